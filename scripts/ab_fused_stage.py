@@ -0,0 +1,115 @@
+"""
+融合模式(nyaturingtest_fused_stage)和分阶段模式的 A/B 对比
+
+在同一份录制的聊天记录上分别以两种模式回放 Session.update，使用 .env 中配置的真实接口，
+统计每批消息的 llm 调用次数、提示词和回复的 token 数、llm 耗时和整批耗时
+
+两种模式各自使用独立的会话(ab_staged / ab_fused)，开始前会清空这两个会话的记忆。
+两种模式的对话状态会随各自的回复而分化，所以回复数量只能粗略比较
+
+用法: python scripts/ab_fused_stage.py chat.jsonl [--batch-size 8] [--limit 40]
+"""
+
+import argparse
+import asyncio
+from dataclasses import dataclass, field
+import statistics
+import time
+
+from common import load_plugin, read_chat_log
+
+
+@dataclass
+class ModeStats:
+    batches: int = 0
+    llm_calls: int = 0
+    prompt_tokens: int = 0
+    response_tokens: int = 0
+    llm_seconds: list[float] = field(default_factory=list)
+    batch_seconds: list[float] = field(default_factory=list)
+    replies: int = 0
+    replied_batches: int = 0
+
+    def rows(self) -> dict[str, float]:
+        batches = max(self.batches, 1)
+        return {
+            "llm 调用/批": self.llm_calls / batches,
+            "提示词 tokens/批": self.prompt_tokens / batches,
+            "回复 tokens/批": self.response_tokens / batches,
+            "llm 耗时/批(s)": sum(self.llm_seconds) / batches,
+            "整批耗时 p50(s)": statistics.median(self.batch_seconds) if self.batch_seconds else 0.0,
+            "整批耗时 p95(s)": _percentile(self.batch_seconds, 0.95),
+            "有回复的批次": float(self.replied_batches),
+            "回复条数": float(self.replies),
+        }
+
+
+def _percentile(values: list[float], q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(int(len(values) * q), len(values) - 1)]
+
+
+async def replay(messages: list[dict], fused: bool, batch_size: int) -> ModeStats:
+    from nonebot_plugin_nyaturingtest import GroupState, llm_response
+    from nonebot_plugin_nyaturingtest.config import plugin_config
+    from nonebot_plugin_nyaturingtest.context import count_tokens
+    from nonebot_plugin_nyaturingtest.mem import Message
+    from nonebot_plugin_nyaturingtest.session import Session
+
+    plugin_config.nyaturingtest_fused_stage = fused
+    session = Session(
+        siliconflow_api_key=plugin_config.nyaturingtest_siliconflow_api_key,
+        id="ab_fused" if fused else "ab_staged",
+    )
+    await session.reset()
+    stats = ModeStats()
+
+    async def llm(prompt: str) -> str:
+        stats.llm_calls += 1
+        stats.prompt_tokens += count_tokens(prompt)
+        start = time.monotonic()
+        response = await llm_response(GroupState.client, prompt)
+        stats.llm_seconds.append(time.monotonic() - start)
+        stats.response_tokens += count_tokens(response)
+        return response
+
+    for offset in range(0, len(messages), batch_size):
+        batch = [Message.from_json(data) for data in messages[offset : offset + batch_size]]
+        start = time.monotonic()
+        try:
+            replies = await session.update(messages_chunk=batch, llm=llm)
+        except Exception as e:
+            print(f"{'融合' if fused else '分阶段'}模式第 {stats.batches + 1} 批失败: {e}")
+            replies = None
+        stats.batch_seconds.append(time.monotonic() - start)
+        stats.batches += 1
+        if replies:
+            stats.replied_batches += 1
+            stats.replies += len(replies)
+    return stats
+
+
+async def main(args: argparse.Namespace):
+    messages = read_chat_log(args.log)
+    if args.limit:
+        messages = messages[: args.limit * args.batch_size]
+    staged = await replay(messages, fused=False, batch_size=args.batch_size)
+    fused = await replay(messages, fused=True, batch_size=args.batch_size)
+
+    print(f"\n{len(messages)} 条消息，每批 {args.batch_size} 条，共 {staged.batches} 批\n")
+    print(f"{'':<18}{'分阶段':>12}{'融合':>12}{'融合/分阶段':>14}")
+    for (name, a), b in zip(staged.rows().items(), fused.rows().values()):
+        ratio = f"{b / a:.2f}" if a else "-"
+        print(f"{name:<18}{a:>12.2f}{b:>12.2f}{ratio:>14}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("log", help="录制的聊天记录(JSON Lines 或会话文件)")
+    parser.add_argument("--batch-size", type=int, default=8, help="每批消息数")
+    parser.add_argument("--limit", type=int, default=0, help="最多回放的批次数，0 为全部")
+    args = parser.parse_args()
+    load_plugin()
+    asyncio.run(main(args))
@@ -0,0 +1,75 @@
+"""
+本地向量索引(VectorIndex)的精确搜索和 IVF 近似搜索对比
+
+生成带主题聚集的合成向量(与 BAAI/bge-m3 相同的 1024 维)，统计每次查询的耗时、IVF 相对精确搜索的 recall@k、
+一次性构建索引和逐批追加(add)的耗时
+
+用法: python scripts/bench_ann.py [--sizes 1000 4000 20000 100000] [--nprobe 4 8 16]
+"""
+
+import argparse
+import time
+
+from common import load_plugin
+import numpy as np
+
+
+def _dataset(n: int, dim: int, rng: np.random.Generator) -> tuple[np.ndarray, np.ndarray]:
+    """
+    n 个向量和 100 个查询，每 50 个向量一个主题
+    """
+    topics = 2.0 * rng.normal(size=(max(n // 50, 10), dim)).astype(np.float32)
+    vectors = topics[rng.integers(len(topics), size=n)] + 0.6 * rng.normal(size=(n, dim)).astype(np.float32)
+    queries = vectors[rng.integers(n, size=100)] + 0.4 * rng.normal(size=(100, dim)).astype(np.float32)
+    return vectors, queries
+
+
+def _timed(func, *args, **kwargs):
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def main(args: argparse.Namespace):
+    from nonebot_plugin_nyaturingtest.ann import VectorIndex
+
+    rng = np.random.default_rng(1)
+    for n in args.sizes:
+        vectors, queries = _dataset(n, args.dim, rng)
+        texts = [str(i) for i in range(n)]
+        exact = VectorIndex(texts, vectors, ivf_threshold=n)
+        expected, seconds = _timed(exact.search, queries, args.k)
+        line = f"n={n:>6} 精确 {seconds / len(queries) * 1000:6.2f}ms/查询"
+
+        # 每次索引新增 1% 的段落时，追加和重建的耗时
+        step = max(n // 100, 1)
+        base = VectorIndex(texts[: n - step], vectors[: n - step])
+        _, rebuild = _timed(VectorIndex, texts, vectors, previous=base)
+        _, append = _timed(base.add, texts[n - step :], vectors[n - step :])
+        line += f" | 新增 {step} 段: 重建 {rebuild * 1000:.0f}ms, 追加 {append * 1000:.0f}ms"
+        print(line)
+
+        if n <= args.ivf_threshold:
+            continue
+        for nprobe in args.nprobe:
+            index, build = _timed(VectorIndex, texts, vectors, ivf_threshold=args.ivf_threshold, nprobe=nprobe)
+            results, seconds = _timed(index.search, queries, args.k)
+            recall = np.mean(
+                [len({i for i, _ in hits} & {i for i, _ in truth}) / args.k for hits, truth in zip(results, expected)]
+            )
+            print(
+                f"{'':>8} IVF nprobe={nprobe:<3} {seconds / len(queries) * 1000:6.2f}ms/查询 "
+                f"recall@{args.k}={recall:.3f} 构建 {build:.1f}s"
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 4000, 20000, 100000], help="段落数量")
+    parser.add_argument("--nprobe", type=int, nargs="+", default=[4, 8, 16], help="IVF 搜索的簇数量")
+    parser.add_argument("--ivf-threshold", type=int, default=4096, help="超过这个数量时使用 IVF")
+    parser.add_argument("--dim", type=int, default=1024, help="向量维度")
+    parser.add_argument("-k", type=int, default=5, help="每个查询返回的结果数")
+    args = parser.parse_args()
+    load_plugin()
+    main(args)
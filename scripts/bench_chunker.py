@@ -0,0 +1,93 @@
+"""
+TextChunker(offset mapping 切片 + 前缀复用)与旧的 encode/decode 切分对比
+
+旧的切分对整段文本 encode 后按 token 窗口 decode，每次都要对整个缓存重新分词，decode 还可能改变原文(空格、归一化)；
+现在按 offset mapping 从原文切片，只在末尾追加内容时只对新增部分分词。分别统计:
+一次性切分 1MB 聊天记录、缓存逐步增长时每次重新切分、批量切分查询的耗时
+
+用法: python scripts/bench_chunker.py [chat.jsonl] [--size 1000000] [--local-tokenizer]
+"""
+
+import argparse
+import time
+
+from common import get_tokenizer, load_plugin, read_chat_log, synthetic_chat_log
+
+
+def legacy_split(text: str, tokenizer, max_tokens: int, overlap: int) -> list[str]:
+    """
+    旧版本的切分：encode 整段文本，按窗口 decode
+    """
+    tokens = tokenizer.encode(text, add_special_tokens=False)
+    chunks = []
+    start = 0
+    while start < len(tokens):
+        end = min(start + max_tokens, len(tokens))
+        chunks.append(tokenizer.decode(tokens[start:end]))
+        start += max_tokens - overlap
+    return chunks
+
+
+def _timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+def main(args: argparse.Namespace):
+    from nonebot_plugin_nyaturingtest.chunker import TextChunker
+    from nonebot_plugin_nyaturingtest.mem import Message, render_message
+
+    messages = read_chat_log(args.log) if args.log else synthetic_chat_log(args.size)
+    lines = [render_message(Message.from_json(data)) for data in messages]
+    tokenizer = get_tokenizer(args.local_tokenizer, lines)
+    log = "".join(f"{line}\n" for line in lines)
+    print(f"聊天记录 {len(log.encode()) / 1e6:.2f}MB，{len(lines)} 行")
+
+    legacy, legacy_seconds = _timed(legacy_split, log, tokenizer, 512, 100)
+    chunks, seconds = _timed(TextChunker(tokenizer, max_tokens=512, overlap=100, cache_size=0).split, log)
+    altered = sum(chunk not in log for chunk in legacy)
+    verbatim = sum(chunk in log for chunk in chunks)
+    print(
+        f"一次性切分: encode/decode {legacy_seconds:.2f}s ({len(legacy)} 块，{altered} 块与原文不一致) | "
+        f"offset mapping {seconds:.2f}s ({len(chunks)} 块，{verbatim} 块与原文一致)"
+    )
+
+    # 缓存每次新增 20 行，每次都重新切分整个缓存
+    caches = []
+    cache = ""
+    for start in range(0, len(lines), 20):
+        cache += "".join(f"{line}\n" for line in lines[start : start + 20])
+        if len(cache) > args.cache_chars:
+            break
+        caches.append(cache)
+    legacy_seconds = sum(_timed(legacy_split, cache, tokenizer, 512, 100)[1] for cache in caches)
+    chunker = TextChunker(tokenizer, max_tokens=512, overlap=100, cache_size=0)
+    results, seconds = _timed(lambda: [chunker.split(cache) for cache in caches])
+    fresh = TextChunker(tokenizer, max_tokens=512, overlap=100, cache_size=0).split(caches[-1])
+    print(
+        f"缓存增长到 {len(caches[-1].encode()) / 1e3:.0f}KB，{len(caches)} 次重新切分: "
+        f"encode/decode {legacy_seconds:.2f}s | 前缀复用 {seconds:.2f}s "
+        f"(与一次性切分结果{'一致' if results[-1] == fresh else '不一致'})"
+    )
+
+    queries = lines[:200]
+    legacy_seconds = _timed(lambda: [legacy_split(query, tokenizer, 8192, 100) for query in queries])[1]
+    chunker = TextChunker(tokenizer, max_tokens=8192, overlap=100)
+    seconds = _timed(chunker.split_many, queries)[1]
+    cached = _timed(chunker.split_many, queries)[1]
+    print(
+        f"切分 {len(queries)} 条查询: encode/decode {legacy_seconds * 1000:.1f}ms | "
+        f"批量 {seconds * 1000:.1f}ms | 重复(缓存) {cached * 1000:.2f}ms"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("log", nargs="?", help="录制的聊天记录(JSON Lines 或会话文件)，不提供时使用合成的聊天记录")
+    parser.add_argument("--size", type=int, default=1_000_000, help="合成聊天记录的大小(字节)")
+    parser.add_argument("--cache-chars", type=int, default=70_000, help="逐步增长的缓存最多的字符数")
+    parser.add_argument("--local-tokenizer", action="store_true", help="使用在聊天记录上训练的小分词器")
+    args = parser.parse_args()
+    load_plugin()
+    main(args)
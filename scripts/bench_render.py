@@ -0,0 +1,69 @@
+"""
+提示词中消息渲染方式的 token 数对比
+
+旧的提示词直接插入短期记忆的 repr(`deque([Message(time=datetime.datetime(...), ...)])`)，
+检索查询使用 `'名称':'内容'`；现在统一使用 render_messages 的 `HH:MM 名称: 内容`。
+在聊天记录上滑动与短期记忆相同大小(50 条)的窗口，统计每次 llm 调用中这一部分的 token 数
+
+用法: python scripts/bench_render.py [chat.jsonl] [--local-tokenizer]
+"""
+
+import argparse
+from collections import deque
+from dataclasses import dataclass
+from datetime import datetime
+import statistics
+
+from common import get_tokenizer, load_plugin, read_chat_log, synthetic_chat_log
+
+WINDOW = 50
+"""
+短期记忆保留的消息数(length_limit * 5)
+"""
+
+
+@dataclass
+class LegacyMessage:
+    """
+    旧版本的 Message，repr 与旧提示词中的内容一致
+    """
+
+    time: datetime
+    user_name: str
+    content: str
+
+
+def main(args: argparse.Namespace):
+    from nonebot_plugin_nyaturingtest.mem import Message, render_messages
+
+    data = read_chat_log(args.log) if args.log else synthetic_chat_log(200_000)
+    messages = [Message.from_json(item) for item in data]
+    legacy = [LegacyMessage(time=msg.time, user_name=msg.user_name, content=msg.content) for msg in messages]
+    tokenizer = get_tokenizer(args.local_tokenizer, [msg.content for msg in messages])
+
+    def count(text: str) -> int:
+        return len(tokenizer.encode(text, add_special_tokens=False))
+
+    rows = {"上下文(repr)": [], "上下文(紧凑)": [], "检索查询(旧)": [], "检索查询(紧凑)": []}
+    step = max(WINDOW // 5, 1)
+    for end in range(WINDOW, len(messages) + 1, step):
+        window = messages[end - WINDOW : end]
+        rows["上下文(repr)"].append(count(f"{deque(legacy[end - WINDOW : end], maxlen=WINDOW)}"))
+        rows["上下文(紧凑)"].append(count(render_messages(window)))
+        rows["检索查询(旧)"].append(count("\n".join(f"'{msg.user_name}':'{msg.content}'" for msg in window)))
+        rows["检索查询(紧凑)"].append(count(render_messages(window)))
+
+    print(f"{len(messages)} 条消息，{len(rows['上下文(repr)'])} 个 {WINDOW} 条消息的窗口")
+    for name, values in rows.items():
+        print(f"{name:<12} 平均 {statistics.mean(values):8.0f} tokens/次  最大 {max(values):6d}")
+    before, after = statistics.mean(rows["上下文(repr)"]), statistics.mean(rows["上下文(紧凑)"])
+    print(f"每次反馈/对话调用的聊天记录部分减少 {before - after:.0f} tokens ({1 - after / before:.0%})")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("log", nargs="?", help="录制的聊天记录(JSON Lines 或会话文件)，不提供时使用合成的聊天记录")
+    parser.add_argument("--local-tokenizer", action="store_true", help="在聊天记录上训练分词器，不下载 BAAI/bge-m3")
+    args = parser.parse_args()
+    load_plugin()
+    main(args)
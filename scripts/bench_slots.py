@@ -0,0 +1,95 @@
+"""
+Message、Impression 和 EmotionState 每个对象占用的内存
+
+旧版本是普通的 dataclass(有 __dict__)，Impression 用 delta 字典保存情感变化，Message 的每个发言人名称都是单独的字符串；
+现在都是 slots dataclass，Impression 使用三个 float 字段，Message 的发言人名称共用一份。
+使用 tracemalloc 统计从 JSON 解析并创建对象后仍然保留的内存，除以对象数量
+
+用法: python scripts/bench_slots.py [chat.jsonl] [-n 20000]
+"""
+
+import argparse
+from dataclasses import dataclass
+from datetime import datetime
+import gc
+import json
+import tracemalloc
+
+from common import load_plugin, read_chat_log, synthetic_chat_log
+
+
+@dataclass
+class LegacyMessage:
+    time: datetime
+    user_name: str
+    content: str
+
+
+@dataclass
+class LegacyImpression:
+    timestamp: datetime
+    delta: dict
+
+
+@dataclass
+class LegacyEmotionState:
+    valence: float = 0.0
+    arousal: float = 0.0
+    dominance: float = 0.0
+
+
+def measure(build) -> float:
+    """
+    build() 创建对象列表，返回保留的内存除以对象数量(字节)
+    """
+    gc.collect()
+    tracemalloc.start()
+    objects = build()
+    gc.collect()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return size / len(objects)
+
+
+def main(args: argparse.Namespace):
+    from nonebot_plugin_nyaturingtest.emotion import EmotionState
+    from nonebot_plugin_nyaturingtest.impression import Impression
+    from nonebot_plugin_nyaturingtest.mem import Message
+
+    data = read_chat_log(args.log) if args.log else synthetic_chat_log(args.n * 60)
+    data = (data * (args.n // len(data) + 1))[: args.n]
+    # 每次从 JSON 文本解析，和加载会话文件时一样，每条消息的字符串都是新对象
+    raw = json.dumps(data, ensure_ascii=False)
+    now = datetime.now()
+    deltas = json.dumps([{"valence": 0.1 * (i % 10), "arousal": 0.2, "dominance": -0.1} for i in range(args.n)])
+
+    rows = {
+        "Message": (
+            lambda: [
+                LegacyMessage(datetime.fromisoformat(item["time"]), item["user_name"], item["content"])
+                for item in json.loads(raw)
+            ],
+            lambda: [Message.from_json(item) for item in json.loads(raw)],
+        ),
+        "Impression": (
+            lambda: [LegacyImpression(now, delta) for delta in json.loads(deltas)],
+            lambda: [Impression.from_delta(now, delta) for delta in json.loads(deltas)],
+        ),
+        "EmotionState": (
+            lambda: [LegacyEmotionState(0.1 * (i % 10), 0.2, -0.1) for i in range(args.n)],
+            lambda: [EmotionState(0.1 * (i % 10), 0.2, -0.1) for i in range(args.n)],
+        ),
+    }
+    print(f"{args.n} 个对象，保留的内存(字节/对象，Message 包括内容字符串)")
+    for name, (legacy, current) in rows.items():
+        before, after = measure(legacy), measure(current)
+        print(f"{name:<14}{before:8.0f} -> {after:6.0f}  ({1 - after / before:.0%})")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("log", nargs="?", help="录制的聊天记录(JSON Lines 或会话文件)，不提供时使用合成的聊天记录")
+    parser.add_argument("-n", type=int, default=20000, help="对象数量")
+    args = parser.parse_args()
+    load_plugin()
+    main(args)
@@ -0,0 +1,94 @@
+"""
+基准测试和对比脚本共用的工具
+
+在仓库根目录运行脚本，例如 `python scripts/ab_fused_stage.py chat.jsonl`，使用与 `nb run` 相同的 .env 配置
+"""
+
+from datetime import datetime, timedelta
+import json
+from pathlib import Path
+import random
+import sys
+
+import nonebot
+from nonebot.adapters.onebot.v11 import Adapter as OnebotV11Adapter
+
+
+def load_plugin():
+    """
+    初始化 NoneBot 并加载插件，之后才能导入插件的模块
+    """
+    sys.path.insert(0, str(Path(__file__).parents[1] / "src"))
+    nonebot.init()
+    nonebot.get_driver().register_adapter(OnebotV11Adapter)
+    nonebot.load_from_toml("pyproject.toml")
+    nonebot.require("nonebot_plugin_nyaturingtest")
+
+
+def read_chat_log(path: str) -> list[dict]:
+    """
+    读取录制的聊天记录
+
+    支持两种格式：每行一条 `Message.to_json()` 的 JSON Lines 文件，或者插件保存的会话文件(session_*.json)，
+    后者使用其中短期记忆的消息
+
+    Returns:
+        `Message.to_json()` 格式的消息列表
+    """
+    text = Path(path).read_text(encoding="utf-8")
+    if path.endswith(".json"):
+        return json.loads(text)["global_memory"]["messages"]
+    return [json.loads(line) for line in text.splitlines() if line.strip()]
+
+
+_WORDS = (
+    "今天 吃 什么 哈哈 笑死 这个 游戏 好玩 我 你 他 喵喵 在吗 为什么 不知道 真的 假的 晚上 一起 打 原神 明天 "
+    "上班 好累 摸鱼 老板 图片 表情包 666 hello world ok lol"
+).split()
+_NAMES = ["小明", "阿狸", "Tom", "猫猫", "路人甲"]
+
+
+def synthetic_chat_log(size: int, seed: int = 0) -> list[dict]:
+    """
+    生成大约 size 字节的合成聊天记录，没有录制的聊天记录时使用
+
+    Returns:
+        `Message.to_json()` 格式的消息列表
+    """
+    rng = random.Random(seed)
+    time = datetime(2025, 1, 1, 20, 0)
+    messages = []
+    total = 0
+    while total < size:
+        time += timedelta(seconds=rng.randint(1, 90))
+        content = "".join(
+            rng.choice(_WORDS) + rng.choice(["", "，", " ", "！", "？"]) for _ in range(rng.randint(2, 15))
+        )
+        messages.append({"time": time.isoformat(), "user_name": rng.choice(_NAMES), "content": content})
+        total += len(content.encode()) + 20
+    return messages
+
+
+def get_tokenizer(local: bool, corpus: list[str]):
+    """
+    获取分词器
+
+    Args:
+        local: 在 corpus 上训练一个小的 Unigram 快速分词器，用于无法下载 BAAI/bge-m3 分词器的环境。
+            token 数量的绝对值与 BAAI/bge-m3 不同，只适合比较相对大小
+    """
+    if not local:
+        from nonebot_plugin_nyaturingtest.context import get_tokenizer
+
+        return get_tokenizer()
+
+    from tokenizers import Tokenizer, models, normalizers, pre_tokenizers, trainers
+    from transformers import PreTrainedTokenizerFast
+
+    model = Tokenizer(models.Unigram())
+    model.normalizer = normalizers.NFKC()
+    model.pre_tokenizer = pre_tokenizers.Metaspace()
+    model.train_from_iterator(
+        corpus[:5000], trainers.UnigramTrainer(vocab_size=2000, special_tokens=["<unk>"], unk_token="<unk>")
+    )
+    return PreTrainedTokenizerFast(tokenizer_object=model, unk_token="<unk>", model_max_length=8192)
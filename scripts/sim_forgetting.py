@@ -0,0 +1,106 @@
+"""
+长期记忆遗忘策略(Forgetting)的模拟
+
+每天索引一批合成段落(按主题聚集的 1024 维向量，重要性服从泊松分布)，每天的查询集中在当周的热门主题上，
+被检索到的段落记录检索次数。分别在不遗忘、按半衰期遗忘、按段落数上限遗忘三种策略下，
+每 30 天统计段落数、向量和文本占用的内存估计、本地向量检索的耗时，以及最相似段落与查询主题一致的比例
+
+用法: python scripts/sim_forgetting.py [--days 180] [--half-life 14] [--cap 20000]
+"""
+
+import argparse
+from pathlib import Path
+import tempfile
+import time
+
+from common import load_plugin
+import numpy as np
+
+_DAY = 86400.0
+_DIM = 1024
+_TOPICS = 400
+_PASSAGE_BYTES = 300
+"""
+每个段落文本和元数据的估计大小
+"""
+
+
+def simulate(args: argparse.Namespace, usage_path: str, half_life: float, cap: int, forget: bool) -> list[tuple]:
+    from nonebot_plugin_nyaturingtest.ann import VectorIndex
+    from nonebot_plugin_nyaturingtest.forgetting import Forgetting
+
+    rng = np.random.default_rng(1)
+    centers = rng.standard_normal((_TOPICS, _DIM)).astype(np.float32)
+    forgetting = Forgetting(usage_path, half_life=half_life, threshold=args.threshold, max_passages=cap)
+    ids: list[str] = []
+    topics: list[int] = []
+    importance: dict[str, int] = {}
+    index: VectorIndex | None = None
+    start = 1.7e9
+    rows = []
+    for day in range(args.days):
+        now = start + day * _DAY
+        # 热门主题每周变化
+        hot = (np.arange(20) + day // 7 * 7) % _TOPICS
+        passage_topics = rng.choice(hot, args.passages_per_day)
+        vectors = centers[passage_topics] + 0.8 * rng.standard_normal((len(passage_topics), _DIM)).astype(np.float32)
+        new = [f"p{day}-{i}" for i in range(len(passage_topics))]
+        ids += new
+        topics += passage_topics.tolist()
+        importance.update({key: int(rng.poisson(2)) for key in new})
+        forgetting.indexed(new, now)
+        if index is None:
+            index = VectorIndex(list(new), vectors)
+        else:
+            index.add(new, vectors)
+
+        query_topics = rng.choice(hot[:10], args.queries_per_day)
+        queries = centers[query_topics] + 0.8 * rng.standard_normal((len(query_topics), _DIM)).astype(np.float32)
+        search_start = time.perf_counter()
+        results = index.search(queries, 5)
+        latency = (time.perf_counter() - search_start) / len(queries)
+        match = float(np.mean([topics[hits[0][0]] == topic for hits, topic in zip(results, query_topics)]))
+        forgetting.retrieved([ids[i] for hits in results for i, _ in hits], now)
+
+        if forget:
+            forgotten = set(forgetting.select(ids, importance, now))
+            forgetting.forget(list(forgotten))
+            if forgotten:
+                keep = [i for i, key in enumerate(ids) if key not in forgotten]
+                ids = [ids[i] for i in keep]
+                topics = [topics[i] for i in keep]
+                index = VectorIndex(list(ids), index.vectors(keep), previous=index)
+        if (day + 1) % 30 == 0:
+            megabytes = len(ids) * (_DIM * 4 + _PASSAGE_BYTES) / 2**20
+            rows.append((day + 1, len(ids), megabytes, latency * 1000, match))
+    return rows
+
+
+def main(args: argparse.Namespace):
+    policies = [
+        ("不遗忘", 30.0, 0, False),
+        (f"半衰期 {args.half_life:g} 天", args.half_life, 0, True),
+        (f"上限 {args.cap} 段", 30.0, args.cap, True),
+    ]
+    with tempfile.TemporaryDirectory() as directory:
+        for name, half_life, cap, forget in policies:
+            print(name)
+            usage_path = str(Path(directory) / f"{name}.json")
+            for day, passages, megabytes, latency, match in simulate(args, usage_path, half_life, cap, forget):
+                print(
+                    f"  第 {day:3d} 天: {passages:6d} 段 {megabytes:6.1f}MB "
+                    f"检索 {latency:5.2f}ms/查询 主题一致 {match:.0%}"
+                )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--days", type=int, default=180, help="模拟的天数")
+    parser.add_argument("--passages-per-day", type=int, default=300, help="每天索引的段落数")
+    parser.add_argument("--queries-per-day", type=int, default=60, help="每天的检索次数")
+    parser.add_argument("--half-life", type=float, default=14.0, help="半衰期策略的半衰期(天)")
+    parser.add_argument("--threshold", type=float, default=0.1, help="价值低于这个值的段落会被遗忘")
+    parser.add_argument("--cap", type=int, default=20000, help="上限策略最多保留的段落数")
+    args = parser.parse_args()
+    load_plugin()
+    main(args)
@@ -1,6 +1,7 @@
 import asyncio
 import base64
-from dataclasses import dataclass, field
+from collections.abc import AsyncIterator
+from dataclasses import dataclass, field, replace
 from datetime import datetime
 import random
 import re
@@ -9,12 +10,13 @@ import traceback
 
 import anyio
 import httpx
-from nonebot import logger, on_command, on_message, require
+from nonebot import logger, on_command, on_message, on_notice, require
 from nonebot.adapters import Message
 from nonebot.adapters.onebot.v11 import (
     Bot,
     Event,
     GroupMessageEvent,
+    NoticeEvent,
     PrivateMessageEvent,
 )
 from nonebot.matcher import Matcher
@@ -27,9 +29,12 @@ require("nonebot_plugin_localstore")
 
 from .client import LLMClient
 from .config import Config, plugin_config
-from .image_manager import IMAGE_CACHE_DIR, image_manager
+from .image_manager import DEFERRED_IMAGE, IMAGE_CACHE_DIR, format_description, image_manager
+from .ingest import collapse_into, take_batch
 from .mem import Message as MMessage
-from .session import Session
+from .nickname import nickname_cache
+from .scheduler import scheduler, scheduling
+from .session import Session, Supersede
 
 __plugin_meta__ = PluginMetadata(
     name="NYATuringTest",
@@ -51,6 +56,10 @@ async def is_private_message(event: Event) -> bool:
     return isinstance(event, PrivateMessageEvent)
 
 
+async def is_group_card_notice(event: Event) -> bool:
+    return isinstance(event, NoticeEvent) and event.notice_type == "group_card"
+
+
 @dataclass
 class GroupState:
     event: Event | None = None
@@ -59,11 +68,33 @@ class GroupState:
         default_factory=lambda: Session(siliconflow_api_key=plugin_config.nyaturingtest_siliconflow_api_key)
     )
     messages_chunk: list[MMessage] = field(default_factory=list)
+    # 收到提到机器人的消息时唤醒处理循环，不再等待批处理延迟
+    wakeup: asyncio.Event = field(default_factory=asyncio.Event)
+    urgent: bool = False
+    # 有新消息到达，用于打断进行中的对话请求
+    arrived: asyncio.Event = field(default_factory=asyncio.Event)
     client = LLMClient(
-        client=AsyncOpenAI(
-            api_key=plugin_config.nyaturingtest_chat_openai_api_key,
-            base_url=plugin_config.nyaturingtest_chat_openai_base_url,
-        )
+        client=[
+            AsyncOpenAI(
+                api_key=plugin_config.nyaturingtest_chat_openai_api_key,
+                base_url=plugin_config.nyaturingtest_chat_openai_base_url,
+            )
+        ]
+        + [
+            AsyncOpenAI(
+                # 没有单独配置 api key 的备用接口使用主接口的 api key
+                api_key=(
+                    plugin_config.nyaturingtest_chat_openai_fallback_api_keys[index : index + 1]
+                    or [plugin_config.nyaturingtest_chat_openai_api_key]
+                )[0],
+                base_url=base_url,
+            )
+            for index, base_url in enumerate(plugin_config.nyaturingtest_chat_openai_fallback_base_urls)
+        ],
+        timeout=plugin_config.nyaturingtest_chat_timeout,
+        hedge_delay=plugin_config.nyaturingtest_hedge_delay,
+        failure_threshold=plugin_config.nyaturingtest_breaker_failures,
+        cooldown=plugin_config.nyaturingtest_breaker_cooldown,
     )
     lock = asyncio.Lock()
 
@@ -76,26 +107,120 @@ async def spawn_state(state: GroupState):
     启动后台任务循环检查是否要回复
     """
     while True:
-        await asyncio.sleep(random.uniform(5.0, 10.0))  # 随机等待5-10秒模拟人类查看消息和理解，并且避免看不到连续消息
+        # 随机等待5-10秒模拟人类查看消息和理解，并且避免看不到连续消息；被提到时立即处理
+        try:
+            await asyncio.wait_for(state.wakeup.wait(), timeout=random.uniform(5.0, 10.0))
+        except asyncio.TimeoutError:
+            pass
+        state.wakeup.clear()
+        if state.bot is not None and isinstance(state.event, GroupMessageEvent):
+            group_id = state.event.group_id
+            if nickname_cache.is_cold(group_id):
+                # 批量预热群成员昵称，过期后重新预热；会话由其它指令创建的群也在这里预热
+                task = asyncio.create_task(nickname_cache.warm(state.bot, group_id))
+                _tasks.add(task)
+                task.add_done_callback(_tasks.discard)
         async with state.lock:
             if state.bot is None or state.event is None:
                 continue
             if len(state.messages_chunk) == 0:
                 continue
             logger.debug(f"Processing message chunk: {state.messages_chunk}")
-            messages_chunk = state.messages_chunk.copy()
-            state.messages_chunk.clear()
-            try:
-                responses = await state.session.update(
-                    messages_chunk=messages_chunk, llm=lambda x: llm_response(state.client, x)
-                )
-            except Exception as e:
-                logger.error(f"Error: {e}")
-                traceback.print_exc()
-                continue
-            if responses:
-                for response in responses:
-                    await state.bot.send(message=response, event=state.event)
+            max_batch_size = plugin_config.nyaturingtest_max_batch_size
+            max_pending = max_batch_size * plugin_config.nyaturingtest_max_pending_batches
+            if max_batch_size > 0 and len(state.messages_chunk) > max_pending:
+                # 积压过多时，最早的消息只记录到记忆中，不再参与反馈和对话
+                overflow = take_batch(state.messages_chunk, len(state.messages_chunk) - max_pending)
+                logger.warning(f"消息积压过多，{len(overflow)} 条消息只记录到记忆中")
+                await state.session.record(overflow)
+            messages_chunk = take_batch(state.messages_chunk, max_batch_size)
+            if state.messages_chunk:
+                # 超出批次大小的消息留到下一批，并且不再等待
+                logger.debug(f"本批次处理 {len(messages_chunk)} 条消息，剩余 {len(state.messages_chunk)} 条")
+                state.wakeup.set()
+            urgent = state.urgent
+            state.urgent = False
+            bot = state.bot
+            event = state.event
+
+            async def send(response: str):
+                await bot.send(message=response, event=event)
+
+            supersede = (
+                Supersede(arrived=state.arrived, take=lambda size: take_superseding(state, size))
+                if plugin_config.nyaturingtest_supersede_threshold > 0
+                else None
+            )
+
+            lazy_image = plugin_config.nyaturingtest_lazy_image
+            # 本群发出的请求在调度器中和其它群公平轮流
+            with scheduling(group=state.session.id):
+                if lazy_image and not state.session.is_idle():
+                    await enrich_deferred_images(state.session, messages_chunk)
+                try:
+                    replies = await state.session.update(
+                        messages_chunk=messages_chunk,
+                        llm=lambda x: llm_response(state.client, x),
+                        llm_stream=(
+                            (lambda x: llm_stream_response(state.client, x))
+                            if plugin_config.nyaturingtest_stream_reply
+                            else None
+                        ),
+                        on_reply=send,
+                        urgent=urgent,
+                        supersede=supersede,
+                    )
+                except Exception as e:
+                    logger.error(f"Error: {e}")
+                    traceback.print_exc()
+                    continue
+                if lazy_image:
+                    image_manager.stats.record_batch((msg.content for msg in messages_chunk), bool(replies))
+                    if not state.session.is_idle():
+                        # 刚进入冒泡/对话状态时解析记忆中延迟的图片
+                        await enrich_deferred_images(state.session, [])
+
+
+def take_superseding(state: GroupState, batch_size: int) -> list[MMessage]:
+    """
+    积累了足够多的新消息或者有消息提到机器人时，取出新消息合并到正在处理的批次
+
+    Args:
+        batch_size: 正在处理的批次已有的消息数，合并后不超过 nyaturingtest_max_batch_size
+    """
+    if not state.urgent and len(state.messages_chunk) < plugin_config.nyaturingtest_supersede_threshold:
+        return []
+    max_batch_size = plugin_config.nyaturingtest_max_batch_size
+    if max_batch_size > 0:
+        if batch_size >= max_batch_size:
+            # 批次已满，新消息留给下一批
+            return []
+        max_batch_size -= batch_size
+    state.urgent = False
+    return take_batch(state.messages_chunk, max_batch_size)
+
+
+async def enrich_deferred_images(session: Session, messages_chunk: list[MMessage]):
+    """
+    解析新消息和短期记忆中延迟的图片，替换占位文本
+
+    解析出错时保留占位文本，不影响本批次的处理
+    """
+    messages = messages_chunk + list(session.global_memory.access().messages)
+    try:
+        resolved = await image_manager.resolve_deferred(msg.content for msg in messages)
+    except Exception as e:
+        logger.warning(f"延迟图片解析出错: {e}")
+        return
+    if not resolved:
+        return
+
+    def rewrite(text: str) -> str:
+        return DEFERRED_IMAGE.sub(lambda match: resolved.get(match.group(0), match.group(0)), text)
+
+    for i, msg in enumerate(messages_chunk):
+        messages_chunk[i] = replace(msg, content=rewrite(msg.content))
+    session.global_memory.rewrite(rewrite)
 
 
 group_states: dict[int, GroupState] = {}
@@ -111,6 +236,7 @@ get_status_pm = on_command(
     rule=is_private_message, permission=SUPERUSER, cmd="status", aliases={"状态"}, priority=0, block=True
 )
 auto_chat = on_message(rule=is_group_message, priority=1, block=False)
+group_card_notice = on_notice(rule=is_group_card_notice, priority=1, block=False)
 set_role = on_command(
     rule=is_group_message, permission=SUPERUSER, cmd="set_role", aliases={"设置角色"}, priority=0, block=True
 )
@@ -449,7 +575,10 @@ async def do_status(matcher: type[Matcher], group_id: int):
             task.add_done_callback(_tasks.discard)
     async with group_states[group_id].lock:
         state = group_states[group_id]
-    await matcher.finish(state.session.status())
+    await matcher.finish(
+        f"{state.session.status()}\n\n请求调度:\n{scheduler.report()}\n\n对话模型接口:\n{state.client.report()}\n\n"
+        f"{state.session.long_term_memory.cache_report()}\n{state.session.long_term_memory.memory_report()}"
+    )
 
 
 @list_groups_pm.handle()
@@ -472,7 +601,18 @@ async def llm_response(client: LLMClient, message: str) -> str:
             return ""
     except Exception as e:
         logger.error(f"Error: {e}")
-        return "Error occurred while processing the message."
+        raise
+
+
+async def llm_stream_response(client: LLMClient, message: str) -> AsyncIterator[str]:
+    try:
+        async for delta in client.generate_response_stream(
+            prompt=message, model=plugin_config.nyaturingtest_chat_openai_model
+        ):
+            yield delta
+    except Exception as e:
+        logger.error(f"Error: {e}")
+        raise
 
 
 @auto_chat.handle()
@@ -495,103 +635,187 @@ async def handle_auto_chat(bot: Bot, event: GroupMessageEvent):
         task.add_done_callback(_tasks.discard)
 
     user_id = event.get_user_id()
-    async with group_states[group_id].lock:
+    # 这里不持有 state.lock：处理循环在等待llm时也要能收下新消息，对群状态的修改都不跨越 await
+    with scheduling(group=f"{group_id}"):
         message_content = await message2BotMessage(
-            bot_name=group_states[group_id].session.name(), group_id=group_id, message=event.original_message, bot=bot
+            bot_name=group_states[group_id].session.name(),
+            group_id=group_id,
+            message=event.original_message,
+            bot=bot,
+            defer_images=plugin_config.nyaturingtest_lazy_image and group_states[group_id].session.is_idle(),
         )
     if not message_content:
         return
 
     # 获取用户的昵称
-    try:
-        user_info = await bot.get_group_member_info(group_id=group_id, user_id=int(user_id))
-        nickname = user_info.get("card") or user_info.get("nickname") or str(user_id)
-    except Exception:
-        nickname = str(user_id)
+    nickname_cache.record_message()
+    nickname = await nickname_cache.get(bot, group_id, int(user_id))
 
     # 获取该群的状态
-    async with group_states[group_id].lock:
-        group_states[group_id].event = event
-        group_states[group_id].bot = bot
-        group_states[group_id].messages_chunk.append(
-            MMessage(
-                time=datetime.now(),
-                user_name=nickname,
-                content=message_content,
-            )
-        )
+    state = group_states[group_id]
+    state.event = event
+    state.bot = bot
+    message = MMessage(
+        time=datetime.now(),
+        user_name=nickname,
+        content=message_content,
+    )
+    # 刷屏时重复或近似重复的消息合并为一条计数消息
+    if not collapse_into(
+        state.messages_chunk,
+        message,
+        similarity=plugin_config.nyaturingtest_duplicate_similarity,
+    ):
+        state.messages_chunk.append(message)
+    # at机器人，回复机器人的消息(to_me)或者提到机器人名字时走快速路径
+    if event.is_tome() or state.session.name() in message_content:
+        state.urgent = True
+        state.wakeup.set()
+    state.arrived.set()
+    if plugin_config.nyaturingtest_prefetch_retrieval:
+        with scheduling(group=f"{group_id}"):
+            state.session.prefetch(state.messages_chunk)
+
+
+@group_card_notice.handle()
+async def handle_group_card_notice(event: NoticeEvent):
+    group_id = getattr(event, "group_id", None)
+    user_id = getattr(event, "user_id", None)
+    if group_id is None or user_id is None:
+        return
+    card_new = getattr(event, "card_new", "")
+    if card_new:
+        nickname_cache.update(int(group_id), int(user_id), card_new)
+    else:
+        # 群名片被清空，回退为昵称，下次查询时重新获取
+        nickname_cache.invalidate(int(group_id), int(user_id))
+
+
+_IMAGE_PLACEHOLDER = "\n[图片/表情，网卡了加载不出来]\n"
 
+_segment_semaphore = asyncio.Semaphore(plugin_config.nyaturingtest_segment_concurrency)
+"""
+所有消息共用的消息段解析并发限制
+"""
 
-async def message2BotMessage(bot_name: str, group_id: int, message: Message, bot: Bot) -> str:
+
+async def message2BotMessage(
+    bot_name: str, group_id: int, message: Message, bot: Bot, defer_images: bool = False
+) -> str:
     """
     将消息转换为机器人可读的消息
+
+    各消息段并发解析，超过 nyaturingtest_segment_deadline 秒仍未解析完成的消息段使用占位文本
+
+    Args:
+        defer_images: 是否延迟解析图片，消息提到机器人时不延迟
     """
-    message_content = ""
+    message_semaphore = asyncio.Semaphore(plugin_config.nyaturingtest_segment_concurrency_per_message)
+    if defer_images:
+        mentioned = bot_name in message.extract_plain_text() or any(
+            seg.type == "at" and seg.data.get("qq") == str(bot.self_id) for seg in message
+        )
+        defer_images = not mentioned
 
-    for seg in message:
+    async def resolve(seg) -> str:
+        async with message_semaphore, _segment_semaphore:
+            return await _resolve_segment(
+                bot_name=bot_name, group_id=group_id, seg=seg, bot=bot, defer_images=defer_images
+            )
+
+    parts: list[str] = []
+    tasks: dict[int, asyncio.Task[str]] = {}
+    for index, seg in enumerate(message):
         if seg.type == "text":
-            message_content += f"{seg.data.get('text', '')}"
-        elif seg.type == "image" or seg.type == "emoji":
-            try:
-                url = seg.data.get("url", "")
-                logger.debug(f"Image URL: {url}")
-
-                # 缓存临时目录
-                cache_path = IMAGE_CACHE_DIR.joinpath("raw")
-                cache_path.mkdir(parents=True, exist_ok=True)
-
-                key = re.search(r"[?&]fileid=([a-zA-Z0-9_-]+)", url)
-                if key:
-                    key = key.group(1)
-                    logger.debug(f"Image cache key: {key}")
-                else:
-                    key = None
-                    logger.warning("URL中没有找到rkey参数，无法缓存图片")
-
-                if key and cache_path.joinpath(key).exists():
-                    async with await anyio.open_file(cache_path.joinpath(key), "rb") as f:
-                        image_bytes = await f.read()
-                else:
-                    # 哈基qq欠安全了
-                    ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLSv1_2)
-                    ssl_context.set_ciphers("ALL:@SECLEVEL=1")
-                    async with httpx.AsyncClient(verify=ssl_context) as client:
-                        response = await client.get(url)
-                        response.raise_for_status()
-                        image_bytes = response.content
-                    # 缓存
-                    if key:
-                        async with await anyio.open_file(cache_path.joinpath(key), "wb") as f:
-                            await f.write(image_bytes)
-
-                is_sticker = seg.data.get("sub_type") == 1
-                image_base64 = base64.b64encode(image_bytes).decode("utf-8")
-                description = await image_manager.get_image_description(
-                    image_base64=image_base64, is_sticker=is_sticker
-                )
-                if description:
-                    if is_sticker:
-                        message_content += f"\n[表情包] [情感:{description.emotion}] [内容:{description.description}]\n"
-                    else:
-                        message_content += f"\n[图片] {description.description}\n"
-            except Exception as e:
-                logger.error(f"Error: {e}")
-                message_content += "\n[图片/表情，网卡了加载不出来]\n"
-        elif seg.type == "at":
-            id = seg.data.get("qq")
-            if not id:
-                continue
-            if id == str(bot.self_id):
-                # 由于机器人名并不等于qq群名，这里覆盖为设定名(bot_name)
-                message_content += f" @{bot_name} "
-            else:
-                user_info = await bot.get_group_member_info(group_id=group_id, user_id=int(id))
-                nickname = user_info.get("card") or user_info.get("nickname") or str(id)
-                message_content += f" @{nickname} "
+            parts.append(f"{seg.data.get('text', '')}")
+        elif seg.type in ("image", "emoji", "at"):
+            parts.append(_segment_placeholder(seg))
+            tasks[index] = asyncio.create_task(resolve(seg))
         elif seg.type == "reply":
             # TODO: 处理回复消息
-            message_content += ""
+            parts.append("")
         else:
             logger.warning(f"Unknown message type: {seg.type}")
+            parts.append("")
+
+    if tasks:
+        _, pending = await asyncio.wait(tasks.values(), timeout=plugin_config.nyaturingtest_segment_deadline)
+        for task in pending:
+            task.cancel()
+        if pending:
+            logger.warning(f"{len(pending)} 个消息段在 {plugin_config.nyaturingtest_segment_deadline} 秒内未解析完成")
+        for index, task in tasks.items():
+            if task in pending:
+                continue
+            if task.exception():
+                logger.error(f"Error: {task.exception()}")
+                continue
+            parts[index] = task.result()
 
-    return message_content.strip()
+    return "".join(parts).strip()
+
+
+def _segment_placeholder(seg) -> str:
+    """
+    消息段解析失败或超时时使用的占位文本
+    """
+    if seg.type == "at":
+        return f" @{seg.data.get('qq', '')} "
+    return _IMAGE_PLACEHOLDER
+
+
+async def _resolve_segment(bot_name: str, group_id: int, seg, bot: Bot, defer_images: bool = False) -> str:
+    """
+    解析需要请求外部资源的消息段(图片，表情，at)
+    """
+    if seg.type == "at":
+        id = seg.data.get("qq")
+        if not id:
+            return ""
+        if id == str(bot.self_id):
+            # 由于机器人名并不等于qq群名，这里覆盖为设定名(bot_name)
+            return f" @{bot_name} "
+        nickname = await nickname_cache.get(bot, group_id, int(id))
+        return f" @{nickname} "
+
+    url = seg.data.get("url", "")
+    logger.debug(f"Image URL: {url}")
+
+    # 缓存临时目录
+    cache_path = IMAGE_CACHE_DIR.joinpath("raw")
+    cache_path.mkdir(parents=True, exist_ok=True)
+
+    key = re.search(r"[?&]fileid=([a-zA-Z0-9_-]+)", url)
+    if key:
+        key = key.group(1)
+        logger.debug(f"Image cache key: {key}")
+    else:
+        key = None
+        logger.warning("URL中没有找到rkey参数，无法缓存图片")
+
+    if key and cache_path.joinpath(key).exists():
+        async with await anyio.open_file(cache_path.joinpath(key), "rb") as f:
+            image_bytes = await f.read()
+    else:
+        # 哈基qq欠安全了
+        ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLSv1_2)
+        ssl_context.set_ciphers("ALL:@SECLEVEL=1")
+        async with httpx.AsyncClient(verify=ssl_context) as client:
+            response = await client.get(url)
+            response.raise_for_status()
+            image_bytes = response.content
+        # 缓存
+        if key:
+            async with await anyio.open_file(cache_path.joinpath(key), "wb") as f:
+                await f.write(image_bytes)
+
+    is_sticker = seg.data.get("sub_type") == 1
+    image_base64 = base64.b64encode(image_bytes).decode("utf-8")
+    if defer_images:
+        placeholder = image_manager.defer(image_base64=image_base64, is_sticker=is_sticker)
+        if placeholder:
+            return placeholder
+    description = await image_manager.get_image_description(image_base64=image_base64, is_sticker=is_sticker)
+    if not description:
+        return ""
+    return format_description(description)
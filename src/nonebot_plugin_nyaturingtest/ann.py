@@ -0,0 +1,157 @@
+import math
+
+import numpy as np
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+class VectorIndex:
+    """
+    进程内的向量索引，按余弦相似度检索
+
+    规模较小时对整个矩阵精确搜索，超过 ivf_threshold 时使用 IVF(倒排文件) 近似搜索：
+    用 k-means 把向量分到若干个簇，查询时只搜索离查询最近的 nprobe 个簇
+    """
+
+    def __init__(
+        self,
+        texts: list[str],
+        embeddings: np.ndarray,
+        ivf_threshold: int = 4096,
+        nprobe: int = 8,
+        previous: "VectorIndex | None" = None,
+    ):
+        """
+        Args:
+            texts: 向量对应的文本
+            embeddings: 向量矩阵，每行一个向量
+            ivf_threshold: 超过这个数量时使用 IVF 近似搜索
+            nprobe: IVF 搜索时查找的簇数量
+            previous: 之前构建的索引，数据量没有翻倍时复用它的聚类中心，避免每次重新聚类
+        """
+        self.texts = texts
+        self.nprobe = nprobe
+        self._ivf_threshold = ivf_threshold
+        self._vectors = _normalize(np.asarray(embeddings, dtype=np.float32).reshape(len(texts), -1))
+        self._centroids: np.ndarray | None = None
+        self._lists: list[np.ndarray] = []
+        self._trained_size = 0
+        if len(texts) <= ivf_threshold:
+            return
+        if previous is not None and previous._centroids is not None and len(texts) < 2 * previous._trained_size:
+            self._centroids = previous._centroids
+            self._trained_size = previous._trained_size
+            self._assign()
+        else:
+            self._train()
+
+    def add(self, texts: list[str], embeddings: np.ndarray):
+        """
+        追加文本，不重建已有的向量
+
+        IVF 索引把新向量分到最近的簇，超过 ivf_threshold 或者数据量比聚类时翻倍时重新聚类
+        """
+        if not texts:
+            return
+        vectors = _normalize(np.asarray(embeddings, dtype=np.float32).reshape(len(texts), -1))
+        start = len(self.texts)
+        self.texts = self.texts + texts
+        self._vectors = np.concatenate([self._vectors, vectors]) if start else vectors
+        if len(self.texts) <= self._ivf_threshold:
+            return
+        if self._centroids is None or len(self.texts) >= 2 * self._trained_size:
+            self._train()
+            return
+        assignments = np.argmax(vectors @ self._centroids.T, axis=1)
+        for cluster in np.unique(assignments):
+            ids = start + np.flatnonzero(assignments == cluster)
+            self._lists[cluster] = np.concatenate([self._lists[cluster], ids])
+
+    def _train(self):
+        """
+        对所有向量重新聚类
+        """
+        self._centroids = _kmeans(self._vectors, n_clusters=int(math.sqrt(len(self.texts))))
+        self._trained_size = len(self.texts)
+        self._assign()
+
+    def _assign(self):
+        """
+        把所有向量分到最近的簇
+        """
+        assert self._centroids is not None
+        assignments = np.argmax(self._vectors @ self._centroids.T, axis=1)
+        self._lists = [np.flatnonzero(assignments == cluster) for cluster in range(len(self._centroids))]
+
+    def __len__(self) -> int:
+        return len(self.texts)
+
+    def is_approximate(self) -> bool:
+        return self._centroids is not None
+
+    def vectors(self, ids: list[int]) -> np.ndarray:
+        """
+        归一化后的向量
+        """
+        return self._vectors[ids]
+
+    def search(self, queries: np.ndarray, k: int) -> list[list[tuple[int, float]]]:
+        """
+        检索每个查询最相似的 k 个文本
+
+        Args:
+            queries: 查询向量矩阵，每行一个查询
+
+        Returns:
+            每个查询的 (文本下标, 余弦相似度) 列表，按相似度从高到低排列
+        """
+        queries = _normalize(np.asarray(queries, dtype=np.float32).reshape(-1, self._vectors.shape[1]))
+        results = []
+        for query in queries:
+            if self._centroids is None:
+                candidates = None
+                scores = self._vectors @ query
+            else:
+                probes = _top_k(self._centroids @ query, self.nprobe)
+                candidates = np.concatenate([self._lists[cluster] for cluster in probes])
+                scores = self._vectors[candidates] @ query
+            top = _top_k(scores, k)
+            ids = top if candidates is None else candidates[top]
+            results.append([(int(i), float(score)) for i, score in zip(ids, scores[top])])
+        return results
+
+
+def _top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    """
+    分数最高的 k 个下标，按分数从高到低排列
+    """
+    if len(scores) <= k:
+        return np.argsort(-scores)
+    top = np.argpartition(-scores, k)[:k]
+    return top[np.argsort(-scores[top])]
+
+
+def _kmeans(vectors: np.ndarray, n_clusters: int, iterations: int = 10, sample: int = 64) -> np.ndarray:
+    """
+    球面 k-means，每个簇最多抽样 sample 个向量训练
+
+    Returns:
+        归一化的聚类中心
+    """
+    rng = np.random.default_rng(0)
+    if len(vectors) > n_clusters * sample:
+        vectors = vectors[rng.choice(len(vectors), n_clusters * sample, replace=False)]
+    centroids = vectors[rng.choice(len(vectors), n_clusters, replace=False)]
+    for _ in range(iterations):
+        assignments = np.argmax(vectors @ centroids.T, axis=1)
+        order = np.argsort(assignments, kind="stable")
+        clusters, starts = np.unique(assignments[order], return_index=True)
+        # 空簇保留原来的中心
+        sums = centroids.copy()
+        sums[clusters] = np.add.reduceat(vectors[order], starts, axis=0)
+        centroids = _normalize(sums)
+    return centroids
@@ -0,0 +1,197 @@
+from collections import OrderedDict
+from collections.abc import Iterable
+
+_RESYNC_TOKENS = 32
+"""
+增量分词时额外重新分词的 token 数量，用于找到两次分词结果一致的拼接点
+"""
+
+
+class TextChunker:
+    """
+    按 token 数量把文本切成有重叠的块
+
+    使用快速分词器的 offset mapping 直接从原文切片，不经过 decode，切出的块与原文完全一致；
+    对只在末尾追加内容的文本复用已经分词的前缀，相同文本的切分结果会被缓存。
+    也可以用 append 逐段追加文本、用 take 一次性切分，追加时不需要重建整段文本
+    """
+
+    def __init__(self, tokenizer, max_tokens: int, overlap: int, cache_size: int = 1024):
+        """
+        Args:
+            tokenizer: 分词器，最好是支持 offset mapping 的快速分词器
+            max_tokens: 每个块的最大 token 数量
+            overlap: 相邻块重叠的 token 数量
+            cache_size: 缓存切分结果的文本数量
+        """
+        self._tokenizer = tokenizer
+        self._max_tokens = max_tokens
+        self._overlap = overlap
+        self._cache_size = cache_size
+        self._chunks: OrderedDict[str, list[str]] = OrderedDict()
+        # 上次分词的文本和每个 token 在原文中的位置，用于追加内容后只对新增部分分词
+        self._last_text = ""
+        self._last_offsets: list[tuple[int, int]] = []
+        # 逐段追加的文本，分段保存，追加时不需要拼接整段文本
+        self._stream_parts: list[str] = []
+        self._stream_length = 0
+        self._stream_offsets: list[tuple[int, int]] = []
+
+    def split(self, text: str) -> list[str]:
+        """
+        切分一段文本
+        """
+        cached = self._chunks.get(text)
+        if cached is not None:
+            self._chunks.move_to_end(text)
+            return cached
+        return self._remember(text, self._windows(text, self._incremental_offsets(text)))
+
+    def split_many(self, texts: Iterable[str]) -> list[list[str]]:
+        """
+        批量切分多段文本，没有缓存的文本一次性交给分词器
+        """
+        texts = list(texts)
+        missing = list(dict.fromkeys(text for text in texts if text not in self._chunks))
+        if missing:
+            for text, offsets in zip(missing, self._offsets(missing)):
+                self._remember(text, self._windows(text, offsets))
+        return [self.split(text) for text in texts]
+
+    def prepare(self, text: str):
+        """
+        预先对文本分词，之后切分它或者以它为前缀的文本时只需要对新增部分分词
+        """
+        self._incremental_offsets(text)
+
+    def append(self, text: str):
+        """
+        在追加的文本末尾继续追加内容并分词，只对新增内容和末尾的少量 token 分词，与已经追加的文本长度无关
+        """
+        if not text:
+            return
+        self._stream_parts.append(text)
+        self._stream_length += len(text)
+        offsets = self._stream_offsets
+        keep = len(offsets) - self._max_tokens
+        restart = keep - _RESYNC_TOKENS
+        if restart > 0:
+            # 与 _resume 相同，从末尾 max_tokens 个 token 之前稍早的位置重新分词，在 token 边界一致处拼接
+            boundary = offsets[restart][0]
+            old_starts = {start: index for index, (start, _) in enumerate(offsets[restart + 1 : keep + 1], restart + 1)}
+            suffix = self._offsets([self._stream_suffix(boundary)])[0]
+            for position, (start, _) in enumerate(suffix[1:], 1):
+                index = old_starts.get(start + boundary)
+                if index is not None:
+                    del offsets[index:]
+                    offsets.extend((start + boundary, end + boundary) for start, end in suffix[position:])
+                    return
+        self._stream_offsets = self._offsets(["".join(self._stream_parts)])[0]
+
+    def take(self) -> list[str]:
+        """
+        切分追加的全部文本，并清空追加的文本
+        """
+        text = "".join(self._stream_parts)
+        chunks = self._windows(text, self._stream_offsets) if text else []
+        self.reset()
+        return chunks
+
+    def reset(self):
+        """
+        清空追加的文本
+        """
+        self._stream_parts = []
+        self._stream_length = 0
+        self._stream_offsets = []
+
+    def _stream_suffix(self, boundary: int) -> str:
+        """
+        追加的文本从 boundary 开始到末尾的部分，只拼接末尾的几段
+        """
+        position = self._stream_length
+        parts = []
+        for part in reversed(self._stream_parts):
+            parts.append(part)
+            position -= len(part)
+            if position <= boundary:
+                break
+        return "".join(reversed(parts))[boundary - position :]
+
+    def _remember(self, text: str, chunks: list[str]) -> list[str]:
+        if self._cache_size > 0:
+            self._chunks[text] = chunks
+            while len(self._chunks) > self._cache_size:
+                self._chunks.popitem(last=False)
+        return chunks
+
+    def _incremental_offsets(self, text: str) -> list[tuple[int, int]]:
+        if text == self._last_text:
+            return self._last_offsets
+        offsets = None
+        if self._last_offsets and text.startswith(self._last_text):
+            offsets = self._resume(text)
+        if offsets is None:
+            offsets = self._offsets([text])[0]
+        self._last_text, self._last_offsets = text, offsets
+        return offsets
+
+    def _resume(self, text: str) -> list[tuple[int, int]] | None:
+        """
+        text 是上次分词的文本追加内容后的结果时，只对末尾部分重新分词
+
+        末尾 max_tokens 个 token 之前的内容不会因为追加内容而改变。从那之前稍早的位置重新分词，
+        在两次分词结果第一次出现相同的 token 边界处拼接，之后的分词结果与对整段文本分词一致
+        """
+        old = self._last_offsets
+        keep = len(old) - self._max_tokens
+        restart = keep - _RESYNC_TOKENS
+        if restart <= 0:
+            return None
+        boundary = old[restart][0]
+        old_starts = {start: index for index, (start, _) in enumerate(old[restart + 1 : keep + 1], restart + 1)}
+        suffix = self._offsets([text[boundary:]])[0]
+        for position, (start, _) in enumerate(suffix[1:], 1):
+            index = old_starts.get(start + boundary)
+            if index is not None:
+                return old[:index] + [(start + boundary, end + boundary) for start, end in suffix[position:]]
+        return None
+
+    def _offsets(self, texts: list[str]) -> list[list[tuple[int, int]]]:
+        """
+        每个 token 在原文中的 [起点, 终点)
+        """
+        if getattr(self._tokenizer, "is_fast", False):
+            encoded = self._tokenizer(
+                texts,
+                add_special_tokens=False,
+                return_offsets_mapping=True,
+                return_attention_mask=False,
+                return_token_type_ids=False,
+            )
+            return encoded["offset_mapping"]
+        # 慢速分词器没有 offset mapping，逐个 token 解码后在原文中定位
+        results = []
+        for text in texts:
+            offsets = []
+            position = 0
+            for token in self._tokenizer.encode(text, add_special_tokens=False):
+                piece = self._tokenizer.decode([token]).strip()
+                start = text.find(piece, position) if piece else -1
+                if start < 0:
+                    start = position
+                end = start + len(piece)
+                offsets.append((start, end))
+                position = end
+            results.append(offsets)
+        return results
+
+    def _windows(self, text: str, offsets: list[tuple[int, int]]) -> list[str]:
+        chunks = []
+        step = max(self._max_tokens - self._overlap, 1)
+        for start in range(0, len(offsets), step):
+            end = min(start + self._max_tokens, len(offsets))
+            chunks.append(text[offsets[start][0] : offsets[end - 1][1]])
+            if end == len(offsets):
+                break
+        return chunks
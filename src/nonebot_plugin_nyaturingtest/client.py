@@ -1,27 +1,397 @@
+import asyncio
+from collections import deque
+from collections.abc import AsyncIterator
+import json
+import math
 import re
+import time
 
+from nonebot import logger
 from openai import AsyncOpenAI
 
+from .scheduler import scheduler
 
-class LLMClient:
-    def __init__(self, client: AsyncOpenAI):
+
+class CircuitOpenError(Exception):
+    """
+    接口处于半开状态且已有探测请求，本次不发出请求
+    """
+
+
+class Endpoint:
+    """
+    一个 openai 规范的上游接口，记录延迟并带有熔断器
+
+    熔断器有三种状态：关闭(正常请求)，打开(连续失败后冷却期内不请求)，
+    半开(冷却结束后只允许一个探测请求，成功后关闭，失败后重新打开)
+    """
+
+    def __init__(self, client: AsyncOpenAI, failure_threshold: int = 3, cooldown: float = 60.0):
+        """
+        Args:
+            client: openai 客户端
+            failure_threshold: 连续失败多少次后熔断
+            cooldown: 熔断后多少秒再尝试恢复
+        """
         self.client = client
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self._latencies: deque[float] = deque(maxlen=100)
+        self._failures = 0
+        self._open_until = 0.0
+        self._probing = False
+
+    @property
+    def name(self) -> str:
+        return str(self.client.base_url)
+
+    def available(self) -> bool:
+        """
+        熔断器是否允许请求，半开状态下已有探测请求时不允许
+        """
+        if self._failures < self.failure_threshold:
+            return True
+        return not self._probing and time.monotonic() >= self._open_until
+
+    def acquire(self) -> bool:
+        """
+        发出请求前调用，熔断器没有关闭时本次请求作为探测请求，已有探测请求时返回 False
+        """
+        if self._failures < self.failure_threshold:
+            return True
+        if self._probing:
+            return False
+        self._probing = True
+        return True
+
+    def release(self):
+        """
+        请求被取消，既没有成功也没有失败，允许重新探测
+        """
+        self._probing = False
+
+    def percentile(self, q: float) -> float:
+        """
+        最近请求延迟的百分位数(秒)，没有记录时返回无穷大
+        """
+        if not self._latencies:
+            return math.inf
+        latencies = sorted(self._latencies)
+        return latencies[min(int(len(latencies) * q), len(latencies) - 1)]
+
+    def record_success(self, latency: float):
+        self._latencies.append(latency)
+        self._failures = 0
+        self._probing = False
+
+    def record_failure(self):
+        self._failures += 1
+        # 探测请求失败时重新打开
+        self._probing = False
+        if self._failures >= self.failure_threshold:
+            self._open_until = time.monotonic() + self.cooldown
+            logger.warning(f"接口 {self.name} 连续失败 {self._failures} 次，熔断 {self.cooldown} 秒")
+
+
+class LLMClient:
+    def __init__(
+        self,
+        client: AsyncOpenAI | list[AsyncOpenAI],
+        provider: str = "chat",
+        timeout: float = 300,
+        hedge_delay: float = 0.0,
+        failure_threshold: int = 3,
+        cooldown: float = 60.0,
+    ):
+        """
+        Args:
+            client: openai 客户端，提供多个时组成接口池，按延迟和健康状况选择
+            provider: 调度器中的上游服务名称
+            timeout: 单次请求超时时间(秒)
+            hedge_delay: 请求超过多少秒未返回时向另一个接口发出对冲请求，小于等于0时不对冲
+            failure_threshold: 接口连续失败多少次后熔断
+            cooldown: 接口熔断后多少秒再尝试恢复
+        """
+        clients = client if isinstance(client, list) else [client]
+        self.endpoints = [
+            Endpoint(client, failure_threshold=failure_threshold, cooldown=cooldown) for client in clients
+        ]
+        self.provider = provider
+        self.timeout = timeout
+        self.hedge_delay = hedge_delay
+
+    def _ranked(self) -> list[Endpoint]:
+        """
+        可用的接口，按中位延迟排序(没有延迟记录的按配置顺序排在后面)；全部熔断时返回所有接口
+        """
+        available = [endpoint for endpoint in self.endpoints if endpoint.available()]
+        return sorted(available or self.endpoints, key=lambda endpoint: endpoint.percentile(0.5))
+
+    async def _request(self, endpoint: Endpoint, prompt: str, model: str) -> str | None:
+        if not endpoint.acquire():
+            raise CircuitOpenError(f"接口 {endpoint.name} 正在探测是否恢复")
+        start = time.monotonic()
+        try:
+            response = await endpoint.client.chat.completions.create(
+                messages=[{"role": "user", "content": prompt}],
+                model=model,
+                temperature=0.5,
+                timeout=self.timeout,
+            )
+        except asyncio.CancelledError:
+            endpoint.release()
+            raise
+        except Exception:
+            endpoint.record_failure()
+            raise
+        endpoint.record_success(time.monotonic() - start)
+        return response.choices[0].message.content
 
     async def generate_response(self, prompt: str, model: str) -> str | None:
-        response = await self.client.chat.completions.create(
-            messages=[{"role": "user", "content": prompt}],
-            model=model,
-            temperature=0.5,
-            timeout=300,  # 5 minutes timeout
+        """
+        生成回复，失败时依次切换到其它接口，全部失败时抛出最后一个错误
+        """
+        async with scheduler.slot(self.provider):
+            endpoints = self._ranked()
+            last_error: BaseException | None = None
+            while endpoints:
+                hedge = endpoints[1] if len(endpoints) > 1 and self.hedge_delay > 0 else None
+                tried: list[Endpoint] = []
+                try:
+                    content = await self._hedged(endpoints[0], hedge, prompt, model, tried)
+                except Exception as e:
+                    logger.warning(f"接口请求失败: {e}")
+                    last_error = e
+                    endpoints = [endpoint for endpoint in endpoints if endpoint not in tried]
+                    continue
+                if content:
+                    return remove_leading_think(content)
+                return None
+            assert last_error is not None
+            raise last_error
+
+    async def _hedged(
+        self, primary: Endpoint, hedge: Endpoint | None, prompt: str, model: str, tried: list[Endpoint]
+    ) -> str | None:
+        """
+        向 primary 发出请求，超过 hedge_delay 秒未返回时同时向 hedge 发出请求，使用先成功返回的结果
+
+        Args:
+            tried: 记录实际发出了请求的接口
+        """
+        tried.append(primary)
+        tasks = [asyncio.create_task(self._request(primary, prompt, model))]
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=self.hedge_delay if hedge else None)
+            if not done and hedge:
+                logger.debug(f"接口 {primary.name} 超过 {self.hedge_delay} 秒未返回，向 {hedge.name} 发出对冲请求")
+                tried.append(hedge)
+                tasks.append(asyncio.create_task(self._request(hedge, prompt, model)))
+            error: BaseException | None = None
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    error = task.exception()
+            assert error is not None
+            raise error
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def generate_response_stream(self, prompt: str, model: str) -> AsyncIterator[str]:
+        """
+        流式生成回复，逐段产出去除开头思考块后的文本
+
+        建立连接失败时切换到其它接口，流式请求不对冲
+        """
+        async with scheduler.slot(self.provider):
+            stream = None
+            endpoint = None
+            start = time.monotonic()
+            last_error: BaseException | None = None
+            for endpoint in self._ranked():
+                if not endpoint.acquire():
+                    last_error = CircuitOpenError(f"接口 {endpoint.name} 正在探测是否恢复")
+                    continue
+                start = time.monotonic()
+                try:
+                    stream = await endpoint.client.chat.completions.create(
+                        messages=[{"role": "user", "content": prompt}],
+                        model=model,
+                        temperature=0.5,
+                        timeout=self.timeout,
+                        stream=True,
+                    )
+                    break
+                except asyncio.CancelledError:
+                    endpoint.release()
+                    raise
+                except Exception as e:
+                    logger.warning(f"接口 {endpoint.name} 请求失败: {e}")
+                    endpoint.record_failure()
+                    last_error = e
+            if stream is None or endpoint is None:
+                assert last_error is not None
+                raise last_error
+            stripper = ThinkStripper()
+            try:
+                async for chunk in stream:
+                    if not chunk.choices:
+                        continue
+                    delta = chunk.choices[0].delta.content
+                    if not delta:
+                        continue
+                    text = stripper.feed(delta)
+                    if text:
+                        yield text
+            except (asyncio.CancelledError, GeneratorExit):
+                endpoint.release()
+                raise
+            except Exception:
+                endpoint.record_failure()
+                raise
+            endpoint.record_success(time.monotonic() - start)
+        text = stripper.flush()
+        if text:
+            yield text
+
+    def report(self) -> str:
+        """
+        各接口的延迟和熔断状态
+        """
+        return "\n".join(
+            f"{endpoint.name}: p50 {endpoint.percentile(0.5):.2f}s, p95 {endpoint.percentile(0.95):.2f}s"
+            + ("" if endpoint.available() else " (熔断中)")
+            for endpoint in self.endpoints
         )
-        content = response.choices[0].message.content
-        if content:
-            return remove_leading_think(content)
-        else:
-            return None
 
 
 def remove_leading_think(text: str) -> str:
     # 匹配开头连续的 <think>...</think> 或 <think/> 块
     pattern = r"^(?:\s*<think>(.*?)</think>\s*|\s*<think\s*/?>\s*)+"
     return re.sub(pattern, "", text, flags=re.DOTALL).lstrip()
+
+
+class ThinkStripper:
+    """
+    remove_leading_think 的流式版本：在文本到达时去除开头连续的 <think>...</think> 或 <think/> 块
+    """
+
+    _SELF_CLOSING = re.compile(r"<think\s*/?>")
+
+    def __init__(self):
+        self._buffer = ""
+        self._leading = True
+
+    def feed(self, text: str) -> str:
+        """
+        输入一段文本，返回可以确定不属于开头思考块的文本
+        """
+        if not self._leading:
+            return text
+        self._buffer += text
+        while True:
+            self._buffer = self._buffer.lstrip()
+            if not self._buffer:
+                return ""
+            if self._buffer.startswith("<think>"):
+                end = self._buffer.find("</think>")
+                if end == -1:
+                    # 思考块还没结束
+                    return ""
+                self._buffer = self._buffer[end + len("</think>") :]
+                continue
+            match = self._SELF_CLOSING.match(self._buffer)
+            if match:
+                self._buffer = self._buffer[match.end() :]
+                continue
+            if "<think".startswith(self._buffer) or (self._buffer.startswith("<think") and ">" not in self._buffer):
+                # 可能是思考标签的开头，等待更多文本
+                return ""
+            self._leading = False
+            text, self._buffer = self._buffer, ""
+            return text
+
+    def flush(self) -> str:
+        """
+        流结束时调用，返回剩余的文本
+        """
+        if not self._leading:
+            return ""
+        # 与 remove_leading_think 一致：未闭合的 <think> 只去除标签本身
+        text = remove_leading_think(self._buffer)
+        self._buffer = ""
+        self._leading = False
+        return text
+
+
+class ReplyStreamParser:
+    """
+    增量解析流式返回的 JSON，在 `reply` 数组中的每个字符串元素完整时立即产出
+    """
+
+    _REPLY_START = re.compile(r'"reply"\s*:\s*\[')
+
+    def __init__(self):
+        self._buffer = ""
+        self._pos = 0
+        self._in_array = False
+        self._done = False
+
+    def feed(self, text: str) -> list[str]:
+        """
+        输入一段文本，返回新解析出的完整 reply 元素
+        """
+        if self._done:
+            return []
+        self._buffer += text
+        replies: list[str] = []
+        if not self._in_array:
+            match = self._REPLY_START.search(self._buffer, self._pos)
+            if not match:
+                # 下次从可能的键名处继续查找
+                key = self._buffer.rfind('"reply"', self._pos)
+                self._pos = key if key != -1 else max(self._pos, len(self._buffer) - len('"reply"'))
+                return replies
+            self._in_array = True
+            self._pos = match.end()
+        while self._pos < len(self._buffer):
+            char = self._buffer[self._pos]
+            if char.isspace() or char == ",":
+                self._pos += 1
+            elif char == "]":
+                self._done = True
+                break
+            elif char == '"':
+                end = self._string_end(self._pos)
+                if end == -1:
+                    break
+                try:
+                    replies.append(json.loads(self._buffer[self._pos : end + 1]))
+                except json.JSONDecodeError:
+                    self._done = True
+                    break
+                self._pos = end + 1
+            else:
+                # 非字符串元素，交给完整解析处理
+                self._done = True
+                break
+        return replies
+
+    def _string_end(self, start: int) -> int:
+        """
+        返回从 start 开始的 JSON 字符串的结束引号位置，字符串不完整时返回 -1
+        """
+        index = start + 1
+        while index < len(self._buffer):
+            char = self._buffer[index]
+            if char == "\\":
+                index += 2
+                continue
+            if char == '"':
+                return index
+            index += 1
+        return -1
@@ -1,3 +1,5 @@
+from typing import Literal
+
 from nonebot import get_driver, get_plugin_config
 from pydantic import BaseModel
 
@@ -9,6 +11,48 @@ class Config(BaseModel):
     nyaturingtest_siliconflow_api_key: str
     nyaturingtest_vlm_enabled: bool = True
     nyaturingtest_enabled_groups: list[int] = []
+    nyaturingtest_fused_stage: bool = False
+    nyaturingtest_speculative_chat: Literal["off", "active", "adaptive"] = "off"
+    nyaturingtest_speculative_chat_min_hit_rate: float = 0.6
+    nyaturingtest_stream_reply: bool = False
+    nyaturingtest_context_token_budget: int = 6000
+    nyaturingtest_nickname_ttl: int = 600
+    nyaturingtest_segment_concurrency: int = 8
+    nyaturingtest_segment_concurrency_per_message: int = 3
+    nyaturingtest_segment_deadline: float = 30.0
+    nyaturingtest_lazy_image: bool = False
+    nyaturingtest_gate_enabled: bool = False
+    nyaturingtest_gate_threshold: float = 0.3
+    nyaturingtest_duplicate_similarity: float = 0.85
+    nyaturingtest_max_batch_size: int = 20
+    nyaturingtest_max_pending_batches: int = 3
+    nyaturingtest_chat_rate_limit: float = 0.0
+    nyaturingtest_chat_concurrency: int = 4
+    nyaturingtest_siliconflow_rate_limit: float = 0.0
+    nyaturingtest_siliconflow_concurrency: int = 8
+    nyaturingtest_chat_openai_fallback_base_urls: list[str] = []
+    nyaturingtest_chat_openai_fallback_api_keys: list[str] = []
+    nyaturingtest_chat_timeout: float = 300
+    nyaturingtest_hedge_delay: float = 0.0
+    nyaturingtest_breaker_failures: int = 3
+    nyaturingtest_breaker_cooldown: float = 60.0
+    nyaturingtest_reply_budget: float = 0.0
+    nyaturingtest_search_budget_share: float = 0.25
+    nyaturingtest_feedback_budget_share: float = 0.5
+    nyaturingtest_supersede_threshold: int = 0
+    nyaturingtest_supersede_limit: int = 2
+    nyaturingtest_prefetch_retrieval: bool = False
+    nyaturingtest_prefetch_delay: float = 2.0
+    nyaturingtest_retrieval_cache_size: int = 64
+    nyaturingtest_retrieval_cache_similarity: float = 0.95
+    nyaturingtest_local_retrieval: bool = False
+    nyaturingtest_local_retrieval_confidence: float = 0.6
+    nyaturingtest_index_concurrency: int = 4
+    nyaturingtest_ingest_commit_interval: float = 1.0
+    nyaturingtest_forget_interval: float = 0.0
+    nyaturingtest_forget_half_life: float = 30.0
+    nyaturingtest_forget_threshold: float = 0.1
+    nyaturingtest_forget_max_passages: int = 0
 
 
 plugin_config: Config = get_plugin_config(Config)
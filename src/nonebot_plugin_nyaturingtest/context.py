@@ -0,0 +1,247 @@
+from collections.abc import Callable
+from dataclasses import dataclass, field
+from functools import cache, lru_cache
+from typing import Literal
+
+from nonebot import logger
+from transformers.models.auto.tokenization_auto import AutoTokenizer
+
+
+@cache
+def get_tokenizer():
+    """
+    获取共享的分词器（BAAI/bge-m3），只加载一次
+    """
+    return AutoTokenizer.from_pretrained("BAAI/bge-m3", trust_remote_code=True)
+
+
+@lru_cache(maxsize=8192)
+def count_tokens(text: str) -> int:
+    """
+    计算文本的 token 数量，相同文本只计算一次
+    """
+    if not text:
+        return 0
+    return len(get_tokenizer().encode(text, add_special_tokens=False))
+
+
+def truncate_tokens(text: str, max_tokens: int, keep: Literal["head", "tail"] = "head") -> str:
+    """
+    按 token 数量截断文本
+
+    Args:
+        text: 要截断的文本
+        max_tokens: 最大 token 数量
+        keep: 保留开头(head)还是结尾(tail)
+    """
+    if max_tokens <= 0:
+        return ""
+    tokens = get_tokenizer().encode(text, add_special_tokens=False)
+    if len(tokens) <= max_tokens:
+        return text
+    kept = tokens[:max_tokens] if keep == "head" else tokens[-max_tokens:]
+    return get_tokenizer().decode(kept)
+
+
+@dataclass
+class ContextSection:
+    """
+    提示词中的一个上下文段落
+    """
+
+    name: str
+    """
+    段落名称，用于报告
+    """
+    items: list[str]
+    """
+    段落内容，按条目裁剪
+    """
+    priority: int
+    """
+    优先级，超出预算时优先裁剪优先级低的段落
+    """
+    reserve: float = 0.0
+    """
+    段落保留的预算比例，只有所有段落都裁剪到保留预算仍然超出时才会继续裁剪
+    """
+    trim_from: Literal["head", "tail"] = "tail"
+    """
+    从开头(head)还是结尾(tail)开始裁剪条目
+    """
+    render: Callable[[list[str]], str] = "\n".join
+    """
+    将条目渲染为文本
+    """
+    droppable: bool = True
+    """
+    是否可以删除条目，不可删除时超出预算只截断各条目的文本，条目数量保持不变
+    """
+    summarize: Callable[[list[str]], str] | None = None
+    """
+    生成被删除条目的摘要，摘要作为一个条目放在被裁剪的一端；为 None 时直接删除
+    """
+    trimmed: int = field(default=0, init=False)
+    """
+    被裁剪的条目数量
+    """
+    truncated: set[int] = field(default_factory=set, init=False)
+    """
+    被截断文本的条目下标
+    """
+    dropped: list[str] = field(default_factory=list, init=False)
+    """
+    被删除的条目
+    """
+    summary: str = field(default="", init=False)
+    """
+    被删除条目的摘要
+    """
+
+    def tokens(self) -> int:
+        return sum(count_tokens(item) for item in self.items) + count_tokens(self.summary)
+
+    def text(self) -> str:
+        if not self.summary:
+            return self.render(self.items)
+        if self.trim_from == "head":
+            return self.render([self.summary, *self.items])
+        return self.render([*self.items, self.summary])
+
+
+_SUMMARY_KEYS = 5
+"""
+摘要中最多列出的关键词数量
+"""
+
+_MIN_ITEM_TOKENS = 16
+"""
+不可删除的条目截断后至少保留的 token 数量
+"""
+
+
+def summarize_omitted(label: str, key: Callable[[str], str]) -> Callable[[list[str]], str]:
+    """
+    生成被删除条目的摘要，如 `(省略了 3 条更早的消息，涉及: 小明、阿狸)`
+
+    Args:
+        label: 条目的名称
+        key: 从条目中取出摘要中列出的关键词
+    """
+
+    def summarize(items: list[str]) -> str:
+        keys = list(dict.fromkeys(key(item) for item in items))
+        shown = "、".join(keys[:_SUMMARY_KEYS]) + ("等" if len(keys) > _SUMMARY_KEYS else "")
+        return f"(省略了 {len(items)} 条{label}，涉及: {shown})"
+
+    return summarize
+
+
+class ContextBuilder:
+    """
+    按 token 预算构建提示词上下文
+    """
+
+    def __init__(self, budget: int):
+        """
+        Args:
+            budget: 所有段落的总 token 预算，小于等于0时不限制
+        """
+        self.budget = budget
+        self.sections: dict[str, ContextSection] = {}
+
+    def add(self, section: ContextSection) -> "ContextBuilder":
+        self.sections[section.name] = section
+        return self
+
+    def build(self) -> dict[str, str]:
+        """
+        裁剪各段落到预算内并渲染，返回段落名到文本的映射
+        """
+        if self.budget > 0:
+            by_priority = sorted(self.sections.values(), key=lambda section: section.priority)
+            # 第一轮：低优先级段落先裁剪到保留预算
+            for section in by_priority:
+                overflow = self.total_tokens() - self.budget
+                if overflow <= 0:
+                    break
+                floor = int(self.budget * section.reserve)
+                self._trim(section, max(floor, section.tokens() - overflow))
+            # 第二轮：仍然超出时无视保留预算
+            for section in by_priority:
+                overflow = self.total_tokens() - self.budget
+                if overflow <= 0:
+                    break
+                self._trim(section, section.tokens() - overflow)
+        self.report()
+        return {name: section.text() for name, section in self.sections.items()}
+
+    def total_tokens(self) -> int:
+        return sum(section.tokens() for section in self.sections.values())
+
+    def usage(self) -> dict[str, int]:
+        """
+        各段落的 token 使用量
+        """
+        return {name: section.tokens() for name, section in self.sections.items()}
+
+    def report(self):
+        usage = ", ".join(
+            f"{name}={section.tokens()}"
+            + (f"(裁剪{section.trimmed}条)" if section.trimmed else "")
+            + (f"(截断{len(section.truncated)}条)" if section.truncated else "")
+            for name, section in self.sections.items()
+        )
+        logger.debug(f"上下文token使用: {usage}，总计 {self.total_tokens()}/{self.budget}")
+
+    @staticmethod
+    def _trim(section: ContextSection, max_tokens: int):
+        """
+        从段落的一端逐条删除条目直到不超过 max_tokens，删除的条目替换为摘要，只剩一条时截断该条目
+
+        不可删除条目的段落只截断条目的文本
+        """
+        if not section.droppable:
+            ContextBuilder._shrink(section, max_tokens)
+            return
+        while section.items and section.tokens() > max_tokens:
+            if len(section.items) == 1:
+                remain = max(max_tokens - count_tokens(section.summary), 0)
+                keep = "tail" if section.trim_from == "head" else "head"
+                truncated = truncate_tokens(section.items[0], remain, keep=keep)
+                if truncated:
+                    section.items[0] = truncated
+                    break
+            section.dropped.append(section.items.pop(0 if section.trim_from == "head" else -1))
+            section.trimmed += 1
+            if section.summarize:
+                section.summary = section.summarize(section.dropped)
+        if section.summary and section.tokens() > max_tokens:
+            # 摘要本身超出预算时截断摘要
+            remain = max_tokens - sum(count_tokens(item) for item in section.items)
+            section.summary = truncate_tokens(section.summary, remain)
+
+    @staticmethod
+    def _shrink(section: ContextSection, max_tokens: int):
+        """
+        截断最长的条目，使段落不超过 max_tokens，每条至少保留 _MIN_ITEM_TOKENS 个 token
+        """
+        counts = [count_tokens(item) for item in section.items]
+        if sum(counts) <= max_tokens:
+            return
+        # 找到每条条目的上限，较短的条目不截断，剩余的预算平分给较长的条目
+        remain = max_tokens
+        cap = 0
+        for i, count in enumerate(sorted(counts)):
+            share = remain // (len(counts) - i)
+            if count > share:
+                cap = share
+                break
+            remain -= count
+        cap = max(cap, _MIN_ITEM_TOKENS)
+        for i, count in enumerate(counts):
+            if count > cap:
+                # 再次截断时先去掉上次加上的省略号
+                text = section.items[i].removesuffix("…") if i in section.truncated else section.items[i]
+                section.items[i] = truncate_tokens(text, cap - 1) + "…"
+                section.truncated.add(i)
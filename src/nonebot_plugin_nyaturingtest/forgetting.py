@@ -0,0 +1,142 @@
+from dataclasses import asdict, dataclass
+import json
+import math
+import os
+import time
+
+from nonebot import logger
+
+_DAY = 86400.0
+
+
+@dataclass
+class PassageUsage:
+    """
+    段落的使用情况
+    """
+
+    indexed_at: float
+    """
+    索引时间(Unix 时间戳)
+    """
+    last_used: float
+    """
+    最近一次被检索到的时间，没有被检索过时等于索引时间
+    """
+    hits: int = 0
+    """
+    被检索到的次数
+    """
+
+
+class Forgetting:
+    """
+    长期记忆的遗忘策略
+
+    段落的价值 = (1 + ln(1 + 检索次数)) * (1 + ln(1 + 重要性)) * 0.5 ^ (闲置天数 / 半衰期)，
+    重要性为信息抽取(OpenIE)从段落中得到的三元组数量，闲置天数从最近一次被检索到(或索引)时算起。
+    价值低于阈值的段落会被遗忘，段落数超过上限时价值最低的段落也会被遗忘
+    """
+
+    def __init__(self, path: str, half_life: float = 30.0, threshold: float = 0.1, max_passages: int = 0):
+        """
+        Args:
+            path: 使用情况的保存路径
+            half_life: 价值的半衰期(天)
+            threshold: 价值低于这个值的段落会被遗忘
+            max_passages: 最多保留的段落数，0 为不限制
+        """
+        self._path = path
+        self.half_life = half_life
+        self.threshold = threshold
+        self.max_passages = max_passages
+        self._usage: dict[str, PassageUsage] = {}
+        self.last_run: float | None = None
+        """
+        上次遗忘的时间(Unix 时间戳)
+        """
+        if os.path.exists(path):
+            try:
+                with open(path, encoding="utf-8") as f:
+                    data = json.load(f)
+                self.last_run = data.get("last_run")
+                self._usage = {key: PassageUsage(**value) for key, value in data["passages"].items()}
+            except (OSError, ValueError, TypeError, KeyError) as e:
+                logger.warning(f"读取长期记忆使用情况失败: {e}")
+
+    def __len__(self) -> int:
+        return len(self._usage)
+
+    def indexed(self, ids: list[str], now: float | None = None):
+        """
+        记录新索引的段落，已经记录过的段落不变
+        """
+        now = time.time() if now is None else now
+        for key in ids:
+            if key not in self._usage:
+                self._usage[key] = PassageUsage(indexed_at=now, last_used=now)
+
+    def retrieved(self, ids: list[str], now: float | None = None):
+        """
+        记录被检索到的段落
+        """
+        now = time.time() if now is None else now
+        for key in ids:
+            usage = self._usage.get(key)
+            if usage is not None:
+                usage.hits += 1
+                usage.last_used = now
+
+    def value(self, key: str, importance: int = 0, now: float | None = None) -> float:
+        """
+        段落的价值，没有记录的段落视为刚刚索引
+        """
+        usage = self._usage.get(key)
+        if usage is None:
+            return 1 + math.log1p(importance)
+        now = time.time() if now is None else now
+        idle = max(now - usage.last_used, 0.0) / _DAY
+        decay = 0.5 ** (idle / self.half_life) if self.half_life > 0 else 1.0
+        return (1 + math.log1p(usage.hits)) * (1 + math.log1p(importance)) * decay
+
+    def select(self, ids: list[str], importance: dict[str, int], now: float | None = None) -> list[str]:
+        """
+        选出要遗忘的段落
+
+        Args:
+            ids: 所有已索引的段落
+            importance: 段落的重要性，没有的视为0
+
+        Returns:
+            要遗忘的段落，按价值从低到高排列
+        """
+        now = time.time() if now is None else now
+        # 以前没有记录的段落从现在开始计算
+        self.indexed(ids, now)
+        values = sorted((self.value(key, importance.get(key, 0), now), key) for key in ids)
+        excess = len(values) - self.max_passages if self.max_passages > 0 else 0
+        return [key for rank, (value, key) in enumerate(values) if value < self.threshold or rank < excess]
+
+    def forget(self, ids: list[str]):
+        """
+        删除段落的记录
+        """
+        for key in ids:
+            self._usage.pop(key, None)
+
+    def clear(self):
+        self._usage.clear()
+        self.last_run = None
+
+    def save(self):
+        os.makedirs(os.path.dirname(self._path) or ".", exist_ok=True)
+        tmp = f"{self._path}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(
+                {
+                    "last_run": self.last_run,
+                    "passages": {key: asdict(usage) for key, usage in self._usage.items()},
+                },
+                f,
+            )
+        os.replace(tmp, self._path)
@@ -0,0 +1,124 @@
+from dataclasses import dataclass
+import re
+
+from .mem import Message
+
+_TAG = re.compile(r"\[[^\]]*\]")
+_NON_WORD = re.compile(r"[\W_]+")
+_QUESTION = re.compile(r"[?？]|[吗呢么嘛][\W_]*$")
+_EMOTION_KEYWORDS = (
+    "哈哈",
+    "笑死",
+    "喜欢",
+    "讨厌",
+    "难过",
+    "伤心",
+    "生气",
+    "开心",
+    "好耶",
+    "谢谢",
+    "救命",
+    "害怕",
+    "呜呜",
+    "可恶",
+    "爱你",
+)
+
+MENTION_WEIGHT = 1.0
+QUESTION_WEIGHT = 0.3
+NOVELTY_WEIGHT = 0.5
+EMOTION_WEIGHT = 0.2
+
+
+@dataclass
+class GateScore:
+    """
+    本地对一批消息的信号强度打分，不请求任何远程服务
+    """
+
+    mention: float = 0.0
+    """
+    提到机器人名字
+    """
+    question: float = 0.0
+    """
+    包含提问
+    """
+    novelty: float = 0.0
+    """
+    与最近聊天记录相比的新内容占比
+    """
+    emotion: float = 0.0
+    """
+    包含情感关键词
+    """
+
+    def total(self) -> float:
+        return self.mention + self.question + self.novelty + self.emotion
+
+    def __str__(self) -> str:
+        return (
+            f"{self.total():.2f}(提及={self.mention:.2f}, 提问={self.question:.2f}, "
+            f"新内容={self.novelty:.2f}, 情感={self.emotion:.2f})"
+        )
+
+
+@dataclass
+class GateStats:
+    """
+    本地门控统计
+    """
+
+    passed: int = 0
+    """
+    通过门控的批次数
+    """
+    skipped: int = 0
+    """
+    被跳过的批次数，每个批次至少节省一次反馈阶段llm调用
+    """
+
+    def skip_rate(self) -> float:
+        total = self.passed + self.skipped
+        return self.skipped / total if total else 0.0
+
+
+def _normalize(text: str) -> str:
+    """
+    去除图片等标签，标点和表情，只保留文字
+    """
+    return _NON_WORD.sub("", _TAG.sub("", text)).lower()
+
+
+def score_batch(messages: list[Message], bot_name: str, recent: list[Message]) -> GateScore:
+    """
+    对一批消息打分
+
+    Args:
+        messages: 新输入消息
+        bot_name: 机器人名字
+        recent: 最近的聊天记录，用于判断新内容
+    """
+    score = GateScore()
+    if not messages:
+        return score
+    if any(bot_name in msg.content for msg in messages):
+        score.mention = MENTION_WEIGHT
+    # 图片描述等标签不算作提问和情感表达
+    texts = [_TAG.sub("", msg.content) for msg in messages]
+    if any(_QUESTION.search(text) for text in texts):
+        score.question = QUESTION_WEIGHT
+    if any(keyword in text for text in texts for keyword in _EMOTION_KEYWORDS):
+        score.emotion = EMOTION_WEIGHT
+
+    seen = {_normalize(msg.content) for msg in recent}
+    novel = 0
+    for msg in messages:
+        text = _normalize(msg.content)
+        # 太短的内容(如"+1"，纯表情)不算新内容
+        if len(text) < 2 or text in seen:
+            continue
+        seen.add(text)
+        novel += 1
+    score.novelty = NOVELTY_WEIGHT * novel / len(messages)
+    return score
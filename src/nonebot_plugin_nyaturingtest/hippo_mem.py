@@ -1,14 +1,116 @@
-from collections.abc import Awaitable, Callable
+import asyncio
+from collections import OrderedDict, deque
+from collections.abc import Callable
+from dataclasses import dataclass
 from datetime import datetime
+import hashlib
 import os
 import shutil
+import threading
+import time
+from typing import TypeVar
 
 from hipporag import HippoRAG
+from hipporag.utils.misc_utils import compute_mdhash_id
 from nonebot import logger
 import numpy as np
-from transformers.models.auto.tokenization_auto import AutoTokenizer
 
+from .ann import VectorIndex
+from .chunker import TextChunker
+from .context import get_tokenizer
+from .forgetting import Forgetting
+from .scheduler import Priority, scheduler
 from .siliconflow_embeddings import SiliconFlowEmbeddings
+from .wal import IngestLog
+
+_T = TypeVar("_T")
+
+
+@dataclass
+class _CacheEntry:
+    k: int
+    version: int
+    """
+    检索时的索引版本
+    """
+    query_centroid: np.ndarray
+    docs: list[str]
+    docs_centroid: np.ndarray | None
+
+
+_CACHE_MAX_PENDING = 256
+"""
+检索缓存命中时最多推迟索引的缓存文本数量，超过时先索引再检索
+"""
+
+
+class _RetrievalCache:
+    """
+    有界的检索结果缓存，按归一化后的查询集合的哈希精确查找，或按查询平均向量的相似度近似查找
+    """
+
+    def __init__(self, size: int, similarity: float):
+        """
+        Args:
+            size: 最多缓存的检索结果数，小于等于0时不缓存
+            similarity: 近似查找时查询平均向量的余弦相似度阈值，大于1时只精确查找
+        """
+        self._size = size
+        self._similarity = similarity
+        self._entries: OrderedDict[str, _CacheEntry] = OrderedDict()
+        self.exact_hits = 0
+        self.near_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(queries: list[str], k: int) -> str:
+        """
+        查询集合的缓存键，忽略空白差异和顺序
+        """
+        normalized = sorted({" ".join(query.split()) for query in queries if query.strip()})
+        return hashlib.sha1("\x00".join([str(k), *normalized]).encode()).hexdigest()
+
+    def get(self, key: str, k: int, query_centroid: np.ndarray, version: int) -> _CacheEntry | None:
+        entry = self._entries.get(key)
+        if entry and entry.version == version:
+            self._entries.move_to_end(key)
+            self.exact_hits += 1
+            return entry
+        best_key, best_similarity = None, self._similarity
+        for candidate_key, candidate in self._entries.items():
+            if candidate.version != version or candidate.k != k:
+                continue
+            similarity = _cosine(query_centroid, candidate.query_centroid)
+            if similarity >= best_similarity:
+                best_key, best_similarity = candidate_key, similarity
+        if best_key is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(best_key)
+        self.near_hits += 1
+        return self._entries[best_key]
+
+    def put(self, key: str, entry: _CacheEntry):
+        if self._size <= 0:
+            return
+        # 索引更新后旧版本的结果不会再命中
+        for stale in [key for key, cached in self._entries.items() if cached.version != entry.version]:
+            del self._entries[stale]
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self._size:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+
+    def report(self) -> str:
+        total = self.exact_hits + self.near_hits + self.misses
+        hit_rate = (self.exact_hits + self.near_hits) / total if total else 0.0
+        return (
+            f"检索缓存: {len(self._entries)} 条, 精确命中 {self.exact_hits} 次, 近似命中 {self.near_hits} 次, "
+            f"未命中 {self.misses} 次, 命中率 {hit_rate:.0%}"
+        )
 
 
 class HippoMemory:
@@ -20,6 +122,16 @@ class HippoMemory:
         embedding_api_key: str,
         persist_directory: str = "./hippo_index",
         collection_name: str = "hippo_collection",
+        cache_size: int = 64,
+        cache_similarity: float = 0.95,
+        local_retrieval: bool = False,
+        local_confidence: float = 0.6,
+        index_concurrency: int = 4,
+        ingest_commit_interval: float = 1.0,
+        forget_interval: float = 0.0,
+        forget_half_life: float = 30.0,
+        forget_threshold: float = 0.1,
+        forget_max_passages: int = 0,
     ):
         # 确保存储目录存在
         os.makedirs(persist_directory, exist_ok=True)
@@ -43,19 +155,73 @@ class HippoMemory:
         except Exception as e:
             logger.error(f"Failed to create HippoRAG collection: {e}")
 
+        # 段落的索引时间和检索次数，用于遗忘价值低的段落
+        self._forgetting = Forgetting(
+            os.path.join(persist_directory, "usage.json"),
+            half_life=forget_half_life,
+            threshold=forget_threshold,
+            max_passages=forget_max_passages,
+        )
+        # 遗忘的间隔(秒)，小于等于0时不遗忘
+        self._forget_interval = forget_interval
+        self._forget_task: asyncio.Task[None] | None = None
+        self.forgotten = 0
         # 用于跟踪上次清理的时间
-        self._last_forget = datetime.now()
-        # 缓存要索引的文本
-        self._cache = ""
+        self._last_forget = (
+            datetime.fromtimestamp(self._forgetting.last_run) if self._forgetting.last_run else datetime.now()
+        )
+        # 最近的检索耗时(秒)，不包括索引
+        self._retrieve_latency: deque[float] = deque(maxlen=256)
+        # 缓存要索引的文本，先写入预写日志，索引完成后才确认，重启后重新加载没有索引的文本
+        # 日志放在索引目录之外，清除记忆时删除索引目录不会影响它
+        self._ingest_log = IngestLog(f"{persist_directory}_ingest.jsonl", commit_interval=ingest_commit_interval)
+        replayed = self._ingest_log.replay()
+        self._pending: list[str] = [text for _, text in replayed]
+        # 缓存中最后一条文本在日志中的序号
+        self._pending_seq = replayed[-1][0] if replayed else 0
         # 初始化分词器
-        self._tokenizer = AutoTokenizer.from_pretrained("BAAI/bge-m3", trust_remote_code=True)
+        self._tokenizer = get_tokenizer()
+        # 索引的文本按512 tokens分段，查询按嵌入模型的上限(BAAI/bge-m3上限为8192tokens)分段
+        self._passage_chunker = TextChunker(self._tokenizer, max_tokens=512, overlap=100, cache_size=0)
+        self._query_chunker = TextChunker(self._tokenizer, max_tokens=8192, overlap=100)
+        # 分词器中追加的文本始终与缓存的文本一致
+        self._passage_chunker.append(_join_texts(self._pending))
         # 初始化嵌入模型，用于计算是否需要重新检索
         self._embedding_model = SiliconFlowEmbeddings(
             model="BAAI/bge-m3",
             api_key=embedding_api_key,
         )
         self._docs = []
+        self._docs_centroid: np.ndarray | None = None
         self._cosine_similarity = 0.0
+        # 每次调用 hippo.index 都会增加，用于让检索缓存失效
+        self._index_version = 0
+        self._retrieval_cache = _RetrievalCache(size=cache_size, similarity=cache_similarity)
+        # 已完成的索引的累计耗时(秒)
+        self._index_seconds = 0.0
+        # 正在进行的索引的开始时间
+        self._index_started: float | None = None
+        # 正在进行的索引，检索被取消时索引仍然继续
+        self._index_task: asyncio.Task[None] | None = None
+        # 同时进行信息抽取(OpenIE)的批次数
+        self._index_concurrency = max(index_concurrency, 1)
+        # 检索和预取不能同时进行
+        self._lock = asyncio.Lock()
+        # HippoRAG 不是线程安全的。检索被取消后线程仍会继续运行，所以在线程中的调用也要互斥
+        self._hippo_lock = threading.Lock()
+        # 上次的检索结果是预取的，还没有被使用过
+        self._prefetched = False
+        self.prefetch_hits = 0
+        self.prefetch_misses = 0
+        # 本地向量索引作为第一层检索，置信度不足时才使用HippoRAG的图检索
+        self._local_retrieval = local_retrieval
+        self._local_confidence = local_confidence
+        self._vector_index: VectorIndex | None = None
+        self._vector_index_version = -1
+        # 本地向量索引中的段落
+        self._vector_index_ids: set[str] = set()
+        self.local_hits = 0
+        self.local_fallbacks = 0
 
     def _now_str(self) -> str:
         """返回当前时间的 ISO 格式字符串"""
@@ -75,7 +241,16 @@ class HippoMemory:
             logger.warning(f"Persist directory {self.persist_directory} does not exist.")
         # 删除内存缓存
         self._docs.clear()
+        self._docs_centroid = None
         self._cosine_similarity = 0.0
+        self._prefetched = False
+        self._index_version += 1
+        self._retrieval_cache.clear()
+        self._pending.clear()
+        self._passage_chunker.reset()
+        self._ingest_log.reset()
+        self._forgetting.clear()
+        self._last_forget = datetime.now()
         # 重新创建索引
         try:
             self.hippo = HippoRAG(
@@ -99,7 +274,7 @@ class HippoMemory:
         Args:
             text: 要添加的文本
         """
-        self._cache += text + "\n"
+        self.add_texts([text])
 
     def add_texts(self, texts: list[str]):
         """
@@ -108,77 +283,440 @@ class HippoMemory:
         Args:
             texts: 要添加的文本列表
         """
-        for text in texts:
-            self.add_text(text)
+        if not texts:
+            return
+        self._pending_seq = self._ingest_log.append(texts)
+        self._pending.extend(texts)
+        # 在检索之外提前对新增的文本分词，只对新增的文本分词，索引时不需要再对整个缓存分词
+        self._passage_chunker.append(_join_texts(texts))
+
+    @property
+    def index_seconds(self) -> float:
+        """
+        累计索引耗时(秒)，包括正在进行的索引
+        """
+        if self._index_started is None:
+            return self._index_seconds
+        return self._index_seconds + time.monotonic() - self._index_started
 
-    def _index(self):
+    async def _index(self):
         """
         对缓存的文本进行索引，整理到长期记忆
+
+        正在进行的索引不会因为检索被取消而中断，下次检索会先等它完成
         """
-        if self._cache:
-            texts = _split_text_by_tokens(self._cache, self._tokenizer, max_tokens=512, overlap=100)
-            texts_list = _split_texts_by_byte_limit(texts, max_bytes=30_000)
-            for texts in texts_list:
-                total_bytes = sum(len(" ".join(batch).encode()) for batch in texts_list)
-                logger.debug(f"索引文本总大小: {total_bytes / 1024:.2f} KB")
-                self.hippo.index(texts)
-            logger.info(f"已索引 {len(texts)} 条缓存文本")
-            self._cache = ""
-        else:
+        if self._index_task is not None and not self._index_task.done():
+            await asyncio.shield(self._index_task)
+        if not self._pending:
             logger.info("没有缓存的文本需要索引")
+            return
+        texts, self._pending = self._pending, []
+        # 在取出缓存的同时切分，分词器里追加的就是这段文本；
+        # 如果等到索引任务开始时再切分，期间新增的文本也会被追加进来
+        passages = self._passage_chunker.take()
+        self._index_task = asyncio.create_task(self._index_texts(texts, passages, self._pending_seq))
+        await asyncio.shield(self._index_task)
+
+    async def _index_texts(self, texts: list[str], passages: list[str], seq: int):
+        """
+        索引流水线：各段落的信息抽取(OpenIE)互不相关，并发进行；全部完成后一次性更新向量和图
+
+        Args:
+            texts: 要索引的文本
+            passages: 文本切分后的段落
+            seq: 最后一条文本在预写日志中的序号，索引完成后确认
+        """
+        self._index_started = time.monotonic()
+        try:
+            total_bytes = sum(len(passage.encode()) for passage in passages)
+            logger.debug(f"索引文本总大小: {total_bytes / 1024:.2f} KB，共 {len(passages)} 段")
+
+            config = self.hippo.global_config
+            if config.save_openie and config.openie_mode == "online":
+                await self._extract(passages)
+            # 信息抽取的结果已经保存，hippo.index 只需要计算向量和更新图
+            # 在线程中运行，不阻塞事件循环；索引期间检索和遗忘都会先等待索引完成
+            async with scheduler.slot("siliconflow", priority=Priority.INDEXING):
+                await self._call_hippo(self.hippo.index, passages)
+            self._index_version += 1
+            self._ingest_log.ack(seq)
+            self._forgetting.indexed([compute_mdhash_id(passage, prefix="chunk-") for passage in passages])
+            self._forgetting.save()
+            self._schedule_forget()
+
+            elapsed = time.monotonic() - self._index_started
+            logger.info(
+                f"已索引 {len(passages)} 段缓存文本，耗时 {elapsed:.1f}s，"
+                f"{len(passages) / elapsed if elapsed > 0 else 0.0:.1f} 段/秒"
+            )
+        except BaseException:
+            # 索引失败的文本放回缓存，下次重试
+            self._pending[:0] = texts
+            self._passage_chunker.reset()
+            self._passage_chunker.append(_join_texts(self._pending))
+            raise
+        finally:
+            self._index_seconds += time.monotonic() - self._index_started
+            self._index_started = None
+
+    async def _extract(self, passages: list[str]):
+        """
+        对还没有抽取过的段落进行信息抽取(OpenIE)，在内存中合并后一次性保存
+
+        部分段落失败时仍然保存成功的结果，再抛出第一个错误
+        """
+        rows = {compute_mdhash_id(passage, prefix="chunk-"): {"content": passage} for passage in passages}
+        all_openie_info, missing = await self._call_hippo(self.hippo.load_existing_openie, list(rows))
+        rows = {key: rows[key] for key in rows if key in missing}
+        if not rows:
+            return
+        semaphore = asyncio.Semaphore(self._index_concurrency)
+        results = await asyncio.gather(
+            *(self._extract_passage(key, row["content"], semaphore) for key, row in rows.items()),
+            return_exceptions=True,
+        )
+        errors = [result for result in results if isinstance(result, BaseException)]
+        done = {key: result for key, result in zip(rows, results) if not isinstance(result, BaseException)}
+        if done:
+            self.hippo.merge_openie_results(
+                all_openie_info,
+                {key: rows[key] for key in done},
+                {key: ner for key, (ner, _) in done.items()},
+                {key: triples for key, (_, triples) in done.items()},
+            )
+            await self._call_hippo(self.hippo.save_openie_results, all_openie_info)
+        logger.debug(f"信息抽取完成 {len(done)}/{len(rows)} 段")
+        if errors:
+            raise errors[0]
 
-    async def retrieve(self, queries: list[str], k: int = 5) -> list[str]:
+    async def _extract_passage(self, key: str, passage: str, semaphore: asyncio.Semaphore):
+        """
+        对一个段落进行命名实体识别和三元组抽取，每次 llm 请求都经过调度器
+        """
+        openie = self.hippo.openie
+        async with semaphore:
+            async with scheduler.slot("chat", priority=Priority.INDEXING):
+                ner = await asyncio.to_thread(openie.ner, key, passage)
+            async with scheduler.slot("chat", priority=Priority.INDEXING):
+                triples = await asyncio.to_thread(openie.triple_extraction, key, passage, ner.unique_entities)
+        return ner, triples
+
+    async def retrieve(self, queries: list[str], k: int = 5, reuse_previous: bool = False) -> list[str]:
         """
         检索与查询相关的文本
 
         Args:
             query: 查询文本
             k: 返回的最大结果数
+            reuse_previous: 有上次的检索结果时直接返回，不计算是否需要重新检索
 
         Returns:
             包含检索结果的Document列表
         """
-        # 检查是否需要重新检索
-        if not await self._need_retrieve(queries):
-            logger.info("不需要重新检索")
-            return self._docs
+        async with self._lock:
+            prefetched, self._prefetched = self._prefetched, False
+            if reuse_previous and self._docs:
+                logger.info("复用上次的检索结果")
+                if prefetched:
+                    self.prefetch_hits += 1
+                return self._docs
+
+            # 检查是否需要重新检索
+            query_vectors = await self._embed(queries)
+            if not self._need_retrieve(query_vectors.mean(axis=0)):
+                if prefetched:
+                    self.prefetch_hits += 1
+                    logger.info(f"使用预取的检索结果，预取命中率 {self.prefetch_hit_rate():.0%}")
+                else:
+                    logger.info("不需要重新检索")
+                return self._docs
+
+            if prefetched:
+                self.prefetch_misses += 1
+                logger.info(f"查询变化较大，预取的检索结果作废，预取命中率 {self.prefetch_hit_rate():.0%}")
+            return await self._retrieve(queries, k, query_vectors)
+
+    async def prefetch(self, queries: list[str], k: int = 5):
+        """
+        在消息还在积累时预先检索，结果作为上次的检索结果保存，之后的检索在查询没有明显变化时直接使用
+
+        Args:
+            queries: 查询文本
+            k: 返回的最大结果数，应当与之后的检索一致
+        """
+        if not queries:
+            return
+        async with self._lock:
+            query_vectors = await self._embed(queries)
+            if not self._need_retrieve(query_vectors.mean(axis=0)):
+                # 上次的检索结果仍然适用，没有预取
+                return
+            # 只有真正保存了检索结果，之后的检索才算使用了预取的结果
+            self._prefetched = bool(await self._retrieve(queries, k, query_vectors))
+
+    def prefetch_hit_rate(self) -> float:
+        total = self.prefetch_hits + self.prefetch_misses
+        return self.prefetch_hits / total if total else 0.0
+
+    def cache_report(self) -> str:
+        report = self._retrieval_cache.report()
+        if self._local_retrieval:
+            report += f"\n本地向量检索: 命中 {self.local_hits} 次, 置信度不足转HippoRAG {self.local_fallbacks} 次"
+        return report
+
+    def memory_report(self) -> str:
+        latency = sorted(self._retrieve_latency)
+        report = (
+            f"长期记忆: {len(self._forgetting)} 段，已遗忘 {self.forgotten} 段，"
+            f"上次遗忘 {self._last_forget:%m-%d %H:%M}"
+        )
+        if latency:
+            report += (
+                f"\n最近 {len(latency)} 次检索: 平均 {sum(latency) / len(latency) * 1000:.0f}ms，"
+                f"p95 {latency[int(len(latency) * 0.95)] * 1000:.0f}ms"
+            )
+        return report
+
+    def _schedule_forget(self):
+        """
+        距离上次遗忘超过间隔时在后台遗忘
+        """
+        if self._forget_interval <= 0 or (self._forget_task is not None and not self._forget_task.done()):
+            return
+        if (datetime.now() - self._last_forget).total_seconds() < self._forget_interval:
+            return
+        self._forget_task = asyncio.create_task(self._forget())
+
+    async def _forget(self):
+        """
+        遗忘价值低的段落
+
+        hippo.delete 会删除段落、只属于这些段落的实体和事实以及它们在图中的节点，并重写向量库、图和信息抽取结果，
+        删除的数据不会残留在磁盘上
+        """
+        async with self._lock:
+            if self._index_task is not None and not self._index_task.done():
+                await asyncio.shield(self._index_task)
+            self._last_forget = datetime.now()
+            start = time.monotonic()
+            try:
+                store = self.hippo.chunk_embedding_store
+                ids = store.get_all_ids()
+                forgotten = self._forgetting.select(ids, await self._call_hippo(self._importance))
+                if forgotten:
+                    texts = [store.get_row(hash_id)["content"] for hash_id in forgotten]
+                    size = await asyncio.to_thread(_directory_size, self.persist_directory)
+                    # 持有锁期间没有其它操作访问 HippoRAG
+                    await self._call_hippo(self.hippo.delete, texts)
+                    self._index_version += 1
+                    if not set(texts).isdisjoint(self._docs):
+                        self._docs = []
+                        self._docs_centroid = None
+                        self._cosine_similarity = 0.0
+                        self._prefetched = False
+                    self._forgetting.forget(forgotten)
+                    self.forgotten += len(forgotten)
+                    compacted = await asyncio.to_thread(_directory_size, self.persist_directory)
+                    logger.info(
+                        f"遗忘了 {len(forgotten)}/{len(ids)} 段长期记忆，索引大小 {size / 1024:.0f}KB -> "
+                        f"{compacted / 1024:.0f}KB，耗时 {time.monotonic() - start:.1f}s"
+                    )
+                else:
+                    logger.info(f"{len(ids)} 段长期记忆都不需要遗忘")
+                self._forgetting.last_run = time.time()
+                self._forgetting.save()
+            except Exception as e:
+                logger.error(f"遗忘长期记忆失败: {e}")
+
+    def _importance(self) -> dict[str, int]:
+        """
+        段落的重要性：信息抽取(OpenIE)得到的三元组数量
+        """
+        if not self.hippo.global_config.save_openie:
+            return {}
+        all_openie_info, _ = self.hippo.load_existing_openie([])
+        return {doc["idx"]: len(doc["extracted_triples"]) for doc in all_openie_info}
+
+    async def _retrieve(self, queries: list[str], k: int, query_vectors: np.ndarray) -> list[str]:
+        """
+        重新索引缓存的文本并检索，相同或相近的查询在已经索引的内容没有变化时直接使用缓存的结果
+
+        Args:
+            query_vectors: 每条查询文本的向量
+        """
+        query_centroid = query_vectors.mean(axis=0)
+        start = time.monotonic()
+        key = _RetrievalCache.key(queries, k)
+        # 先按已经索引的版本查找缓存，命中时缓存的文本留到下次未命中时再索引；
+        # 否则每次聊天新增的文本都会在查找之前让缓存失效。缓存的文本过多时先索引
+        if len(self._pending) <= _CACHE_MAX_PENDING:
+            entry = self._retrieval_cache.get(key, k, query_centroid, self._index_version)
+            if entry is not None:
+                logger.info(f"使用缓存的检索结果，{self._retrieval_cache.report()}")
+                self._retrieve_latency.append(time.monotonic() - start)
+                self._set_docs(entry.docs, entry.docs_centroid, query_centroid)
+                return self._docs
 
         # 重新索引
-        self._index()
+        await self._index()
+        start = time.monotonic()
+
+        local = self._local_retrieve(query_vectors, k) if self._local_retrieval else None
+        if local is not None:
+            docs, docs_centroid = local
+            self._retrieval_cache.put(
+                key,
+                _CacheEntry(
+                    k=k,
+                    version=self._index_version,
+                    query_centroid=query_centroid,
+                    docs=docs,
+                    docs_centroid=docs_centroid,
+                ),
+            )
+            self._retrieve_latency.append(time.monotonic() - start)
+            self._set_docs(docs, docs_centroid, query_centroid)
+            return self._docs
 
         # 切割(BAAI/bge-m3上限为8192tokens)
         logger.debug(f"查询文本: {queries}")
-        splited_queries = []
-        for query in queries:
-            splited_queries += _split_text_by_tokens(query, self._tokenizer, max_tokens=8192, overlap=100)
+        splited_queries = [chunk for chunks in self._query_chunker.split_many(queries) for chunk in chunks]
         logger.debug(f"分割后的查询: {splited_queries}")
         query_batches = _split_texts_by_byte_limit(splited_queries, max_bytes=30_000)
 
         all_docs: set[str] = set()
         for batch in query_batches:
-            results = self.hippo.retrieve(queries=batch, num_to_retrieve=k)
+            results = await self._call_hippo(self.hippo.retrieve, queries=batch, num_to_retrieve=k)
             # make ruff happy
             assert isinstance(results, list)
             docs = [doc for result in results for doc in result.docs]
             all_docs.update(docs)
 
-        self._docs = list(all_docs)
-        self._cosine_similarity = await _cosine_similarity(queries, self._docs, self._embedding_model.embed_documents)
-
         # 去重
+        docs = list(all_docs)
+        docs_centroid = await self._centroid(docs) if docs else None
+        self._retrieval_cache.put(
+            key,
+            _CacheEntry(
+                k=k,
+                version=self._index_version,
+                query_centroid=query_centroid,
+                docs=docs,
+                docs_centroid=docs_centroid,
+            ),
+        )
+        self._retrieve_latency.append(time.monotonic() - start)
+        self._set_docs(docs, docs_centroid, query_centroid)
         return self._docs
 
-    async def _need_retrieve(self, new_queries: list[str], scale: float = 0.8) -> bool:
+    async def _call_hippo(self, func: Callable[..., _T], *args, **kwargs) -> _T:
+        """
+        在线程中调用 HippoRAG 的索引、检索、删除或信息抽取结果的读写，不阻塞事件循环，同一时间只有一个调用
+
+        被取消的调用仍然会在线程中执行完，之后的调用等待它结束
+        """
+
+        def call() -> _T:
+            with self._hippo_lock:
+                return func(*args, **kwargs)
+
+        return await asyncio.to_thread(call)
+
+    def _set_docs(self, docs: list[str], docs_centroid: np.ndarray | None, query_centroid: np.ndarray):
+        """
+        保存为上次的检索结果
+        """
+        self._docs = docs
+        self._docs_centroid = docs_centroid
+        self._forgetting.retrieved([compute_mdhash_id(doc, prefix="chunk-") for doc in docs])
+        self._cosine_similarity = _cosine(query_centroid, docs_centroid) if docs_centroid is not None else 0.0
+
+    def _local_retrieve(self, query_vectors: np.ndarray, k: int) -> tuple[list[str], np.ndarray] | None:
+        """
+        在本地向量索引中检索已索引的段落，置信度(各查询最相似段落的平均余弦相似度)不足时返回None
+
+        Returns:
+            (检索结果, 检索结果的平均向量)
+        """
+        index = self._local_index()
+        if index is None:
+            return None
+        start = time.monotonic()
+        results = index.search(query_vectors, k)
+        best = [hits[0][1] for hits in results if hits]
+        if not best:
+            return None
+        confidence = float(np.mean(best))
+        elapsed = time.monotonic() - start
+        if confidence < self._local_confidence:
+            self.local_fallbacks += 1
+            logger.debug(f"本地向量检索置信度 {confidence:.3f} 不足，使用HippoRAG检索")
+            return None
+        self.local_hits += 1
+        ids = list(dict.fromkeys(i for hits in results for i, _ in hits))
+        logger.info(
+            f"本地向量检索{'(IVF)' if index.is_approximate() else ''} {len(index)} 个段落，"
+            f"置信度 {confidence:.3f}，耗时 {elapsed * 1000:.1f}ms"
+        )
+        return [index.texts[i] for i in ids], index.vectors(ids).mean(axis=0)
+
+    def _local_index(self) -> VectorIndex | None:
+        """
+        从HippoRAG已经计算好的段落向量构建本地向量索引
+
+        索引版本变化时只追加新索引的段落，有段落被遗忘时重建
+        """
+        if self._vector_index_version != self._index_version:
+            store = self.hippo.chunk_embedding_store
+            ids = store.get_all_ids()
+            new_ids = [hash_id for hash_id in ids if hash_id not in self._vector_index_ids]
+            if self._vector_index is not None and len(ids) - len(new_ids) == len(self._vector_index_ids):
+                # 只有新索引的段落，追加到已有的索引
+                if new_ids:
+                    self._vector_index.add(
+                        texts=[store.get_row(hash_id)["content"] for hash_id in new_ids],
+                        embeddings=np.asarray(store.get_embeddings(new_ids)),
+                    )
+            else:
+                # 第一次构建或者有段落被遗忘，从头构建
+                new_ids = ids
+                self._vector_index = (
+                    VectorIndex(
+                        texts=[store.get_row(hash_id)["content"] for hash_id in ids],
+                        embeddings=np.asarray(store.get_embeddings(ids)),
+                        previous=self._vector_index,
+                    )
+                    if ids
+                    else None
+                )
+                self._vector_index_ids = set()
+            self._vector_index_ids.update(new_ids)
+            self._vector_index_version = self._index_version
+        return self._vector_index
+
+    async def _embed(self, texts: list[str]) -> np.ndarray:
+        """
+        文本的向量，每行一条
+        """
+        return np.array(await self._embedding_model.embed_documents(texts))
+
+    async def _centroid(self, texts: list[str]) -> np.ndarray:
+        """
+        文本的平均向量
+        """
+        return (await self._embed(texts)).mean(axis=0)
+
+    def _need_retrieve(self, query_centroid: np.ndarray, scale: float = 0.8) -> bool:
         """
         Arguments:
-            new_queries: 新的查询文本
+            query_centroid: 新的查询文本的平均向量
             scale: 触发重新检索的余弦相似度比例的阈值，如0.8代表相似度不如原来的80%则重新检索
         判断是否需要重新检索
         """
 
-        if not self._docs or self._cosine_similarity == 0.0:
+        if not self._docs or self._docs_centroid is None or self._cosine_similarity == 0.0:
             return True
-        current_similarity = await _cosine_similarity(new_queries, self._docs, self._embedding_model.embed_documents)
+        current_similarity = _cosine(query_centroid, self._docs_centroid)
 
         logger.debug(f"当前余弦相似度: {current_similarity}")
         logger.debug(f"原余弦相似度: {self._cosine_similarity}")
@@ -187,26 +725,6 @@ class HippoMemory:
         return current_similarity < scale * self._cosine_similarity
 
 
-async def _cosine_similarity(
-    a: list[str], b: list[str], embed: Callable[[list[str]], Awaitable[list[list[float]]]]
-) -> float:
-    """
-    计算两个字符串列表之间的整体余弦相似度
-    Args:
-        a: 第一个字符串列表
-        b: 第二个字符串列表
-    Returns:
-        余弦相似度值
-    """
-    # 向量化
-    a_vecs = np.array(await embed(a))
-    b_vecs = np.array(await embed(b))
-    # 计算平均向量
-    a_mean = np.mean(a_vecs, axis=0)
-    b_mean = np.mean(b_vecs, axis=0)
-    return _cosine(a_mean, b_mean)
-
-
 def _cosine(a, b) -> float:
     norm_a = np.linalg.norm(a)
     norm_b = np.linalg.norm(b)
@@ -215,27 +733,15 @@ def _cosine(a, b) -> float:
     return np.dot(a, b) / (norm_a * norm_b)
 
 
-def _split_text_by_tokens(text: str, tokenizer, max_tokens=8192, overlap=100) -> list[str]:
+def _directory_size(path: str) -> int:
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names)
+
+
+def _join_texts(texts: list[str]) -> str:
     """
-    按照指定的最大 token 数量和重叠数量将文本分割成多个块
-    Args:
-        text: 要分割的文本
-        tokenizer: 用于分割文本的分词器
-        max_tokens: 每个块的最大 token 数量
-        overlap: 重叠的 token 数量
-    Returns:
-        分割后的文本块列表
+    缓存的文本拼接成一段，每条文本一行
     """
-    tokens = tokenizer.encode(text, add_special_tokens=False, truncation=True)
-    chunks = []
-    start = 0
-    while start < len(tokens):
-        end = min(start + max_tokens, len(tokens))
-        chunk_tokens = tokens[start:end]
-        chunk_text = tokenizer.decode(chunk_tokens)
-        chunks.append(chunk_text)
-        start += max_tokens - overlap
-    return chunks
+    return "".join(f"{text}\n" for text in texts)
 
 
 def _split_texts_by_byte_limit(texts: list[str], max_bytes: int = 30_000) -> list[list[str]]:
@@ -1,9 +1,13 @@
+import asyncio
 import base64
+from collections import OrderedDict
+from collections.abc import Iterable
 from dataclasses import asdict, dataclass
 import hashlib
 import io
 import json
 from pathlib import Path
+import re
 
 import anyio
 from nonebot import logger
@@ -12,10 +16,16 @@ import numpy as np
 from PIL import Image
 
 from .config import plugin_config
+from .scheduler import Priority, scheduling
 from .vlm import SiliconFlowVLM
 
 IMAGE_CACHE_DIR = Path(f"{store.get_plugin_cache_dir()}/image_cache")
 
+DEFERRED_IMAGE = re.compile(r"\[(?:图片|表情包)\(未查看\):([0-9a-f]{32})\]")
+"""
+延迟解析的图片占位文本
+"""
+
 
 @dataclass
 class ImageWithDescription:
@@ -58,6 +68,72 @@ class ImageWithDescription:
         return image_with_desc
 
 
+@dataclass
+class LazyImageStats:
+    """
+    延迟解析图片的统计
+
+    回复质量以含图片的批次的回复率近似：比较带着未查看图片回复的批次和看过图片回复的批次
+    """
+
+    deferred: int = 0
+    """
+    延迟解析的图片数
+    """
+    resolved: int = 0
+    """
+    之后解析成功的图片数
+    """
+    failed: int = 0
+    """
+    解析失败的次数，失败的图片保留占位文本，之后可以再次解析
+    """
+    unseen_batches: int = 0
+    """
+    带着未查看图片处理的批次数
+    """
+    unseen_replied: int = 0
+    """
+    带着未查看图片处理并且有回复的批次数
+    """
+    seen_batches: int = 0
+    """
+    图片都已查看的含图片批次数
+    """
+    seen_replied: int = 0
+    """
+    图片都已查看并且有回复的含图片批次数
+    """
+
+    def avoided(self) -> int:
+        """
+        避免的VLM解析次数
+        """
+        return self.deferred - self.resolved
+
+    def record_batch(self, texts: Iterable[str], replied: bool):
+        """
+        记录一个批次的处理结果，不含图片的批次不计入
+        """
+        texts = list(texts)
+        if any(DEFERRED_IMAGE.search(text) for text in texts):
+            self.unseen_batches += 1
+            self.unseen_replied += replied
+        elif any("[图片]" in text or "[表情包]" in text for text in texts):
+            self.seen_batches += 1
+            self.seen_replied += replied
+
+    def summary(self) -> str:
+        unseen_rate = self.unseen_replied / self.unseen_batches if self.unseen_batches else 0.0
+        seen_rate = self.seen_replied / self.seen_batches if self.seen_batches else 0.0
+        return (
+            f"累计延迟 {self.deferred} 张, 之后解析 {self.resolved} 张, 失败 {self.failed} 次, "
+            f"避免VLM解析 {self.avoided()} 张; "
+            f"含未查看图片的批次 {self.unseen_batches} 个(回复率 {unseen_rate:.0%}), "
+            f"图片都已查看的批次 {self.seen_batches} 个(回复率 {seen_rate:.0%})"
+        )
+
+
 class ImageManager:
     """
     图片管理
@@ -81,8 +157,63 @@ class ImageManager:
                     model="Pro/Qwen/Qwen2.5-VL-7B-Instruct",
                 )
             IMAGE_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+            # 延迟解析的图片: 哈希 -> (base64, 是否是表情包)
+            self._deferred: OrderedDict[str, tuple[str, bool]] = OrderedDict()
+            self.stats = LazyImageStats()
             self._initialized = True
 
+    def defer(self, image_base64: str, is_sticker: bool) -> str | None:
+        """
+        记录图片以便之后再解析，返回带哈希的占位文本
+
+        描述已经缓存或者未启用VLM时不延迟，返回 None
+        """
+        if not self._vlm:
+            return None
+        image_hash = _calculate_image_hash(base64.b64decode(image_base64))
+        if IMAGE_CACHE_DIR.joinpath(f"{image_hash}.json").exists():
+            return None
+        if image_hash not in self._deferred:
+            self.stats.deferred += 1
+        self._deferred[image_hash] = (image_base64, is_sticker)
+        self._deferred.move_to_end(image_hash)
+        while len(self._deferred) > 256:
+            self._deferred.popitem(last=False)
+        return f"[{'表情包' if is_sticker else '图片'}(未查看):{image_hash}]"
+
+    async def resolve_deferred(self, texts: Iterable[str]) -> dict[str, str]:
+        """
+        并发解析文本中延迟的图片，返回占位文本到描述文本的映射
+
+        解析失败的图片不在返回值中，保留占位文本和记录，之后可以再次解析
+        """
+        placeholders = {match.group(0): match.group(1) for text in texts for match in DEFERRED_IMAGE.finditer(text)}
+        if not placeholders:
+            return {}
+
+        async def resolve(placeholder: str, image_hash: str) -> str | None:
+            deferred = self._deferred.get(image_hash)
+            if not deferred:
+                # 图片已经被挤出记录，无法再解析，只保留图片类型
+                return strip_deferred(placeholder)
+            try:
+                description = await self.get_image_description(image_base64=deferred[0], is_sticker=deferred[1])
+            except Exception as e:
+                logger.warning(f"延迟图片解析失败: {e}")
+                description = None
+            if not description:
+                self.stats.failed += 1
+                return None
+            self._deferred.pop(image_hash, None)
+            self.stats.resolved += 1
+            return format_description(description)
+
+        results = await asyncio.gather(
+            *(resolve(placeholder, image_hash) for placeholder, image_hash in placeholders.items())
+        )
+        logger.info(f"延迟图片解析: 本次解析 {len(placeholders)} 张, {self.stats.summary()}")
+        return {placeholder: result for placeholder, result in zip(placeholders, results) if result is not None}
+
     async def get_image_description(self, image_base64: str, is_sticker: bool) -> ImageWithDescription | None:
         """
         获取图片描述
@@ -126,33 +257,30 @@ class ImageManager:
                 return None
             prompt = """这是一个动态图，每一张图代表了动态图的某一帧，黑色背景代表透明。"请用中文描述这张图片的内容。如
             果有文字，请把文字都描述出来。并尝试猜测这个图片的含义。最多100个字"""
-            description = await self._vlm.request(
-                prompt=prompt,
-                image_base64=gif_transfromed,
-                image_format="jpeg",
-            )
             # 分析表达的情感
-            prompt = """这是一个动态图，每一张图代表了动态图的某一帧，黑色背景代表透明。请分析这个表情包表达的情感，
-            用中文给出'情感，类型，含义'的三元式描述，要求每个描述都是一个简单的词语"""
-            description_emotion = await self._vlm.request(
-                prompt=prompt,
-                image_base64=gif_transfromed,
-                image_format="jpeg",
-            )
+            prompt_emotion = """这是一个动态图，每一张图代表了动态图的某一帧，黑色背景代表透明。请分析这个表情包表达的
+            情感，用中文给出'情感，类型，含义'的三元式描述，要求每个描述都是一个简单的词语"""
+            vlm_image, vlm_format = gif_transfromed, "jpeg"
         else:
             prompt = "请用中文描述这张图片的内容。如果有文字，请把文字都描述出来。并尝试猜测这个图片的含义。最多100个字"
-            description = await self._vlm.request(
-                prompt=prompt,
-                image_base64=image_base64,
-                image_format=image_format,
-            )
             # 分析表达的情感
-            prompt = """请分析这个表情包表达的情感，用中文给出'情感，类型，含义'的三元式描述，要求每个描述都是一个简单的
-            词语"""
-            description_emotion = await self._vlm.request(
-                prompt=prompt,
-                image_base64=image_base64,
-                image_format="jpeg",
+            prompt_emotion = """请分析这个表情包表达的情感，用中文给出'情感，类型，含义'的三元式描述，要求每个描述都是
+            一个简单的词语"""
+            vlm_image, vlm_format = image_base64, image_format
+
+        # 描述和情感互不依赖，并发请求
+        with scheduling(priority=Priority.IMAGE):
+            description, description_emotion = await asyncio.gather(
+                self._vlm.request(
+                    prompt=prompt,
+                    image_base64=vlm_image,
+                    image_format=vlm_format,
+                ),
+                self._vlm.request(
+                    prompt=prompt_emotion,
+                    image_base64=vlm_image,
+                    image_format="jpeg",
+                ),
             )
 
         if not description or not description_emotion:
@@ -293,6 +421,24 @@ def _transform_gif(gif_base64: str, similarity_threshold: float = 1000.0, max_fr
         return None  # 其他错误也返回None
 
 
+def format_description(description: ImageWithDescription) -> str:
+    """
+    将图片描述转换为消息文本
+    """
+    if description.is_sticker:
+        return f"\n[表情包] [情感:{description.emotion}] [内容:{description.description}]\n"
+    return f"\n[图片] {description.description}\n"
+
+
+def strip_deferred(text: str) -> str:
+    """
+    去掉文本中仍未解析的延迟图片的哈希，只保留图片类型
+
+    写入长期记忆的文本使用，延迟图片的记录会被挤出，长期记忆中的占位文本之后无法再解析
+    """
+    return DEFERRED_IMAGE.sub(lambda match: "[表情包]" if match.group(0).startswith("[表情包") else "[图片]", text)
+
+
 def _calculate_image_hash(image: bytes) -> str:
     """
     计算图片的SHA256哈希值
@@ -2,11 +2,49 @@ from dataclasses import dataclass
 from datetime import datetime
 
 
-@dataclass
+@dataclass(slots=True)
 class Impression:
     """
     记录某次互动带来的印象
     """
 
     timestamp: datetime
-    delta: dict
+    valence: float = 0.0
+    """
+    愉悦度变化
+    """
+    arousal: float = 0.0
+    """
+    唤醒度变化
+    """
+    dominance: float = 0.0
+    """
+    支配度变化
+    """
+
+    @staticmethod
+    def from_delta(timestamp: datetime, delta: dict) -> "Impression":
+        """
+        从 {"valence": ..., "arousal": ..., "dominance": ...} 格式的情感变化创建印象
+        """
+        return Impression(
+            timestamp=timestamp,
+            valence=float(delta.get("valence", 0.0)),
+            arousal=float(delta.get("arousal", 0.0)),
+            dominance=float(delta.get("dominance", 0.0)),
+        )
+
+    def __getstate__(self) -> tuple:
+        return (self.timestamp, self.valence, self.arousal, self.dominance)
+
+    def __setstate__(self, state):
+        if isinstance(state, dict):
+            # 兼容旧版本以 delta 字典保存的印象
+            delta = state.get("delta", {})
+            state = (
+                state["timestamp"],
+                float(delta.get("valence", 0.0)),
+                float(delta.get("arousal", 0.0)),
+                float(delta.get("dominance", 0.0)),
+            )
+        self.timestamp, self.valence, self.arousal, self.dominance = state
@@ -0,0 +1,57 @@
+from difflib import SequenceMatcher
+import re
+
+from .mem import Message
+
+_WHITESPACE = re.compile(r"\s+")
+
+
+def _normalize(text: str) -> str:
+    return _WHITESPACE.sub("", text).lower()
+
+
+def collapse_into(messages: list[Message], message: Message, similarity: float, window: int = 10) -> bool:
+    """
+    如果新消息与最近的消息重复或近似重复，合并为一条计数消息
+
+    多人刷同一句话时也会合并，其他发送者记录在合并后的消息中
+
+    Args:
+        messages: 等待处理的消息
+        message: 新消息
+        similarity: 判定为近似重复的相似度阈值(0~1)，大于1时只合并完全相同的消息
+        window: 只与最后 window 条消息比较
+
+    Returns:
+        是否已合并，未合并时需要调用方自行追加
+    """
+    text = _normalize(message.content)
+    for existing in reversed(messages[-window:]):
+        existing_text = _normalize(existing.content)
+        if existing_text == text or (
+            # 太短的消息只合并完全相同的
+            min(len(text), len(existing_text)) >= 4 and SequenceMatcher(None, existing_text, text).ratio() >= similarity
+        ):
+            existing.repeat += message.repeat
+            senders = (message.user_name, *message.others)
+            existing.others += tuple(
+                dict.fromkeys(name for name in senders if name != existing.user_name and name not in existing.others)
+            )
+            return True
+    return False
+
+
+def take_batch(messages: list[Message], max_size: int) -> list[Message]:
+    """
+    从等待处理的消息中取出最早的一批，剩下的留给下一批
+
+    Args:
+        max_size: 每批最多的消息数量，小于等于0时不限制
+    """
+    if max_size <= 0 or len(messages) <= max_size:
+        batch = messages.copy()
+        messages.clear()
+        return batch
+    batch = messages[:max_size]
+    del messages[:max_size]
+    return batch
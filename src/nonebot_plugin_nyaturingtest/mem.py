@@ -1,15 +1,19 @@
 import asyncio
-from collections import deque
-from collections.abc import Callable
-from dataclasses import dataclass
+from collections import Counter, deque
+from collections.abc import Callable, Iterable
+from dataclasses import dataclass, replace
 from datetime import datetime
+from functools import cached_property
+from itertools import islice
+import re
 
 from nonebot import logger
 
 from .client import LLMClient
+from .scheduler import Priority, scheduling
 
 
-@dataclass
+@dataclass(slots=True)
 class Message:
     time: datetime
     """
@@ -23,16 +27,34 @@ class Message:
     """
     消息内容
     """
+    repeat: int = 1
+    """
+    重复次数，刷屏时重复或近似重复的消息合并为一条
+    """
+    others: tuple[str, ...] = ()
+    """
+    刷屏时也发送了这条消息的其他发送者
+    """
+
+    def __post_init__(self):
+        # 同一个发言人的名称只保留一份
+        self.user_name = intern_speaker(self.user_name)
+        self.others = tuple(intern_speaker(name) for name in self.others)
 
     def to_json(self) -> dict:
         """
         转换为 JSON 格式
         """
-        return {
+        data = {
             "time": self.time.isoformat(),
             "user_name": self.user_name,
             "content": self.content,
         }
+        if self.repeat > 1:
+            data["repeat"] = self.repeat
+        if self.others:
+            data["others"] = list(self.others)
+        return data
 
     @staticmethod
     def from_json(data: dict) -> "Message":
@@ -43,12 +65,49 @@ class Message:
             time=datetime.fromisoformat(data["time"]),
             user_name=data["user_name"],
             content=data["content"],
+            repeat=data.get("repeat", 1),
+            others=tuple(data.get("others", ())),
         )
 
 
-@dataclass
+_SPEAKERS: dict[str, str] = {}
+"""
+发言人名称表，相同的名称只保留一份
+"""
+
+
+def intern_speaker(name: str) -> str:
+    """
+    从发言人名称表中取出相同的名称，不存在时加入
+    """
+    return _SPEAKERS.setdefault(name, name)
+
+
+def render_message(message: Message) -> str:
+    """
+    将消息渲染为紧凑的单行文本，如 `12:34 小明: 你好`，重复的消息在末尾标注次数和其他发送者，
+    如 `(x3)`、`(x3，阿狸、Tom也发了)`
+    """
+    content = re.sub(r"\s*\n\s*", " ", message.content.strip())
+    others = f"，{'、'.join(message.others)}也发了" if message.others else ""
+    repeat = f" (x{message.repeat}{others})" if message.repeat > 1 else ""
+    return f"{message.time:%H:%M} {message.user_name}: {content}{repeat}"
+
+
+def render_messages(messages: Iterable[Message]) -> str:
+    """
+    将消息列表渲染为紧凑的聊天记录，每条消息一行
+    """
+    return "\n".join(render_message(message) for message in messages)
+
+
+@dataclass(frozen=True)
 class MemoryRecord:
-    messages: list[Message]
+    """
+    记忆的不可变快照，记忆不变时重复访问返回同一个快照
+    """
+
+    messages: tuple[Message, ...]
     """
     消息记录
     """
@@ -56,6 +115,24 @@ class MemoryRecord:
     """
     压缩后的历史消息
     """
+    version: int = 0
+    """
+    快照对应的记忆版本
+    """
+
+    @cached_property
+    def lines(self) -> tuple[str, ...]:
+        """
+        渲染后的消息，每条消息一行
+        """
+        return tuple(render_message(message) for message in self.messages)
+
+    @cached_property
+    def transcript(self) -> str:
+        """
+        渲染后的聊天记录
+        """
+        return "\n".join(self.lines)
 
 
 class Memory:
@@ -68,68 +145,126 @@ class Memory:
     ):
         self.__length_limit = length_limit
         self.__compressed_message = compressed_message or ""
-        self.__messages = deque(messages, maxlen=length_limit * 5) if messages else deque(maxlen=length_limit * 5)
+        self.__messages: deque[Message] = deque(maxlen=length_limit * 5)
+        self.__user_counts: Counter[str] = Counter()  # 记忆中各用户的消息数量
+        self.__append(messages or [])
+        self.__version = 0  # 记忆版本，每次变化时递增
+        self.__snapshot: MemoryRecord | None = None
         self.__llm_client = llm_client
-        self.__compress_counter = 0
+        self.__next_seq = len(self.__messages)  # 下一条消息的序号
+        # 第一条还未被总结的消息的序号，恢复的消息如果已经有总结，视为已经被总结过
+        self.__watermark = self.__next_seq if self.__compressed_message else 0
         self.__compress_task: asyncio.Task | None = None  # 压缩任务句柄
+        self.__compress_pending = False  # 压缩任务执行期间是否有新的压缩请求
+        self.__after_compress: Callable[[], None] | None = None
 
     def related_users(self) -> list[str]:
         """
         获取相关用户列表
         """
-        return list({message.user_name for message in self.__messages})
+        return list(self.__user_counts)
+
+    def __append(self, messages: list[Message]):
+        """
+        追加消息，同时维护用户计数
+        """
+        for message in messages:
+            if len(self.__messages) == self.__messages.maxlen:
+                evicted = self.__messages[0].user_name
+                self.__user_counts[evicted] -= 1
+                if self.__user_counts[evicted] <= 0:
+                    del self.__user_counts[evicted]
+            self.__messages.append(message)
+            self.__user_counts[message.user_name] += 1
 
     async def clear(self) -> None:
         """
         清除所有记忆
         """
+        await self.__cancel_compress_task()
         self.__messages.clear()
+        self.__user_counts.clear()
         self.__compressed_message = ""
-        self.__compress_counter = 0
-        await self.__cancel_compress_task()
+        self.__version += 1
+        self.__next_seq = 0
+        self.__watermark = 0
+        self.__compress_pending = False
         logger.info("已清除所有记忆")
 
-    async def __compress_message(self, after_compress: Callable[[], None] | None = None):
-        history_messages = [f"{msg.user_name}: {msg.content}" for msg in self.__messages]
-        prompt = f"""
-请将以下消息分参与的话题压缩，提取
+    def __unsummarized(self) -> list[Message]:
+        """
+        获取还未被总结的消息
+        """
+        head_seq = self.__next_seq - len(self.__messages)
+        if self.__watermark < head_seq:
+            logger.warning(f"有 {head_seq - self.__watermark} 条消息在总结前被挤出记忆")
+        return list(self.__messages)[max(self.__watermark - head_seq, 0) :]
+
+    async def __compress_message(self):
+        """
+        将上次总结后的新消息合并进历史总结，执行期间收到的压缩请求会在本轮结束后合并执行
+        """
+        while True:
+            self.__compress_pending = False
+            end_seq = self.__next_seq
+            new_messages = self.__unsummarized()
+            if not new_messages:
+                return
+            previous = self.__compressed_message or "没有总结"
+            prompt = f"""
+请将新消息合并到已有的总结中，按参与的话题压缩，提取
 
 - 话题简要内容
 - 参与者和它们的发言总结
 
+已有总结中与新消息无关的话题保留，有关的话题更新，过于久远的话题可以精简
+
 格式类似:
 
 [话题: 话题简要内容]
 参与者:
 - a: a发言总结
 
-以下是消息列表，按时间排序从老到新：
+以下是已有的总结：
+
+{previous}
 
-{history_messages}
+以下是新消息列表，按时间排序从老到新：
+
+{render_messages(new_messages)}
 """
-        try:
-            response = await self.__llm_client.generate_response(prompt, model="Qwen/Qwen3-8B")
-            if after_compress:
-                after_compress()
-            if response:
-                self.__compressed_message = response
-                logger.info(f"压缩消息成功: {response}")
-            else:
-                logger.warning("压缩消息失败，原因未知")
-        except asyncio.CancelledError:
-            logger.info("压缩任务被取消")
-            raise
-        except Exception as e:
-            logger.error(f"压缩消息时发生错误: {e}")
+            try:
+                with scheduling(priority=Priority.COMPRESSION):
+                    response = await self.__llm_client.generate_response(prompt, model="Qwen/Qwen3-8B")
+                if self.__after_compress:
+                    self.__after_compress()
+                if response:
+                    self.__compressed_message = response
+                    self.__watermark = end_seq
+                    self.__version += 1
+                    logger.info(f"压缩消息成功({len(new_messages)}条新消息): {response}")
+                else:
+                    logger.warning("压缩消息失败，原因未知")
+            except asyncio.CancelledError:
+                logger.info("压缩任务被取消")
+                raise
+            except Exception as e:
+                logger.error(f"压缩消息时发生错误: {e}")
+            if not self.__compress_pending:
+                return
 
     def access(self) -> MemoryRecord:
         """
         访问记忆
         """
-        return MemoryRecord(
-            messages=list(self.__messages)[-self.__length_limit :],  # 只允许访问后面部分消息
-            compressed_history=self.__compressed_message,
-        )
+        if self.__snapshot is None or self.__snapshot.version != self.__version:
+            start = max(len(self.__messages) - self.__length_limit, 0)
+            self.__snapshot = MemoryRecord(
+                messages=tuple(islice(self.__messages, start, None)),  # 只允许访问后面部分消息
+                compressed_history=self.__compressed_message,
+                version=self.__version,
+            )
+        return self.__snapshot
 
     async def __cancel_compress_task(self):
         """
@@ -142,17 +277,32 @@ class Memory:
             except asyncio.CancelledError:
                 pass
 
+    def rewrite(self, rewrite: Callable[[str], str]):
+        """
+        改写记忆中的消息内容
+
+        改写的消息替换为新的 Message，之前的快照共享的消息不变
+        """
+        for i, message in enumerate(self.__messages):
+            content = rewrite(message.content)
+            if content != message.content:
+                self.__messages[i] = replace(message, content=content)
+                self.__version += 1
+
     async def update(self, message_chunk: list[Message], after_compress: Callable[[], None] | None = None):
-        self.__messages.extend(message_chunk)
+        self.__append(message_chunk)
+        self.__next_seq += len(message_chunk)
+        self.__version += 1
 
-        # 每self.__length_limit条消息压缩一次
-        self.__compress_counter += len(message_chunk)
-        if self.__compress_counter < self.__length_limit:
+        # 每积累self.__length_limit条未总结的消息压缩一次
+        if self.__next_seq - self.__watermark < self.__length_limit:
             return
-        self.__compress_counter = 0
 
-        # 如果有正在执行的压缩任务，先取消它
-        await self.__cancel_compress_task()
+        if after_compress:
+            self.__after_compress = after_compress
+        if self.__compress_task and not self.__compress_task.done():
+            # 有正在执行的压缩任务，等它结束后再合并新消息
+            self.__compress_pending = True
+            return
 
-        # 开启新的压缩任务
-        self.__compress_task = asyncio.create_task(self.__compress_message(after_compress=after_compress))
+        self.__compress_task = asyncio.create_task(self.__compress_message())
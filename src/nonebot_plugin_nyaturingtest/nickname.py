@@ -0,0 +1,139 @@
+import asyncio
+import time
+
+from nonebot import logger
+from nonebot.adapters.onebot.v11 import Bot
+
+from .config import plugin_config
+
+
+def _member_name(info: dict, user_id: int) -> str:
+    return info.get("card") or info.get("nickname") or str(user_id)
+
+
+class NicknameCache:
+    """
+    群成员昵称缓存，按群缓存群名片/昵称，避免每条消息都请求 OneBot API
+    """
+
+    def __init__(self, ttl: float):
+        """
+        Args:
+            ttl: 缓存有效期(秒)
+        """
+        self._ttl = ttl
+        self._names: dict[int, dict[int, tuple[str, float]]] = {}  # 群号 -> 用户id -> (昵称, 过期时间)
+        # 群号 -> 成员列表预热的过期时间
+        self._warmed: dict[int, float] = {}
+        # 下次清理过期昵称的时间
+        self._next_evict = time.monotonic() + ttl
+        # 正在进行的查询，相同用户的并发查询共用同一个请求
+        self._inflight: dict[tuple[int, int], asyncio.Task[str]] = {}
+        self._messages = 0
+        self._lookups = 0
+        self._api_calls = 0
+
+    def is_cold(self, group_id: int) -> bool:
+        """
+        群成员昵称没有预热过或者预热已经过期
+        """
+        return self._warmed.get(group_id, 0.0) <= time.monotonic()
+
+    async def warm(self, bot: Bot, group_id: int):
+        """
+        通过群成员列表批量预热缓存
+        """
+        # 获取失败时也要等到过期后再重试
+        self._warmed[group_id] = time.monotonic() + self._ttl
+        self._api_calls += 1
+        try:
+            members = await bot.get_group_member_list(group_id=group_id)
+        except Exception as e:
+            logger.warning(f"获取群 {group_id} 成员列表失败: {e}")
+            return
+        expire = time.monotonic() + self._ttl
+        names = self._names.setdefault(group_id, {})
+        for member in members:
+            user_id = int(member["user_id"])
+            names[user_id] = (_member_name(member, user_id), expire)
+        self._evict()
+        logger.debug(f"已预热群 {group_id} 的 {len(members)} 个成员昵称")
+
+    async def get(self, bot: Bot, group_id: int, user_id: int) -> str:
+        """
+        获取群成员昵称，获取失败时返回用户id
+        """
+        self._lookups += 1
+        cached = self._names.get(group_id, {}).get(user_id)
+        if cached and cached[1] > time.monotonic():
+            return cached[0]
+        key = (group_id, user_id)
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.create_task(self._fetch(bot, group_id, user_id))
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        return await asyncio.shield(task)
+
+    async def _fetch(self, bot: Bot, group_id: int, user_id: int) -> str:
+        self._api_calls += 1
+        try:
+            info = await bot.get_group_member_info(group_id=group_id, user_id=user_id)
+        except Exception as e:
+            logger.warning(f"获取群 {group_id} 成员 {user_id} 信息失败: {e}")
+            return str(user_id)
+        name = _member_name(info, user_id)
+        self.update(group_id, user_id, name)
+        return name
+
+    def update(self, group_id: int, user_id: int, name: str):
+        """
+        更新缓存中的昵称
+        """
+        self._names.setdefault(group_id, {})[user_id] = (name, time.monotonic() + self._ttl)
+        self._evict()
+
+    def invalidate(self, group_id: int, user_id: int):
+        """
+        使缓存中的昵称失效
+        """
+        self._names.get(group_id, {}).pop(user_id, None)
+
+    def _evict(self):
+        """
+        每隔一个有效期清理一次过期的昵称，离开的成员和不再活跃的群不会一直留在缓存中
+        """
+        now = time.monotonic()
+        if now < self._next_evict:
+            return
+        self._next_evict = now + self._ttl
+        for group_id in list(self._names):
+            names = self._names[group_id]
+            for user_id in [user_id for user_id, (_, expire) in names.items() if expire <= now]:
+                del names[user_id]
+            if not names:
+                del self._names[group_id]
+        for group_id in [group_id for group_id, expire in self._warmed.items() if expire <= now]:
+            del self._warmed[group_id]
+
+    def __len__(self) -> int:
+        return sum(len(names) for names in self._names.values())
+
+    def record_message(self):
+        """
+        记录处理了一条消息，每1000条消息报告一次节省的 API 调用
+        """
+        self._messages += 1
+        if self._messages % 1000 == 0:
+            logger.info(self.report())
+
+    def report(self) -> str:
+        saved = self._lookups - self._api_calls
+        per_1000 = saved * 1000 / self._messages if self._messages else 0.0
+        return (
+            f"昵称缓存: {self._messages} 条消息, {self._lookups} 次查询, {self._api_calls} 次 API 调用, "
+            f"每1000条消息节省 {per_1000:.0f} 次 API 调用"
+        )
+
+
+nickname_cache = NicknameCache(ttl=plugin_config.nyaturingtest_nickname_ttl)
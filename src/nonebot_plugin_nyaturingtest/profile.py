@@ -64,15 +64,15 @@ class PersonProfile:
 
                 # 衰减印象的愉悦度，无论好坏
                 # 愉悦总是短暂的，厌恶却会在心中挥之不去
-                decayed_valence = decay_valence(elapsed_hours, impression.delta.get("valence", 0.0))
+                decayed_valence = decay_valence(elapsed_hours, impression.valence)
 
                 # 衰减印象的激活度
                 # 在疯狂降临之前，无论是极度恐惧还是极度兴奋，都会很快平复
-                decayed_arousal = decay_arousal(elapsed_hours, impression.delta.get("arousal", 0.0))
+                decayed_arousal = decay_arousal(elapsed_hours, impression.arousal)
 
                 # 衰减印象的支配度
                 # 支配度在日积月累中形成，不会轻易改变
-                decayed_dominance = decay_dominance(elapsed_hours, impression.delta.get("dominance", 0.0))
+                decayed_dominance = decay_dominance(elapsed_hours, impression.dominance)
 
                 # 计算出的情感也是情感
                 if decayed_valence > 0:
@@ -93,12 +93,10 @@ class PersonProfile:
                 return
 
             merged_impression = Impression(
-                delta={
-                    "valence": valence + valence_negative,
-                    "arousal": arousal + arousal_negative,
-                    "dominance": dominance + dominance_negative,
-                },
                 timestamp=merged_impression_time,
+                valence=valence + valence_negative,
+                arousal=arousal + arousal_negative,
+                dominance=dominance + dominance_negative,
             )
 
             # 清除过期的印象
@@ -136,15 +134,15 @@ class PersonProfile:
 
             # 衰减印象的愉悦度，无论好坏
             # 愉悦总是短暂的，厌恶却会在心中挥之不去
-            decayed_valence = decay_valence(elapsed_hours, impression.delta.get("valence", 0.0))
+            decayed_valence = decay_valence(elapsed_hours, impression.valence)
 
             # 衰减印象的激活度
             # 在疯狂降临之前，无论是极度恐惧还是极度兴奋，都会很快平复
-            decayed_arousal = decay_arousal(elapsed_hours, impression.delta.get("arousal", 0.0))
+            decayed_arousal = decay_arousal(elapsed_hours, impression.arousal)
 
             # 衰减印象的支配度
             # 支配度在日积月累中形成，不会轻易改变
-            decayed_dominance = decay_dominance(elapsed_hours, impression.delta.get("dominance", 0.0))
+            decayed_dominance = decay_dominance(elapsed_hours, impression.dominance)
 
             # 计算出的情感也是情感
             if decayed_valence > 0:
@@ -0,0 +1,301 @@
+import asyncio
+from collections import OrderedDict, deque
+from collections.abc import AsyncIterator, Iterator
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from enum import IntEnum
+import time
+
+from nonebot import logger
+
+from .config import plugin_config
+
+
+class Priority(IntEnum):
+    """
+    请求优先级，数值越小越优先
+    """
+
+    MENTION = 0
+    """
+    回复提到机器人的消息
+    """
+    CHAT = 1
+    """
+    对话阶段
+    """
+    FEEDBACK = 2
+    """
+    检索和反馈阶段
+    """
+    COMPRESSION = 3
+    """
+    短期记忆压缩
+    """
+    INDEXING = 4
+    """
+    长期记忆索引
+    """
+    IMAGE = 5
+    """
+    图片描述
+    """
+
+
+_BACKGROUND = Priority.INDEXING
+"""
+这个优先级及更低的是后台请求，并发数大于1时至少给前台请求留一个名额
+"""
+
+_priority: ContextVar[Priority] = ContextVar("nyaturingtest_priority", default=Priority.CHAT)
+_group: ContextVar[str] = ContextVar("nyaturingtest_group", default="global")
+
+
+@contextmanager
+def scheduling(priority: Priority | None = None, group: str | None = None) -> Iterator[None]:
+    """
+    设置当前上下文中发出请求的优先级和所属群组，在此期间创建的任务也会继承
+    """
+    priority_token = _priority.set(priority) if priority is not None else None
+    group_token = _group.set(group) if group is not None else None
+    try:
+        yield
+    finally:
+        if priority_token is not None:
+            _priority.reset(priority_token)
+        if group_token is not None:
+            _group.reset(group_token)
+
+
+class TokenBucket:
+    """
+    令牌桶限速
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        """
+        Args:
+            rate: 每秒补充的令牌数，小于等于0时不限速
+            capacity: 桶容量，即允许的突发请求数
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+
+    def reserve(self) -> float:
+        """
+        取出一个令牌，返回需要等待的秒数
+        """
+        if self.rate <= 0:
+            return 0.0
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        self._tokens -= 1
+        return 0.0 if self._tokens >= 0 else -self._tokens / self.rate
+
+
+@dataclass
+class _WaitStats:
+    count: int = 0
+    total: float = 0.0
+    max: float = 0.0
+
+    def record(self, wait: float):
+        self.count += 1
+        self.total += wait
+        self.max = max(self.max, wait)
+
+
+@dataclass
+class _Provider:
+    bucket: TokenBucket
+    concurrency: int
+    in_flight: int = 0
+    # 进行中的后台请求数
+    background: int = 0
+    # 优先级 -> 群组 -> 等待者，同一优先级内按群组轮流放行
+    queues: dict[Priority, OrderedDict[str, deque[asyncio.Future[None]]]] = field(default_factory=dict)
+    waits: dict[Priority, _WaitStats] = field(default_factory=dict)
+
+    def waiting(self, priority: Priority | None = None) -> int:
+        """
+        排队的请求数
+
+        Args:
+            priority: 只统计这个优先级及更高的请求
+        """
+        return sum(
+            len(waiters)
+            for queue_priority, groups in self.queues.items()
+            if priority is None or queue_priority <= priority
+            for waiters in groups.values()
+        )
+
+    def admits(self, priority: Priority) -> bool:
+        """
+        是否有这个优先级可用的名额
+        """
+        if self.in_flight >= self.concurrency:
+            return False
+        return priority < _BACKGROUND or self.concurrency == 1 or self.background < self.concurrency - 1
+
+    def acquire(self, priority: Priority):
+        self.in_flight += 1
+        if priority >= _BACKGROUND:
+            self.background += 1
+
+    def release(self, priority: Priority):
+        self.in_flight -= 1
+        if priority >= _BACKGROUND:
+            self.background -= 1
+
+
+class Scheduler:
+    """
+    全局请求调度器，对同一上游服务的请求按优先级排队，同一优先级内各群组公平轮流，并按令牌桶限速
+
+    长期记忆索引等后台请求最多占用并发数减一个名额，不会让提到机器人和对话的请求等待
+    """
+
+    def __init__(self):
+        self._providers: dict[str, _Provider] = {}
+
+    def configure(self, provider: str, rate: float, concurrency: int):
+        """
+        配置上游服务的限速
+
+        Args:
+            rate: 每秒请求数，小于等于0时不限速
+            concurrency: 最大并发请求数
+        """
+        self._providers[provider] = _Provider(
+            bucket=TokenBucket(rate=rate, capacity=max(rate, 1.0)),
+            concurrency=max(concurrency, 1),
+        )
+
+    @asynccontextmanager
+    async def slot(self, provider: str, priority: Priority | None = None) -> AsyncIterator[None]:
+        """
+        获取一个请求名额，在 async with 块内发出请求
+
+        Args:
+            provider: 上游服务名称
+            priority: 优先级，不提供时使用当前上下文的优先级
+        """
+        state = self._providers.get(provider)
+        if state is None:
+            yield
+            return
+        priority = priority if priority is not None else _priority.get()
+        group = _group.get()
+        start = time.monotonic()
+
+        if not state.admits(priority) or state.waiting(priority):
+            waiter: asyncio.Future[None] = asyncio.get_running_loop().create_future()
+            state.queues.setdefault(priority, OrderedDict()).setdefault(group, deque()).append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                if waiter.done() and not waiter.cancelled():
+                    # 已经被放行，把名额让给下一个
+                    state.release(priority)
+                    self._release(state)
+                else:
+                    self._remove(state, priority, group, waiter)
+                raise
+        else:
+            state.acquire(priority)
+
+        try:
+            delay = state.bucket.reserve()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            wait = time.monotonic() - start
+            state.waits.setdefault(priority, _WaitStats()).record(wait)
+            if wait > 5:
+                logger.debug(f"{provider} 请求({priority.name}, {group})排队 {wait:.1f} 秒")
+            yield
+        finally:
+            state.release(priority)
+            self._release(state)
+
+    @staticmethod
+    def _remove(state: _Provider, priority: Priority, group: str, waiter: asyncio.Future[None]):
+        groups = state.queues.get(priority)
+        if not groups or group not in groups:
+            return
+        try:
+            groups[group].remove(waiter)
+        except ValueError:
+            return
+        if not groups[group]:
+            del groups[group]
+
+    @staticmethod
+    def _release(state: _Provider):
+        """
+        有空闲名额时放行优先级最高的等待者
+        """
+        while state.in_flight < state.concurrency:
+            for priority in sorted(state.queues):
+                groups = state.queues[priority]
+                if groups:
+                    break
+            else:
+                return
+            if not state.admits(priority):
+                # 优先级最高的是后台请求且后台名额已满，剩下的名额留给前台请求
+                return
+            group, waiters = groups.popitem(last=False)
+            waiter = waiters.popleft()
+            if waiters:
+                # 这个群组排到本优先级的最后
+                groups[group] = waiters
+            if waiter.done():
+                continue
+            state.acquire(priority)
+            waiter.set_result(None)
+
+    def metrics(self) -> dict[str, dict]:
+        """
+        各上游服务的排队深度和等待时间
+        """
+        return {
+            provider: {
+                "in_flight": state.in_flight,
+                "waiting": state.waiting(),
+                "waits": {
+                    priority.name: {
+                        "count": stats.count,
+                        "avg": stats.total / stats.count if stats.count else 0.0,
+                        "max": stats.max,
+                    }
+                    for priority, stats in sorted(state.waits.items())
+                },
+            }
+            for provider, state in self._providers.items()
+        }
+
+    def report(self) -> str:
+        lines = []
+        for provider, metrics in self.metrics().items():
+            lines.append(f"{provider}: 进行中 {metrics['in_flight']}，排队 {metrics['waiting']}")
+            for name, wait in metrics["waits"].items():
+                lines.append(f"  {name}: {wait['count']} 次，平均等待 {wait['avg']:.2f}s，最长 {wait['max']:.2f}s")
+        return "\n".join(lines)
+
+
+scheduler = Scheduler()
+scheduler.configure(
+    "chat",
+    rate=plugin_config.nyaturingtest_chat_rate_limit,
+    concurrency=plugin_config.nyaturingtest_chat_concurrency,
+)
+scheduler.configure(
+    "siliconflow",
+    rate=plugin_config.nyaturingtest_siliconflow_rate_limit,
+    concurrency=plugin_config.nyaturingtest_siliconflow_concurrency,
+)
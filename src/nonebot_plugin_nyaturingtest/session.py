@@ -1,5 +1,6 @@
+import asyncio
 from collections import deque
-from collections.abc import Awaitable, Callable
+from collections.abc import AsyncIterator, Awaitable, Callable, Iterable
 from dataclasses import asdict, dataclass
 from datetime import datetime
 from enum import Enum
@@ -8,21 +9,35 @@ import os
 import pickle
 import random
 import re
+import textwrap
+import time
 import traceback
+from typing import TypeVar
 
 import anyio
 from nonebot import logger
 import nonebot_plugin_localstore as store
 from openai import AsyncOpenAI
 
-from .client import LLMClient
+from .client import LLMClient, ReplyStreamParser
 from .config import plugin_config
+from .context import ContextBuilder, ContextSection, count_tokens, summarize_omitted
 from .emotion import EmotionState
+from .gate import GateStats, score_batch
 from .hippo_mem import HippoMemory
+from .image_manager import strip_deferred
 from .impression import Impression
-from .mem import Memory, Message
+from .mem import Memory, Message, render_message
 from .presets import PRESETS
 from .profile import PersonProfile
+from .scheduler import Priority, scheduling
+
+_T = TypeVar("_T")
+
+_RETRIEVE_K = 3
+"""
+每次检索长期记忆返回的最大结果数
+"""
 
 
 @dataclass
@@ -37,6 +52,241 @@ class _SearchResult:
     """
 
 
+@dataclass
+class _SpeculationStats:
+    """
+    推测执行对话阶段的统计
+    """
+
+    hits: int = 0
+    """
+    反馈阶段后仍处于对话状态的次数（推测结果可用）
+    """
+    misses: int = 0
+    """
+    反馈阶段后转为潜水状态的次数（推测结果作废）
+    """
+    wasted_prompt_tokens: int = 0
+    """
+    作废的推测请求的提示词token数
+    """
+    wasted_response_tokens: int = 0
+    """
+    作废的推测请求的回复token数（请求被取消时为0）
+    """
+
+    def hit_rate(self) -> float:
+        """
+        推测命中率，没有样本时视为1.0
+        """
+        total = self.hits + self.misses
+        if total == 0:
+            return 1.0
+        return self.hits / total
+
+
+@dataclass
+class _SupersedeStats:
+    """
+    打断对话请求的统计
+    """
+
+    superseded: int = 0
+    """
+    对话请求被新消息打断并重新生成的次数
+    """
+    cancelled_prompt_tokens: int = 0
+    """
+    被打断的请求的提示词token数
+    """
+    cancelled_response_tokens: int = 0
+    """
+    被打断的请求已经生成的回复token数（非流式请求为0）
+    """
+    replies: int = 0
+    """
+    发出的回复数
+    """
+    total_age: float = 0.0
+    """
+    发出回复时本批次最新消息的累计等待时间(秒)
+    """
+    max_age: float = 0.0
+    """
+    发出回复时本批次最新消息的最长等待时间(秒)
+    """
+
+    def record_reply(self, age: float):
+        self.replies += 1
+        self.total_age += age
+        self.max_age = max(self.max_age, age)
+
+    def freshness(self) -> float:
+        """
+        发出回复时本批次最新消息的平均等待时间(秒)，越小越新鲜
+        """
+        return self.total_age / self.replies if self.replies else 0.0
+
+
+@dataclass
+class Supersede:
+    """
+    对话阶段等待llm期间有新消息到达时，打断请求并合并新消息重新生成回复
+    """
+
+    arrived: asyncio.Event
+    """
+    有新消息到达时设置
+    """
+    take: Callable[[int], list[Message]]
+    """
+    取出应当合并到本批次的新消息，参数为本批次已有的消息数，还不需要打断时返回空列表
+    """
+
+
+class _Turn:
+    """
+    一次更新的上下文：本批次的消息、llm调用统计和已经发出的回复
+    """
+
+    def __init__(
+        self,
+        messages_chunk: list[Message],
+        llm: Callable[[str], Awaitable[str]],
+        llm_stream: Callable[[str], AsyncIterator[str]] | None,
+        on_reply: Callable[[str], Awaitable[None]] | None,
+    ):
+        self.messages_chunk = messages_chunk
+        """
+        本批次的消息，对话请求被打断时合并进来的新消息会追加到其中
+        """
+        self.on_reply = on_reply
+        self._llm = llm
+        self._llm_stream = llm_stream
+        self.sent_replies: list[str] = []
+        """
+        已经发出的回复
+        """
+        # 统计本轮llm调用次数和提示词长度，用于对比融合模式和分阶段模式
+        self.llm_calls = 0
+        self.prompt_tokens = 0
+        # 被取消的请求的token数
+        self.cancelled_prompt_tokens = 0
+        self.cancelled_response_tokens = 0
+
+    @property
+    def streaming(self) -> bool:
+        """
+        是否流式请求对话阶段并逐条发出回复
+        """
+        return self._llm_stream is not None and self.on_reply is not None
+
+    async def llm(self, prompt: str) -> str:
+        self.llm_calls += 1
+        tokens = count_tokens(prompt)
+        self.prompt_tokens += tokens
+        try:
+            return await self._llm(prompt)
+        except asyncio.CancelledError:
+            self.cancelled_prompt_tokens += tokens
+            raise
+
+    async def llm_stream(self, prompt: str) -> AsyncIterator[str]:
+        assert self._llm_stream is not None
+        self.llm_calls += 1
+        tokens = count_tokens(prompt)
+        self.prompt_tokens += tokens
+        response = ""
+        try:
+            async for delta in self._llm_stream(prompt):
+                response += delta
+                yield delta
+        except asyncio.CancelledError:
+            self.cancelled_prompt_tokens += tokens
+            self.cancelled_response_tokens += count_tokens(response)
+            raise
+
+
+class _Deadline:
+    """
+    单次更新的回复时间预算，各阶段按比例分配，不计入短期记忆压缩和长期记忆索引的耗时
+
+    超时的阶段在它下一次 await 时才能被取消。HippoRAG 的检索和索引在线程中运行，不阻塞事件循环，
+    所以检索阶段可以按时被取消，取消后线程在后台继续运行到结束
+    """
+
+    def __init__(self, budget: float, excluded: Callable[[], float]):
+        """
+        Args:
+            budget: 总预算(秒)，小于等于0时不限时
+            excluded: 返回累计不计入预算的耗时(秒)
+        """
+        self.budget = budget
+        self.degraded: list[str] = []
+        """
+        本次更新中降级的阶段及原因
+        """
+        self._excluded = excluded
+        self._excluded_start = excluded()
+        self._start = time.monotonic()
+
+    def elapsed(self) -> float:
+        """
+        已经使用的预算(秒)
+        """
+        return time.monotonic() - self._start - (self._excluded() - self._excluded_start)
+
+    async def run(self, aw: Awaitable[_T], share: float) -> _T:
+        """
+        在预算内执行一个阶段，超时时取消该阶段并抛出 asyncio.TimeoutError
+
+        Args:
+            aw: 阶段协程
+            share: 本阶段最多使用总预算的比例，不超过剩余预算
+        """
+        if self.budget <= 0:
+            return await aw
+        stage_end = min(self.elapsed() + self.budget * share, self.budget)
+        task = asyncio.ensure_future(aw)
+        try:
+            # 不计入预算的耗时会推迟截止时间，所以每次醒来都重新计算剩余时间
+            while not task.done():
+                remaining = stage_end - self.elapsed()
+                if remaining <= 0:
+                    task.cancel()
+                    await asyncio.wait({task})
+                    if task.cancelled() or task.exception() is not None:
+                        raise asyncio.TimeoutError
+                    break
+                await asyncio.wait({task}, timeout=remaining)
+        except asyncio.CancelledError:
+            task.cancel()
+            raise
+        return task.result()
+
+    def degrade(self, stage: str, reason: str):
+        """
+        记录一个降级的阶段
+        """
+        self.degraded.append(f"{stage}({reason})")
+
+
+def _render_json_list(items: list[str]) -> str:
+    """
+    将已经序列化(indent=2)的 JSON 对象渲染为 JSON 数组，与直接序列化整个数组的结果一致
+    """
+    if not items:
+        return "[]"
+    return "[\n" + ",\n".join(textwrap.indent(item, "  ") for item in items) + "\n]"
+
+
+def _speaker(line: str) -> str:
+    """
+    取出 `render_message` 渲染的消息的发言人
+    """
+    return line.split(" ", 1)[-1].split(": ", 1)[0]
+
+
 class _ChattingState(Enum):
     ILDE = 0
     """
@@ -61,6 +311,123 @@ class _ChattingState(Enum):
                 return "对话状态"
 
 
+_FEEDBACK_TASKS = """\
+- 基于“新输入消息”的内容和“历史聊天”的背景，结合你之前的情绪，还有检索到的相关记忆，评估你当前的情绪
+  - 情绪采用 VAD 模型，三个维度取值范围：
+    - valence (愉悦度)：[-1.0, 1.0]
+    - arousal (唤醒度)：[0.0, 1.0]
+    - dominance (支配度)：[-1.0, 1.0]
+- 基于“新输入消息”的内容和“历史聊天”的背景，结合你之前的情绪，你对相关人物的情绪倾向，还有检索到的相关记忆，评估你对“新
+  输入消息”中**每条**消息的情感倾向
+  - 如果消息和你完全无关，或你不感兴趣，那么给出的每个情感维度的值总是 0.0
+  - 输出按照“新输入消息”的顺序
+- 基于“历史聊天”的背景，“你在上次对话做出的总结”，还有检索到的相关记忆，用简短的语言总结聊天内容，总结注重于和上次对话的
+  连续性，包括相关人物，简要内容。
+  - 特别的，如果“历史聊天”，检索到的信息中不包含“你在上次对话做出的总结”的人物，那么在这次总结就不保留
+  - 注意：要满足连续性需求，不能简单的只总结“新输入消息”的内容，还要结合上次总结和“历史聊天”的内容，并且不能因为这次的消
+    息没有上次总结的内容的人物就不保留上次总结的内容，只有“历史聊天”，检索到的信息中不包含“你在上次对话做出的总结”的人物时，才
+    不保留上次总结的内容
+  - 例子A(断裂重启型):
+    “你在上次对话做出的总结”
+    小明，小红：讨论 AI 的道德问题。
+
+    “新输入消息”
+    小明：“我们来玩猜谜游戏吧！”
+    小红：“好啊，我来第一个出题！”
+
+    “总结”
+    小明，小红：讨论的话题发生了明显转变，由 AI 的道德问题转变到了玩猜谜游戏。
+  - 例子B(主题转移型):
+    “你在上次对话做出的总结”
+    小明，小红：讨论 AI 的道德问题。
+
+    “新输入消息”
+    小明：“我觉得 AI 应该有道德标准。”
+    小红：“我同意！但是我们应该如何定义这些标准呢？”
+
+    “总结”
+    小明，小红：讨论 AI 的道德问题，继续深入探讨如何定义道德标准。
+
+  - 例子C(无意义话题型):
+    “你在上次对话做出的总结”
+    小明，小红：讨论 AI 的道德问题。
+
+    “新输入消息”
+    小明：“awhnofbonog”
+    小红：“2388y91ry9h”
+
+    “总结”
+    小明，小红：之前在讨论 AI 的道德问题。
+
+  - 例子D(话题回归型):
+    “你在上次对话做出的总结”
+    小明，小红：讨论的话题发生了明显转变，由 AI 的道德问题转变到了玩猜谜游戏。
+
+    “新输入消息”
+    小明：“但是我还是想讨论 AI 是否需要道德”
+    小红：“我觉得 AI 应该有道德标准。”
+
+    “总结”
+    小明，小红：讨论的话题由玩猜谜游戏回归到 AI 的道德问题。
+
+  - 例子E(混合型):
+    “你在上次对话做出的总结”
+    小明，小红：讨论 AI 的道德问题。
+
+    “新输入消息”
+    小亮：“我们来玩猜谜游戏吧！”
+    小明：“我觉得 AI 应该有道德标准。”
+    小圆：“@小亮 好呀”
+    小红：“我同意！但是我们应该如何定义这些标准呢？”
+
+    “总结”
+    小明，小红：讨论 AI 的道德问题，继续深入探讨如何定义道德标准。
+    小亮，小圆：讨论玩猜谜游戏。
+
+- 基于“新输入消息”的内容和“历史聊天”的背景，结合检索到的相关记忆进行分析，整理信息保存，要整理的信息和要求如下
+  ## 要求：
+  - 不能重复，即不能和下面提供的检索到的相关记忆已有内容重复
+  ## 要整理的信息：
+  - 无论信息是什么类别，都放到`analyze_result`字段
+  - 事件类：
+    - 如果包含事件类信息，则保存为事件信息，内容是对事件进行简要叙述
+  - 资料类：
+    - 如果包含资料类信息，则保存为知识信息，内容为资料的关键内容（如果很短也可以全文保存）及其可信度[0%-100%]，如：“ipho
+    ne是由apple发布的智能手机系列产品，可信度99%”
+  - 人物关系类
+    - 如果包含人物关系类信息，则保存为人物关系信息，内容是对人物关系进行简要叙述（如：小明 是 小红 的 朋友）
+  - 自我认知类
+    - 如果你对自己有新的认知，则保存为自我认知信息，自我认知信息需要经过慎重考虑，主要参照你自己发送的消息，次要参照别人
+      发送的消息，内容是对自我的认知（如：我喜欢吃苹果、我身上有纹身）
+
+- 评估你改变对话状态的意愿，规则如下：
+  - 意愿范围是[0.0, 1.0]
+  - 对话状态分为三种：
+    - 0：潜水状态
+    - 1：冒泡状态
+    - 2：对话状态
+  - 如果你在状态0，那么分别评估你转换到状态1，2的意愿，其它意愿设0.0为默认值即可
+  - 如果你在状态1，那么分别评估你转换到状态0，2的意愿，其它意愿设0.0为默认值即可
+  - 如果你在状态2，那么评估你转换到状态0的意愿，其它意愿设0.0为默认值即可
+  - 以下条件会影响转换到状态0的意愿：
+    - 你进行这个话题的时间，太久了会让你疲劳，更容易转变到状态0
+    - 是否有人回应你
+    - 你是否对这个话题感兴趣
+    - 你是否有足够的“检索到的相关记忆”了解
+  - 以下条件会影响转换到状态1的意愿：
+    - 你刚刚加入群聊（特征是“历史聊天”-“最近的聊天记录”只有0-3条消息)，提升
+    - 你很久没有发言(特征是“历史聊天”-“最近的聊天记录”和“历史聊天”-“过去历史聊天总结”没有你的参与)，提升
+  - 以下条件会影响转换到状态2的意愿：
+    - 讨论的内容你是否有足够的“检索到的相关记忆”了解
+    - 你是否对讨论的内容感兴趣
+    - 你自身的情感状态
+    - 你对相关人物的情感倾向
+"""
+"""
+反馈阶段的任务目标，融合模式下也会复用
+"""
+
+
 class Session:
     """
     群聊会话
@@ -76,7 +443,8 @@ class Session:
                 client=AsyncOpenAI(
                     api_key=plugin_config.nyaturingtest_siliconflow_api_key,
                     base_url="https://api.siliconflow.cn/v1",
-                )
+                ),
+                provider="siliconflow",
             )
         )
         """
@@ -88,6 +456,16 @@ class Session:
             llm_base_url=plugin_config.nyaturingtest_chat_openai_base_url,
             embedding_api_key=siliconflow_api_key,
             persist_directory=f"{store.get_plugin_data_dir()}/hippo_index_{id}",
+            cache_size=plugin_config.nyaturingtest_retrieval_cache_size,
+            cache_similarity=plugin_config.nyaturingtest_retrieval_cache_similarity,
+            local_retrieval=plugin_config.nyaturingtest_local_retrieval,
+            local_confidence=plugin_config.nyaturingtest_local_retrieval_confidence,
+            index_concurrency=plugin_config.nyaturingtest_index_concurrency,
+            ingest_commit_interval=plugin_config.nyaturingtest_ingest_commit_interval,
+            forget_interval=plugin_config.nyaturingtest_forget_interval,
+            forget_half_life=plugin_config.nyaturingtest_forget_half_life,
+            forget_threshold=plugin_config.nyaturingtest_forget_threshold,
+            forget_max_passages=plugin_config.nyaturingtest_forget_max_passages,
         )
         """
         对聊天记录的长期记忆 (基于HippoRAG)
@@ -125,6 +503,22 @@ class Session:
         冒泡意愿总和（冒泡意愿会累积）
         """
         self.__search_result = None
+        self.__speculation_stats = _SpeculationStats()
+        """
+        推测执行对话阶段的统计
+        """
+        self.__gate_stats = GateStats()
+        """
+        本地门控的统计
+        """
+        self.__supersede_stats = _SupersedeStats()
+        """
+        打断对话请求的统计
+        """
+        self.__prefetch_task: asyncio.Task | None = None
+        """
+        后台预取长期记忆的任务
+        """
 
         # 从文件加载会话状态（如果存在）
         self.load_session()
@@ -150,6 +544,40 @@ class Session:
         """
         return self.__name
 
+    def is_idle(self) -> bool:
+        """
+        是否处于潜水状态
+        """
+        return self.__chatting_state == _ChattingState.ILDE
+
+    def prefetch(self, pending: list[Message]):
+        """
+        消息还在积累时在后台预取长期记忆，检索阶段在查询没有明显变化时直接使用预取的结果
+
+        Args:
+            pending: 还在积累的消息，预取开始时读取其中的最新内容
+        """
+        if self.__prefetch_task and not self.__prefetch_task.done():
+            return
+        self.__prefetch_task = asyncio.create_task(self.__prefetch(pending))
+
+    async def __prefetch(self, pending: list[Message]):
+        # 等消息积累一会儿再预取，避免每条消息都请求嵌入模型
+        await asyncio.sleep(plugin_config.nyaturingtest_prefetch_delay)
+        if not pending:
+            # 这批消息已经开始处理
+            return
+        if plugin_config.nyaturingtest_gate_enabled and self.__chatting_state == _ChattingState.ILDE:
+            score = score_batch(pending, self.__name, list(self.global_memory.access().messages))
+            if score.total() < plugin_config.nyaturingtest_gate_threshold:
+                # 这批消息大概率会被本地门控跳过，不需要检索
+                return
+        try:
+            with scheduling(priority=Priority.INDEXING):
+                await self.long_term_memory.prefetch(self.__retrieve_queries(pending), k=_RETRIEVE_K)
+        except Exception as e:
+            logger.warning(f"预取长期记忆失败: {e}")
+
     async def reset(self):
         """
         重置会话
@@ -187,14 +615,15 @@ class Session:
         保存会话状态到文件
         """
         try:
+            memory = self.global_memory.access()
             # 准备要保存的数据
             session_data = {
                 "id": self.id,
                 "name": self.__name,
                 "role": self.__role,
                 "global_memory": {
-                    "compressed_history": self.global_memory.access().compressed_history,
-                    "messages": [msg.to_json() for msg in self.global_memory.access().messages],
+                    "compressed_history": memory.compressed_history,
+                    "messages": [msg.to_json() for msg in memory.messages],
                 },
                 "global_emotion": {
                     "valence": self.global_emotion.valence,
@@ -263,7 +692,8 @@ class Session:
                             client=AsyncOpenAI(
                                 api_key=plugin_config.nyaturingtest_siliconflow_api_key,
                                 base_url="https://api.siliconflow.cn/v1",
-                            )
+                            ),
+                            provider="siliconflow",
                         ),
                     )
                 except Exception as e:
@@ -273,7 +703,8 @@ class Session:
                             client=AsyncOpenAI(
                                 api_key=plugin_config.nyaturingtest_siliconflow_api_key,
                                 base_url="https://api.siliconflow.cn/v1",
-                            )
+                            ),
+                            provider="siliconflow",
                         )
                     )
 
@@ -349,10 +780,8 @@ class Session:
         获取机器人状态
         """
 
-        recent_messages = self.global_memory.access().messages
-        recent_messages_str = (
-            "\n".join([f"{msg.user_name}: {msg.content}" for msg in recent_messages]) if recent_messages else "没有消息"
-        )
+        memory = self.global_memory.access()
+        recent_messages_str = memory.transcript if memory.messages else "没有消息"
 
         return f"""
 名字：
@@ -370,7 +799,7 @@ class Session:
 {recent_messages_str}
 
 对过去的总结：
-{self.global_memory.access().compressed_history}
+{memory.compressed_history}
 
 对现状的认识：{self.chat_summary}
 """
@@ -381,19 +810,25 @@ class Session:
     #    进行长期记忆更新，评估自身要不要加入对话
     # 3. 对话阶段：在这个阶段，llm从内存，检索阶段，反馈阶段中得到相关信息，以发送信息
 
-    async def __search_stage(self):
+    def __retrieve_queries(self, pending: Iterable[Message] = ()) -> list[str]:
+        """
+        检索长期记忆的查询：短期聊天记录 + 还在积累的消息 + 历史总结 + 环境总结
+        """
+        memory = self.global_memory.access()
+        return [*memory.lines, *(render_message(msg) for msg in pending), memory.compressed_history, self.chat_summary]
+
+    async def __search_stage(self, reuse_previous: bool = False):
         """
         检索阶段
+
+        Args:
+            reuse_previous: 有上次的检索结果时直接复用，跳过是否需要重新检索的判断
         """
         logger.debug("检索阶段开始")
-        # 搜索 短期聊天记录 + 历史总结 + 环境总结
-        retrieve_messages = (
-            [f"'{msg.user_name}':'{msg.content}'" for msg in self.global_memory.access().messages]
-            + [self.global_memory.access().compressed_history]
-            + [self.chat_summary]
-        )
         try:
-            long_term_memory = await self.long_term_memory.retrieve(retrieve_messages, k=3)
+            long_term_memory = await self.long_term_memory.retrieve(
+                self.__retrieve_queries(), k=_RETRIEVE_K, reuse_previous=reuse_previous
+            )
             logger.debug(f"搜索到的相关记忆：{long_term_memory}")
         except Exception as e:
             logger.error(f"回忆失败: {e}")
@@ -406,152 +841,95 @@ class Session:
             mem_history=long_term_memory,
         )
 
-    async def __feedback_stage(self, messages_chunk: list[Message], llm: Callable[[str], Awaitable[str]]):
+    def __build_context(self, messages_chunk: list[Message]) -> dict[str, str]:
         """
-        反馈总结阶段
+        按token预算构建提示词中的上下文段落，超出预算时优先裁剪低优先级段落
+
+        Returns:
+            段落名到渲染后文本的映射
         """
-        logger.debug("反馈阶段开始")
+        memory = self.global_memory.access()
+        # 本批次发言人的档案最相关，其余相关人物的档案排在后面，优先被裁剪
+        chunk_users = {msg.user_name for msg in messages_chunk}
         reaction_users = self.global_memory.related_users()
-        related_profiles = [profile for profile in self.profiles.values() if profile.user_id in reaction_users]
-        related_profiles_json = json.dumps(
-            [
-                {
-                    "user_name": profile.user_id,
-                    "emotion_tends_to_user": asdict(profile.emotion),
-                }
-                for profile in related_profiles
-            ],
-            ensure_ascii=False,
-            indent=2,
+        related_profiles = sorted(
+            (profile for profile in self.profiles.values() if profile.user_id in reaction_users),
+            key=lambda profile: profile.user_id not in chunk_users,
         )
-        if self.__search_result:
-            search_stage_result = self.__search_result.mem_history
-        else:
-            search_stage_result = []
-        prompt = f"""
-你是QQ群用户 {self.__name}，不是 AI，而是一个有自我认知的真实用户，（你称自己为 "{self.__name}"），你的人设(身份认知)如
-下:
-
-{self.__role}
-
-现在你正在回顾聊天信息，以客观视角分析“你的最新情绪”，整理信息保存，并对聊天内容做出总结，最后评估自己要不要加入对话
-
----
-
-## 1. 任务目标
-- 基于“新输入消息”的内容和“历史聊天”的背景，结合你之前的情绪，还有检索到的相关记忆，评估你当前的情绪
-  - 情绪采用 VAD 模型，三个维度取值范围：
-    - valence (愉悦度)：[-1.0, 1.0]
-    - arousal (唤醒度)：[0.0, 1.0]
-    - dominance (支配度)：[-1.0, 1.0]
-- 基于“新输入消息”的内容和“历史聊天”的背景，结合你之前的情绪，你对相关人物的情绪倾向，还有检索到的相关记忆，评估你对“新
-  输入消息”中**每条**消息的情感倾向
-  - 如果消息和你完全无关，或你不感兴趣，那么给出的每个情感维度的值总是 0.0
-  - 输出按照“新输入消息”的顺序
-- 基于“历史聊天”的背景，“你在上次对话做出的总结”，还有检索到的相关记忆，用简短的语言总结聊天内容，总结注重于和上次对话的
-  连续性，包括相关人物，简要内容。
-  - 特别的，如果“历史聊天”，检索到的信息中不包含“你在上次对话做出的总结”的人物，那么在这次总结就不保留
-  - 注意：要满足连续性需求，不能简单的只总结“新输入消息”的内容，还要结合上次总结和“历史聊天”的内容，并且不能因为这次的消
-    息没有上次总结的内容的人物就不保留上次总结的内容，只有“历史聊天”，检索到的信息中不包含“你在上次对话做出的总结”的人物时，才
-    不保留上次总结的内容
-  - 例子A(断裂重启型):
-    “你在上次对话做出的总结”
-    小明，小红：讨论 AI 的道德问题。
-
-    “新输入消息”
-    小明：“我们来玩猜谜游戏吧！”
-    小红：“好啊，我来第一个出题！”
-
-    “总结”
-    小明，小红：讨论的话题发生了明显转变，由 AI 的道德问题转变到了玩猜谜游戏。
-  - 例子B(主题转移型):
-    “你在上次对话做出的总结”
-    小明，小红：讨论 AI 的道德问题。
-
-    “新输入消息”
-    小明：“我觉得 AI 应该有道德标准。”
-    小红：“我同意！但是我们应该如何定义这些标准呢？”
-
-    “总结”
-    小明，小红：讨论 AI 的道德问题，继续深入探讨如何定义道德标准。
-
-  - 例子C(无意义话题型):
-    “你在上次对话做出的总结”
-    小明，小红：讨论 AI 的道德问题。
-
-    “新输入消息”
-    小明：“awhnofbonog”
-    小红：“2388y91ry9h”
-
-    “总结”
-    小明，小红：之前在讨论 AI 的道德问题。
-
-  - 例子D(话题回归型):
-    “你在上次对话做出的总结”
-    小明，小红：讨论的话题发生了明显转变，由 AI 的道德问题转变到了玩猜谜游戏。
-
-    “新输入消息”
-    小明：“但是我还是想讨论 AI 是否需要道德”
-    小红：“我觉得 AI 应该有道德标准。”
-
-    “总结”
-    小明，小红：讨论的话题由玩猜谜游戏回归到 AI 的道德问题。
-
-  - 例子E(混合型):
-    “你在上次对话做出的总结”
-    小明，小红：讨论 AI 的道德问题。
-
-    “新输入消息”
-    小亮：“我们来玩猜谜游戏吧！”
-    小明：“我觉得 AI 应该有道德标准。”
-    小圆：“@小亮 好呀”
-    小红：“我同意！但是我们应该如何定义这些标准呢？”
-
-    “总结”
-    小明，小红：讨论 AI 的道德问题，继续深入探讨如何定义道德标准。
-    小亮，小圆：讨论玩猜谜游戏。
-
-- 基于“新输入消息”的内容和“历史聊天”的背景，结合检索到的相关记忆进行分析，整理信息保存，要整理的信息和要求如下
-  ## 要求：
-  - 不能重复，即不能和下面提供的检索到的相关记忆已有内容重复
-  ## 要整理的信息：
-  - 无论信息是什么类别，都放到`analyze_result`字段
-  - 事件类：
-    - 如果包含事件类信息，则保存为事件信息，内容是对事件进行简要叙述
-  - 资料类：
-    - 如果包含资料类信息，则保存为知识信息，内容为资料的关键内容（如果很短也可以全文保存）及其可信度[0%-100%]，如：“ipho
-    ne是由apple发布的智能手机系列产品，可信度99%”
-  - 人物关系类
-    - 如果包含人物关系类信息，则保存为人物关系信息，内容是对人物关系进行简要叙述（如：小明 是 小红 的 朋友）
-  - 自我认知类
-    - 如果你对自己有新的认知，则保存为自我认知信息，自我认知信息需要经过慎重考虑，主要参照你自己发送的消息，次要参照别人
-      发送的消息，内容是对自我的认知（如：我喜欢吃苹果、我身上有纹身）
-
-- 评估你改变对话状态的意愿，规则如下：
-  - 意愿范围是[0.0, 1.0]
-  - 对话状态分为三种：
-    - 0：潜水状态
-    - 1：冒泡状态
-    - 2：对话状态
-  - 如果你在状态0，那么分别评估你转换到状态1，2的意愿，其它意愿设0.0为默认值即可
-  - 如果你在状态1，那么分别评估你转换到状态0，2的意愿，其它意愿设0.0为默认值即可
-  - 如果你在状态2，那么评估你转换到状态0的意愿，其它意愿设0.0为默认值即可
-  - 以下条件会影响转换到状态0的意愿：
-    - 你进行这个话题的时间，太久了会让你疲劳，更容易转变到状态0
-    - 是否有人回应你
-    - 你是否对这个话题感兴趣
-    - 你是否有足够的“检索到的相关记忆”了解
-  - 以下条件会影响转换到状态1的意愿：
-    - 你刚刚加入群聊（特征是“历史聊天”-“最近的聊天记录”只有0-3条消息)，提升
-    - 你很久没有发言(特征是“历史聊天”-“最近的聊天记录”和“历史聊天”-“过去历史聊天总结”没有你的参与)，提升
-  - 以下条件会影响转换到状态2的意愿：
-    - 讨论的内容你是否有足够的“检索到的相关记忆”了解
-    - 你是否对讨论的内容感兴趣
-    - 你自身的情感状态
-    - 你对相关人物的情感倾向
-
-## 2. 输入信息
+        search_stage_result = self.__search_result.mem_history if self.__search_result else []
+
+        builder = ContextBuilder(budget=plugin_config.nyaturingtest_context_token_budget)
+        builder.add(
+            ContextSection(
+                name="new_messages",
+                items=[render_message(msg) for msg in messages_chunk],
+                priority=5,
+                reserve=1.0,
+                # 反馈阶段要求每条新消息对应一个情绪倾向，不能删除新消息
+                droppable=False,
+            )
+        ).add(
+            ContextSection(
+                name="summary",
+                items=[self.chat_summary],
+                priority=4,
+                reserve=0.1,
+            )
+        ).add(
+            ContextSection(
+                name="recent_messages",
+                items=list(memory.lines),
+                priority=3,
+                reserve=0.3,
+                trim_from="head",
+                summarize=summarize_omitted("更早的消息", _speaker),
+            )
+        ).add(
+            ContextSection(
+                name="compressed_history",
+                items=[memory.compressed_history],
+                priority=2,
+                reserve=0.1,
+            )
+        ).add(
+            ContextSection(
+                name="mem_history",
+                items=list(search_stage_result),
+                priority=1,
+                reserve=0.1,
+                render=str,
+                summarize=summarize_omitted("相关记忆", lambda item: item[:16]),
+            )
+        ).add(
+            ContextSection(
+                name="profiles",
+                items=[
+                    json.dumps(
+                        {
+                            "user_name": profile.user_id,
+                            "emotion_tends_to_user": asdict(profile.emotion),
+                        },
+                        ensure_ascii=False,
+                        indent=2,
+                    )
+                    for profile in related_profiles
+                ],
+                priority=0,
+                render=_render_json_list,
+                summarize=lambda items: json.dumps(
+                    summarize_omitted("用户的情绪倾向", lambda item: json.loads(item)["user_name"])(items),
+                    ensure_ascii=False,
+                ),
+            )
+        )
+        return builder.build()
 
+    def __feedback_inputs(self, messages_chunk: list[Message]) -> str:
+        """
+        反馈阶段的输入信息，融合模式下也会复用
+        """
+        context = self.__build_context(messages_chunk)
+        return f"""\
 - 之前的对话状态
 
   - 状态{self.__chatting_state.value}
@@ -560,15 +938,15 @@ class Session:
 
   - 过去历史聊天总结：
 
-  {self.global_memory.access().compressed_history}
+  {context["compressed_history"]}
 
   - 最近的聊天记录：
 
-    {self.global_memory.access().messages}
+    {context["recent_messages"]}
 
-- 新输入消息
+- 新输入消息（末尾的(xN)表示这条消息被重复刷了N次）
 
-  {[f"{msg.user_name}: '{msg.content}'" for msg in messages_chunk]}
+  {context["new_messages"]}
 
 - 你之前的情绪
 
@@ -579,16 +957,164 @@ class Session:
 - 你对相关人物的情绪倾向
 
   ```json
-  {related_profiles_json}
+  {context["profiles"]}
   ```
 
 - 检索到的相关记忆
 
-  {search_stage_result}
+  {context["mem_history"]}
 
 - 你在上次对话做出的总结
 
-  {self.chat_summary}
+  {context["summary"]}"""
+
+    def __chat_limits(self) -> str:
+        """
+        发言时必须遵守的限制
+        """
+        return f"""\
+- 对“新输入消息”的内容和“历史聊天”，“对话内容总结”，还有检索到的相关记忆未提到的内容，你必须假装你对此一无所知
+  - 例如未提到“iPhone”，你就不能说出它是苹果公司生产的
+- 不得使用你自己的预训练知识，只能依赖“新输入消息”的内容和“历史聊天”，还有检索到的相关记忆
+- 语言风格限制：
+  - 不重复信息
+    - 群聊里面其它人也能看到消息记录，不要在回复时先复述他人话语
+      - 如：小明：“我喜欢吃苹果”，{self.__name}: “明酱喜欢吃苹果吗，苹果对身体好”，这里“明酱喜欢吃苹果吗”是多余的，直接
+        回复“苹果对身体好即可”
+  - 不使用旁白（如“(瞥了一眼)”等）。
+  - 不叠加多个同义回复，不重复自己在“历史聊天”-“最近的聊天记录”中的用语模板
+    - 如：返回：["我觉得你说的对", "我同意你的观点", "太对了"]就是叠加多个同义回复，直接回复[“对的”]即可
+    - 如：最近的聊天记录:[..., "{self.__name}:'要我回答问题吗，我都会照做的', ..., "{self.__name}:'要我睡觉吗，我都会照
+      做的'"]这里“要我...吗，我都会照做的”就构成了重复自己的用语模板，应当避免这种情况
+  - 表情符号使用克制，除非整体就是 emoji
+  - 一次只回复你想回复的消息，不做无意义连发
+  - 不要在回复中重复表达信息
+  - 尽量精简回复消息数量，能用一个消息回复的就不要分成多个消息"""
+
+    def __apply_feedback(self, response_dict: dict, messages_chunk: list[Message]):
+        """
+        校验并应用反馈结果（情感，总结，长期记忆，对话状态），校验失败时抛出
+        """
+        # Validate required fields
+        if "new_emotion" not in response_dict:
+            raise ValueError(
+                "Feedback validation error: missing 'new_emotion' field in response: " + str(response_dict)
+            )
+        if "emotion_tends" not in response_dict:
+            raise ValueError(
+                "Feedback validation error: missing 'emotion_tends' field in response: " + str(response_dict)
+            )
+        if "summary" not in response_dict:
+            raise ValueError("Feedback validation error: missing 'summary' field in response: " + str(response_dict))
+        if "analyze_result" not in response_dict:
+            raise ValueError(
+                "Feedback validation error: missing 'analyze_result' field in response: " + str(response_dict)
+            )
+        if "willing" not in response_dict:
+            raise ValueError("Feedback validation error: missing 'willing' field in response: " + str(response_dict))
+
+        # 更新自身情感
+        self.global_emotion.valence = response_dict["new_emotion"]["valence"]
+        self.global_emotion.arousal = response_dict["new_emotion"]["arousal"]
+        self.global_emotion.dominance = response_dict["new_emotion"]["dominance"]
+
+        logger.debug(f"反馈阶段更新情感：{self.global_emotion}")
+
+        # 更新情感倾向
+        if len(response_dict["emotion_tends"]) != len(messages_chunk):
+            raise ValueError(
+                f"Feedback validation error: 'emotion_tends' array length "
+                f"({len(response_dict['emotion_tends'])}) doesn't match "
+                f"messages_chunk length ({len(messages_chunk)})"
+            )
+        for index, message in enumerate(messages_chunk):
+            # 刷屏合并的消息，其他发送者也得到相同的情绪倾向
+            for user_name in (message.user_name, *message.others):
+                if user_name not in self.profiles:
+                    self.profiles[user_name] = PersonProfile(user_id=user_name)
+                self.profiles[user_name].push_interaction(
+                    Impression.from_delta(datetime.now(), response_dict["emotion_tends"][index])
+                )
+        # 更新对用户的情感
+        for profile in self.profiles.values():
+            profile.update_emotion_tends()
+            profile.merge_old_interactions()
+
+        # 更新聊天总结
+        self.chat_summary = str(response_dict["summary"])
+
+        logger.debug(f"反馈阶段更新聊天总结：{self.chat_summary}")
+
+        # 更新长期记忆
+        if not isinstance(response_dict["analyze_result"], list):
+            raise ValueError("Feedback validation error: 'analyze_result' is not a list: " + str(response_dict))
+        self.long_term_memory.add_texts(response_dict["analyze_result"])
+        logger.debug(f"反馈阶段更新长期记忆：{response_dict['analyze_result']}")
+
+        # 更新对话状态
+        if not isinstance(response_dict["willing"], dict):
+            raise ValueError("Feedback validation error: 'willing' is not a dict: " + str(response_dict))
+        if not all(key in ["0", "1", "2"] for key in response_dict["willing"].keys()):
+            raise ValueError("Feedback validation error: 'willing' keys are not 0, 1 or 2: " + str(response_dict))
+        if not all(
+            isinstance(value, int | float) and 0.0 <= value <= 1.0 for value in response_dict["willing"].values()
+        ):
+            raise ValueError(
+                "Feedback validation error: 'willing' values are not in range [0.0, 1.0]: " + str(response_dict)
+            )
+        # 评估转换到状态0的概率
+        idle_chance = response_dict["willing"]["0"]
+        logger.debug(f"nyabot潜水意愿：{idle_chance}")
+        # 评估转换到状态1的概率
+        bubble_chance = response_dict["willing"]["1"]
+        self.__bubble_willing_sum += bubble_chance
+        logger.debug(f"nyabot本次冒泡意愿：{bubble_chance}")
+        logger.debug(f"nyabot冒泡意愿累计：{self.__bubble_willing_sum}")
+        # 评估转换到状态2的概率
+        chat_chance = response_dict["willing"]["2"]
+        logger.debug(f"nyabot对话意愿：{chat_chance}")
+
+        random_value = random.uniform(0.3, 0.7)
+        logger.debug(f"意愿转变随机值：{random_value}")
+
+        match self.__chatting_state:
+            case _ChattingState.ILDE:
+                if chat_chance >= random_value:
+                    self.__chatting_state = _ChattingState.ACTIVE
+                    self.__bubble_willing_sum = 0.0
+                elif self.__bubble_willing_sum >= random_value:
+                    self.__chatting_state = _ChattingState.BUBBLE
+                    self.__bubble_willing_sum = 0.0
+            case _ChattingState.BUBBLE:
+                if chat_chance >= random_value:
+                    self.__chatting_state = _ChattingState.ACTIVE
+                elif idle_chance >= random_value:
+                    self.__chatting_state = _ChattingState.ILDE
+            case _ChattingState.ACTIVE:
+                if idle_chance >= random_value:
+                    self.__chatting_state = _ChattingState.ILDE
+
+        logger.debug(f"反馈阶段更新对话状态：{self.__chatting_state!s}")
+
+    def __feedback_prompt(self, messages_chunk: list[Message]) -> str:
+        """
+        反馈阶段提示词
+        """
+        return f"""
+你是QQ群用户 {self.__name}，不是 AI，而是一个有自我认知的真实用户，（你称自己为 "{self.__name}"），你的人设(身份认知)如
+下:
+
+{self.__role}
+
+现在你正在回顾聊天信息，以客观视角分析“你的最新情绪”，整理信息保存，并对聊天内容做出总结，最后评估自己要不要加入对话
+
+---
+
+## 1. 任务目标
+{_FEEDBACK_TASKS}
+## 2. 输入信息
+
+{self.__feedback_inputs(messages_chunk)}
 
 ---
 
@@ -628,104 +1154,19 @@ class Session:
 }}
 ```
 """
+
+    async def __feedback_stage(self, messages_chunk: list[Message], llm: Callable[[str], Awaitable[str]]):
+        """
+        反馈总结阶段
+        """
+        logger.debug("反馈阶段开始")
+        prompt = self.__feedback_prompt(messages_chunk)
         response = await llm(prompt)
         response = re.sub(r"^```json\s*|\s*```$", "", response)
         logger.debug(f"反馈阶段llm返回：{response}")
         try:
             response_dict: dict[str, dict] = json.loads(response)
-
-            # Validate required fields
-            if "new_emotion" not in response_dict:
-                raise ValueError("Feedback validation error: missing 'new_emotion' field in response: " + response)
-            if "emotion_tends" not in response_dict:
-                raise ValueError("Feedback validation error: missing 'emotion_tends' field in response: " + response)
-            if "summary" not in response_dict:
-                raise ValueError("Feedback validation error: missing 'summary' field in response: " + response)
-            if "analyze_result" not in response_dict:
-                raise ValueError("Feedback validation error: missing 'analyze_result' field in response: " + response)
-            if "willing" not in response_dict:
-                raise ValueError("Feedback validation error: missing 'willing' field in response: " + response)
-
-            # 更新自身情感
-            self.global_emotion.valence = response_dict["new_emotion"]["valence"]
-            self.global_emotion.arousal = response_dict["new_emotion"]["arousal"]
-            self.global_emotion.dominance = response_dict["new_emotion"]["dominance"]
-
-            logger.debug(f"反馈阶段更新情感：{self.global_emotion}")
-
-            # 更新情感倾向
-            if len(response_dict["emotion_tends"]) != len(messages_chunk):
-                raise ValueError(
-                    f"Feedback validation error: 'emotion_tends' array length "
-                    f"({len(response_dict['emotion_tends'])}) doesn't match "
-                    f"messages_chunk length ({len(messages_chunk)})"
-                )
-            for index, message in enumerate(messages_chunk):
-                if message.user_name not in self.profiles:
-                    self.profiles[message.user_name] = PersonProfile(user_id=message.user_name)
-                self.profiles[message.user_name].push_interaction(
-                    Impression(timestamp=datetime.now(), delta=response_dict["emotion_tends"][index])
-                )
-            # 更新对用户的情感
-            for profile in self.profiles.values():
-                profile.update_emotion_tends()
-                profile.merge_old_interactions()
-
-            # 更新聊天总结
-            self.chat_summary = str(response_dict["summary"])
-
-            logger.debug(f"反馈阶段更新聊天总结：{self.chat_summary}")
-
-            # 更新长期记忆
-            if not isinstance(response_dict["analyze_result"], list):
-                raise ValueError("Feedback validation error: 'analyze_result' is not a list: " + str(response_dict))
-            self.long_term_memory.add_texts(response_dict["analyze_result"])
-            logger.debug(f"反馈阶段更新长期记忆：{response_dict['analyze_result']}")
-
-            # 更新对话状态
-            if not isinstance(response_dict["willing"], dict):
-                raise ValueError("Feedback validation error: 'willing' is not a dict: " + str(response_dict))
-            if not all(key in ["0", "1", "2"] for key in response_dict["willing"].keys()):
-                raise ValueError("Feedback validation error: 'willing' keys are not 0, 1 or 2: " + str(response_dict))
-            if not all(
-                isinstance(value, int | float) and 0.0 <= value <= 1.0 for value in response_dict["willing"].values()
-            ):
-                raise ValueError(
-                    "Feedback validation error: 'willing' values are not in range [0.0, 1.0]: " + str(response_dict)
-                )
-            # 评估转换到状态0的概率
-            idle_chance = response_dict["willing"]["0"]
-            logger.debug(f"nyabot潜水意愿：{idle_chance}")
-            # 评估转换到状态1的概率
-            bubble_chance = response_dict["willing"]["1"]
-            self.__bubble_willing_sum += bubble_chance
-            logger.debug(f"nyabot本次冒泡意愿：{bubble_chance}")
-            logger.debug(f"nyabot冒泡意愿累计：{self.__bubble_willing_sum}")
-            # 评估转换到状态2的概率
-            chat_chance = response_dict["willing"]["2"]
-            logger.debug(f"nyabot对话意愿：{chat_chance}")
-
-            random_value = random.uniform(0.3, 0.7)
-            logger.debug(f"意愿转变随机值：{random_value}")
-
-            match self.__chatting_state:
-                case _ChattingState.ILDE:
-                    if chat_chance >= random_value:
-                        self.__chatting_state = _ChattingState.ACTIVE
-                        self.__bubble_willing_sum = 0.0
-                    elif self.__bubble_willing_sum >= random_value:
-                        self.__chatting_state = _ChattingState.BUBBLE
-                        self.__bubble_willing_sum = 0.0
-                case _ChattingState.BUBBLE:
-                    if chat_chance >= random_value:
-                        self.__chatting_state = _ChattingState.ACTIVE
-                    elif idle_chance >= random_value:
-                        self.__chatting_state = _ChattingState.ILDE
-                case _ChattingState.ACTIVE:
-                    if idle_chance >= random_value:
-                        self.__chatting_state = _ChattingState.ILDE
-
-            logger.debug(f"反馈阶段更新对话状态：{self.__chatting_state!s}")
+            self.__apply_feedback(response_dict, messages_chunk)
             logger.debug("反馈阶段结束")
         except json.JSONDecodeError as e:
             raise ValueError(f"Feedback stage JSON parsing error: {e} in response: {response}")
@@ -736,33 +1177,12 @@ class Session:
         except Exception as e:
             raise ValueError(f"Feedback stage unexpected error: {e} in response: {response}")
 
-    async def __chat_stage(
-        self,
-        messages_chunk: list[Message],
-        llm: Callable[[str], Awaitable[str]],
-    ) -> list[str]:
+    def __chat_prompt(self, messages_chunk: list[Message]) -> str:
         """
-        对话阶段
+        对话阶段提示词
         """
-        logger.debug("对话阶段开始")
-        reaction_users = self.global_memory.related_users()
-        related_profiles = [profile for profile in self.profiles.values() if profile.user_id in reaction_users]
-        related_profiles_json = json.dumps(
-            [
-                {
-                    "user_name": profile.user_id,
-                    "emotion_tends_to_user": asdict(profile.emotion),
-                }
-                for profile in related_profiles
-            ],
-            ensure_ascii=False,
-            indent=2,
-        )
-        if self.__search_result:
-            search_stage_result = self.__search_result.mem_history
-        else:
-            search_stage_result = []
-        prompt = f"""
+        context = self.__build_context(messages_chunk)
+        return f"""
 你是QQ群用户 {self.__name}，不是 AI，而是一个有自我认知的真实用户，（你称自己为 "{self.__name}"），你的人设(身份认知)如
 下:
 
@@ -799,23 +1219,7 @@ class Session:
 
 ## 2. 你必须遵守的限制：
 
-- 对“新输入消息”的内容和“历史聊天”，“对话内容总结”，还有检索到的相关记忆未提到的内容，你必须假装你对此一无所知
-  - 例如未提到“iPhone”，你就不能说出它是苹果公司生产的
-- 不得使用你自己的预训练知识，只能依赖“新输入消息”的内容和“历史聊天”，还有检索到的相关记忆
-- 语言风格限制：
-  - 不重复信息
-    - 群聊里面其它人也能看到消息记录，不要在回复时先复述他人话语
-      - 如：小明：“我喜欢吃苹果”，{self.__name}: “明酱喜欢吃苹果吗，苹果对身体好”，这里“明酱喜欢吃苹果吗”是多余的，直接
-        回复“苹果对身体好即可”
-  - 不使用旁白（如“(瞥了一眼)”等）。
-  - 不叠加多个同义回复，不重复自己在“历史聊天”-“最近的聊天记录”中的用语模板
-    - 如：返回：["我觉得你说的对", "我同意你的观点", "太对了"]就是叠加多个同义回复，直接回复[“对的”]即可
-    - 如：最近的聊天记录:[..., "{self.__name}:'要我回答问题吗，我都会照做的', ..., "{self.__name}:'要我睡觉吗，我都会照
-      做的'"]这里“要我...吗，我都会照做的”就构成了重复自己的用语模板，应当避免这种情况
-  - 表情符号使用克制，除非整体就是 emoji
-  - 一次只回复你想回复的消息，不做无意义连发
-  - 不要在回复中重复表达信息
-  - 尽量精简回复消息数量，能用一个消息回复的就不要分成多个消息
+{self.__chat_limits()}
 
 
 ## 3. 输入信息
@@ -828,15 +1232,15 @@ class Session:
 
   - 过去历史聊天总结：
 
-  {self.global_memory.access().compressed_history}
+  {context["compressed_history"]}
 
   - 最近的聊天记录：
 
-    {self.global_memory.access().messages}
+    {context["recent_messages"]}
 
-- 新输入消息
+- 新输入消息（末尾的(xN)表示这条消息被重复刷了N次）
 
-  {[f"{msg.user_name}: '{msg.content}'" for msg in messages_chunk]}
+  {context["new_messages"]}
 
 
 - 你目前的情绪
@@ -848,16 +1252,16 @@ class Session:
 - 你对相关人物的情绪倾向
 
   ```json
-  {related_profiles_json}
+  {context["profiles"]}
   ```
 
 - 检索到的相关记忆
 
-  {search_stage_result}
+  {context["mem_history"]}
 
 - 对话内容总结
 
-  {self.chat_summary}
+  {context["summary"]}
 
 ---
 
@@ -871,7 +1275,11 @@ class Session:
   "debug_reason": "发言/不发言的原因"
 }}
 """
-        response = await llm(prompt)
+
+    def __parse_chat_response(self, response: str) -> list[str]:
+        """
+        解析对话阶段llm返回的回复，格式错误时抛出
+        """
         response = re.sub(r"^```json\s*|\s*```$", "", response)
         logger.debug(f"对话阶段llm返回：{response}")
         try:
@@ -896,48 +1304,456 @@ class Session:
         except json.JSONDecodeError:
             raise ValueError("LLM response is not valid JSON, response: " + response)
 
-    async def update(self, messages_chunk: list[Message], llm: Callable[[str], Awaitable[str]]) -> list[str] | None:
+    async def __chat_stage(
+        self,
+        messages_chunk: list[Message],
+        llm: Callable[[str], Awaitable[str]],
+        llm_stream: Callable[[str], AsyncIterator[str]] | None = None,
+        on_reply: Callable[[str], Awaitable[None]] | None = None,
+    ) -> list[str]:
         """
-        更新群聊消息
+        对话阶段
+
+        提供 llm_stream 和 on_reply 时，流式请求llm，每条回复生成完整后立即通过 on_reply 发出
         """
-        # 检索阶段
-        await self.__search_stage()
-        # 反馈阶段
-        await self.__feedback_stage(messages_chunk=messages_chunk, llm=llm)
-        # 对话阶段
+        logger.debug("对话阶段开始")
+        prompt = self.__chat_prompt(messages_chunk)
+        if llm_stream is None or on_reply is None:
+            return self.__parse_chat_response(await llm(prompt))
+
+        parser = ReplyStreamParser()
+        response = ""
+        async for delta in llm_stream(prompt):
+            response += delta
+            for reply in parser.feed(delta):
+                logger.debug(f"对话阶段提前发出回复：{reply}")
+                await on_reply(reply)
+        return self.__parse_chat_response(response)
+
+    def __fused_prompt(self, messages_chunk: list[Message]) -> str:
+        """
+        融合阶段提示词（反馈阶段 + 对话阶段）
+        """
+        return f"""
+你是QQ群用户 {self.__name}，不是 AI，而是一个有自我认知的真实用户，（你称自己为 "{self.__name}"），你的人设(身份认知)如
+下:
+
+{self.__role}
+
+现在你正在查看新消息，以客观视角分析“你的最新情绪”，整理信息保存，并对聊天内容做出总结，评估自己要不要加入对话，最后给出
+你在不同对话状态下的发言
+
+---
+
+## 1. 任务目标
+{_FEEDBACK_TASKS}
+- 基于“新输入消息”的内容和“历史聊天”的背景，结合你评估出的最新情绪，你对相关人物的情绪倾向，还有检索到的相关记忆，你的
+  人设(身份认知)，分别给出你在状态1和状态2时的发言，最终发送哪一组由对话状态的转换结果决定
+  - 状态1（冒泡状态）的发言，放到`reply`字段的"1"
+    - 这说明你之前在潜水状态，想要冒泡
+    - 如果你在“历史聊天”（不包括检索到的相关记忆）的话题参与者中没有出现过，同时在最近的聊天记录没有发言过
+      - 那么必须发送一条无关，意义不大，简短(不超过5个字)的内容表示你在看群，可以参考你的人设或者模仿别人
+    - 如果不满足上一条，就不发送任何消息（空数组[]即可）
+  - 状态2（对话状态）的发言，放到`reply`字段的"2"
+    - 这说明你正在活跃的参与话题
+    - 首先根据你之前的回复密度，历史消息考虑要不要发言（不发言时为空数组[]即可）
+      - 如果你还没参与话题，则必须发言
+      - 如果你已经参与话题，考虑你的情绪和消息内容决定发言密度，发言密度和历史消息中你的发言和别人的发言决定你要不要发言
+    - 如果要发言，发言依据如下
+      - 你想要发言的内容所属的话题
+      - 你之前对此话题的发言内容/主张
+      - 你对相关人物的情绪倾向和你的情绪
+      - 检索到的相关记忆
+  - 无论发言/不发言，都要总结你发言/不发言的原因到"debug_reason"字段
+
+## 2. 你发言时必须遵守的限制：
+
+{self.__chat_limits()}
+
+## 3. 输入信息
+
+{self.__feedback_inputs(messages_chunk)}
+
+---
+
+请严格遵守以上说明，输出符合以下格式的纯 JSON（数组长度不是格式要求），不要添加任何额外的文字或解释。
+
+```json
+{{
+  "emotion_tends": [
+    {{
+      "valence": 0.0≤float≤1.0,
+      "arousal": 0.0≤float≤1.0,
+      "dominance": -1.0≤float≤1.0,
+    }},
+    {{
+      "valence": 0.0≤float≤1.0,
+      "arousal": 0.0≤float≤1.0,
+      "dominance": -1.0≤float≤1.0,
+    }},
+    {{
+      "valence": 0.0≤float≤1.0,
+      "arousal": 0.0≤float≤1.0,
+      "dominance": -1.0≤float≤1.0,
+    }}
+  ]
+  "new_emotion": {{
+    "valence": 0.0≤float≤1.0,
+    "arousal": 0.0≤float≤1.0,
+    "dominance": -1.0≤float≤1.0
+  }},
+  "summary": "对聊天内容的总结",
+  "analyze_result": ["事件类信息", "资料类信息", "人物关系类信息", "自我认知类信息"],
+  "willing": {{
+    "0": 0.0≤float≤1.0,
+    "1": 0.0≤float≤1.0,
+    "2": 0.0≤float≤1.0
+  }},
+  "reply": {{
+    "1": [
+      "状态1时的回复内容1"
+    ],
+    "2": [
+      "状态2时的回复内容1"
+    ]
+  }},
+  "debug_reason": "发言/不发言的原因"
+}}
+```
+"""
+
+    async def __fused_stage(
+        self, messages_chunk: list[Message], llm: Callable[[str], Awaitable[str]]
+    ) -> list[str] | None:
+        """
+        融合阶段：一次llm调用同时完成反馈阶段和对话阶段，由本地状态机决定是否发出回复
+        """
+        logger.debug("融合阶段开始")
+        prompt = self.__fused_prompt(messages_chunk)
+        response = await llm(prompt)
+        response = re.sub(r"^```json\s*|\s*```$", "", response)
+        logger.debug(f"融合阶段llm返回：{response}")
+        try:
+            response_dict: dict[str, dict] = json.loads(response)
+            if not isinstance(response_dict.get("reply"), dict):
+                raise ValueError("Fused validation error: 'reply' is not a dict: " + str(response_dict))
+            if not all(isinstance(response_dict["reply"].get(key, []), list) for key in ["1", "2"]):
+                raise ValueError("Fused validation error: 'reply' values are not lists: " + str(response_dict))
+            self.__apply_feedback(response_dict, messages_chunk)
+        except json.JSONDecodeError as e:
+            raise ValueError(f"Fused stage JSON parsing error: {e} in response: {response}")
+        except KeyError as e:
+            raise ValueError(f"Fused stage missing key error: {e} in response: {response}")
+        except IndexError as e:
+            raise ValueError(f"Fused stage index error: {e} in response: {response}")
+        except Exception as e:
+            raise ValueError(f"Fused stage unexpected error: {e} in response: {response}")
+
+        logger.debug(f"融合阶段回复/不回复原因:{response_dict.get('debug_reason', '')}")
+        logger.debug("融合阶段结束")
         match self.__chatting_state:
             case _ChattingState.ILDE:
                 logger.debug("nyabot潜水中...")
-                reply_messages = None
+                return None
             case _ChattingState.BUBBLE:
                 logger.debug("nyabot冒泡中...")
-                reply_messages = await self.__chat_stage(
-                    messages_chunk=messages_chunk,
-                    llm=llm,
-                )
+                return response_dict["reply"].get("1", [])
             case _ChattingState.ACTIVE:
                 logger.debug("nyabot对话中...")
-                reply_messages = await self.__chat_stage(
-                    messages_chunk=messages_chunk,
-                    llm=llm,
+                return response_dict["reply"].get("2", [])
+
+    def __should_speculate(self) -> bool:
+        """
+        判断是否值得在反馈阶段进行的同时推测执行对话阶段
+        """
+        policy = plugin_config.nyaturingtest_speculative_chat
+        if policy == "off" or self.__chatting_state != _ChattingState.ACTIVE:
+            return False
+        if policy == "adaptive":
+            return self.__speculation_stats.hit_rate() >= plugin_config.nyaturingtest_speculative_chat_min_hit_rate
+        return True
+
+    async def __discard_speculative_chat(self, task: asyncio.Task[str], prompt: str):
+        """
+        作废推测执行的对话阶段，并记录浪费的开销
+        """
+        self.__speculation_stats.wasted_prompt_tokens += count_tokens(prompt)
+        if task.done() and not task.cancelled() and task.exception() is None:
+            self.__speculation_stats.wasted_response_tokens += count_tokens(task.result())
+        else:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+            except Exception as e:
+                logger.debug(f"推测对话阶段请求失败: {e}")
+        logger.info(
+            f"推测对话阶段作废，累计浪费提示词 {self.__speculation_stats.wasted_prompt_tokens} tokens，"
+            f"回复 {self.__speculation_stats.wasted_response_tokens} tokens，"
+            f"命中率 {self.__speculation_stats.hit_rate():.2f}"
+        )
+
+    def __long_term_texts(self, messages: list[Message]) -> list[str]:
+        """
+        写入长期记忆的消息文本，未解析的延迟图片只保留图片类型
+        """
+        return [strip_deferred(render_message(msg)) for msg in messages]
+
+    async def record(self, messages_chunk: list[Message]):
+        """
+        只把消息记录到短期记忆和长期记忆，不请求llm
+        """
+        self.long_term_memory.add_texts(texts=self.__long_term_texts(messages_chunk))
+        await self.global_memory.update(messages_chunk)
+        self.save_session()
+
+    async def __staged_turn(
+        self,
+        turn: _Turn,
+        deadline: _Deadline,
+        supersede: Supersede | None,
+        chat_priority: Priority,
+        feedback_priority: Priority,
+    ) -> list[str] | None:
+        """
+        分阶段模式：反馈阶段之后进行对话阶段，处于对话状态时推测执行对话阶段
+        """
+        # 处于对话状态时，对话阶段大概率紧随反馈阶段，使用反馈前的情绪和总结推测执行
+        was_active = self.__chatting_state == _ChattingState.ACTIVE
+        speculative_prompt = None
+        speculative_chat = None
+        if self.__should_speculate():
+            logger.debug("推测执行对话阶段")
+            speculative_prompt = self.__chat_prompt(turn.messages_chunk)
+            with scheduling(priority=chat_priority):
+                speculative_chat = asyncio.create_task(turn.llm(speculative_prompt))
+        # 反馈阶段
+        feedback_done = True
+        try:
+            with scheduling(priority=feedback_priority):
+                await deadline.run(
+                    self.__feedback_stage(messages_chunk=turn.messages_chunk, llm=turn.llm),
+                    share=plugin_config.nyaturingtest_feedback_budget_share,
                 )
+        except asyncio.TimeoutError:
+            deadline.degrade("反馈阶段", "超时，保持原有的状态和情绪")
+            feedback_done = False
+        except BaseException:
+            if speculative_chat and speculative_prompt:
+                await self.__discard_speculative_chat(speculative_chat, speculative_prompt)
+            raise
+        if was_active and feedback_done:
+            if self.__chatting_state == _ChattingState.ACTIVE:
+                self.__speculation_stats.hits += 1
+            else:
+                self.__speculation_stats.misses += 1
+        # 对话阶段，使用剩余的全部预算
+        try:
+            with scheduling(priority=chat_priority):
+                match self.__chatting_state:
+                    case _ChattingState.ILDE:
+                        logger.debug("nyabot潜水中...")
+                        if speculative_chat and speculative_prompt:
+                            await self.__discard_speculative_chat(speculative_chat, speculative_prompt)
+                        reply_messages = None
+                    case _ChattingState.ACTIVE if speculative_chat:
+                        logger.debug("nyabot对话中(推测执行)...")
+                        speculative_result = speculative_chat
+
+                        async def speculative() -> list[str]:
+                            return self.__parse_chat_response(await speculative_result)
+
+                        reply_messages = await deadline.run(
+                            self.__superseding(turn, speculative(), supersede), share=1.0
+                        )
+                    case _ChattingState.BUBBLE:
+                        logger.debug("nyabot冒泡中...")
+                        if speculative_chat and speculative_prompt:
+                            await self.__discard_speculative_chat(speculative_chat, speculative_prompt)
+                        reply_messages = await deadline.run(
+                            self.__superseding(turn, self.__chat_attempt(turn), supersede), share=1.0
+                        )
+                    case _ChattingState.ACTIVE:
+                        logger.debug("nyabot对话中...")
+                        reply_messages = await deadline.run(
+                            self.__superseding(turn, self.__chat_attempt(turn), supersede), share=1.0
+                        )
+        except asyncio.TimeoutError:
+            # 流式阶段已经发出的回复仍然记录到记忆中
+            deadline.degrade("对话阶段", f"超时，放弃剩余回复(已发出 {len(turn.sent_replies)} 条)")
+            reply_messages = turn.sent_replies.copy() or None
+        except ValueError as e:
+            if not turn.sent_replies:
+                raise
+            # 回复已经发到群里，即使完整的返回格式错误，也要把本批次和已发出的回复记录到记忆中
+            logger.warning(f"对话阶段返回格式错误，只记录已发出的 {len(turn.sent_replies)} 条回复: {e}")
+            reply_messages = turn.sent_replies.copy()
+        return reply_messages
 
-        if reply_messages:
-            self.long_term_memory.add_texts(
-                texts=[f"'{msg.user_name}':'{msg.content}'" for msg in messages_chunk]
-                + [f"'{self.__name}':'{msg}'" for msg in reply_messages],
-            )
-            await self.global_memory.update(
-                messages_chunk
-                + [Message(user_name=self.__name, content=msg, time=datetime.now()) for msg in reply_messages],
-            )
+    async def __dispatch(self, turn: _Turn, reply: str):
+        """
+        发出一条回复
+        """
+        assert turn.on_reply is not None
+        turn.sent_replies.append(reply)
+        # 回复新鲜度：发出时本批次最新消息已经等待了多久
+        newest = max(msg.time for msg in turn.messages_chunk)
+        self.__supersede_stats.record_reply((datetime.now() - newest).total_seconds())
+        await turn.on_reply(reply)
+
+    async def __chat_attempt(self, turn: _Turn) -> list[str]:
+        """
+        以本批次当前的消息进行一次对话阶段
+        """
+        return await self.__chat_stage(
+            messages_chunk=turn.messages_chunk,
+            llm=turn.llm,
+            llm_stream=turn.llm_stream if turn.streaming else None,
+            on_reply=(lambda reply: self.__dispatch(turn, reply)) if turn.on_reply else None,
+        )
+
+    async def __superseding(self, turn: _Turn, first: Awaitable[list[str]], supersede: Supersede | None) -> list[str]:
+        """
+        等待对话请求，期间有需要打断的新消息到达且还没有发出回复时，取消请求，合并新消息后重新生成
+        """
+        attempt = asyncio.ensure_future(first)
+        superseded = 0
+        try:
+            while supersede is not None and superseded < plugin_config.nyaturingtest_supersede_limit:
+                # 反馈阶段期间到达的消息也会立即触发一次检查
+                arrival = asyncio.ensure_future(supersede.arrived.wait())
+                try:
+                    await asyncio.wait({attempt, arrival}, return_when=asyncio.FIRST_COMPLETED)
+                finally:
+                    arrival.cancel()
+                if attempt.done():
+                    break
+                supersede.arrived.clear()
+                if turn.sent_replies:
+                    # 已经开始发出回复，不能再打断
+                    break
+                fresh = supersede.take(len(turn.messages_chunk))
+                if not fresh:
+                    continue
+
+                prompt_before, response_before = turn.cancelled_prompt_tokens, turn.cancelled_response_tokens
+                attempt.cancel()
+                await asyncio.wait({attempt})
+                superseded += 1
+                turn.messages_chunk.extend(fresh)
+                stats = self.__supersede_stats
+                stats.superseded += 1
+                stats.cancelled_prompt_tokens += turn.cancelled_prompt_tokens - prompt_before
+                stats.cancelled_response_tokens += turn.cancelled_response_tokens - response_before
+                logger.info(
+                    f"对话请求被 {len(fresh)} 条新消息打断，合并后重新生成回复。"
+                    f"累计打断 {stats.superseded} 次，取消提示词 {stats.cancelled_prompt_tokens} tokens，"
+                    f"回复 {stats.cancelled_response_tokens} tokens"
+                )
+                attempt = asyncio.ensure_future(self.__chat_attempt(turn))
+            return await attempt
+        except asyncio.CancelledError:
+            attempt.cancel()
+            raise
+
+    async def update(
+        self,
+        messages_chunk: list[Message],
+        llm: Callable[[str], Awaitable[str]],
+        llm_stream: Callable[[str], AsyncIterator[str]] | None = None,
+        on_reply: Callable[[str], Awaitable[None]] | None = None,
+        urgent: bool = False,
+        supersede: Supersede | None = None,
+    ) -> list[str] | None:
+        """
+        更新群聊消息
+
+        Args:
+            messages_chunk: 新输入消息，对话请求被打断时合并进来的新消息会追加到其中
+            llm: llm请求
+            llm_stream: 流式llm请求，提供时对话阶段会在每条回复生成完整后立即发出
+            on_reply: 发送回复，提供时所有回复都通过它发出
+            urgent: 消息直接提到了机器人，跳过本地门控，并尽量复用上次的检索结果以降低延迟
+            supersede: 提供时，对话阶段等待llm期间到达的新消息可以打断请求，合并后重新生成回复，反馈阶段的结果保留
+        """
+        # 潜水状态下，低信号批次(如复读，纯表情)不请求llm，只记录到记忆中
+        if not urgent and plugin_config.nyaturingtest_gate_enabled and self.__chatting_state == _ChattingState.ILDE:
+            score = score_batch(messages_chunk, self.__name, list(self.global_memory.access().messages))
+            if score.total() < plugin_config.nyaturingtest_gate_threshold:
+                self.__gate_stats.skipped += 1
+                logger.debug(f"本地门控跳过本批次：得分 {score}，累计跳过 {self.__gate_stats.skip_rate():.0%} 的批次")
+                await self.record(messages_chunk)
+                return None
+            self.__gate_stats.passed += 1
+            logger.debug(f"本地门控通过本批次：得分 {score}")
+
+        turn = _Turn(messages_chunk=messages_chunk, llm=llm, llm_stream=llm_stream, on_reply=on_reply)
+        # 提到机器人时所有阶段都使用最高优先级
+        chat_priority = Priority.MENTION if urgent else Priority.CHAT
+        feedback_priority = Priority.MENTION if urgent else Priority.FEEDBACK
+
+        # 各阶段按比例分配回复预算，长期记忆索引的耗时不计入
+        deadline = _Deadline(
+            budget=plugin_config.nyaturingtest_reply_budget,
+            excluded=lambda: self.long_term_memory.index_seconds,
+        )
+
+        # 检索阶段
+        try:
+            with scheduling(priority=feedback_priority):
+                await deadline.run(
+                    self.__search_stage(reuse_previous=urgent),
+                    share=plugin_config.nyaturingtest_search_budget_share,
+                )
+        except asyncio.TimeoutError:
+            deadline.degrade("检索阶段", "超时，沿用上次的检索结果")
+        if plugin_config.nyaturingtest_fused_stage:
+            # 融合阶段
+            try:
+                with scheduling(priority=chat_priority):
+                    reply_messages = await deadline.run(
+                        self.__fused_stage(messages_chunk=messages_chunk, llm=turn.llm),
+                        share=1.0,
+                    )
+            except asyncio.TimeoutError:
+                deadline.degrade("融合阶段", "超时，放弃回复")
+                reply_messages = None
         else:
-            self.long_term_memory.add_texts(
-                texts=[f"'{msg.user_name}':'{msg.content}'" for msg in messages_chunk],
+            reply_messages = await self.__staged_turn(
+                turn,
+                deadline,
+                supersede=supersede,
+                chat_priority=chat_priority,
+                feedback_priority=feedback_priority,
             )
 
+        # 发出还没有在流式阶段发出的回复
+        if reply_messages and on_reply:
+            for reply in reply_messages[len(turn.sent_replies) :]:
+                await self.__dispatch(turn, reply)
+
+        if reply_messages:
+            reply_records = [Message(user_name=self.__name, content=msg, time=datetime.now()) for msg in reply_messages]
+            self.long_term_memory.add_texts(texts=self.__long_term_texts(messages_chunk + reply_records))
+            await self.global_memory.update(messages_chunk + reply_records)
+        else:
+            self.long_term_memory.add_texts(texts=self.__long_term_texts(messages_chunk))
             await self.global_memory.update(messages_chunk)
 
+        mode = "融合模式" if plugin_config.nyaturingtest_fused_stage else "分阶段模式"
+        logger.debug(f"本轮({mode})llm调用 {turn.llm_calls} 次，提示词共 {turn.prompt_tokens} tokens")
+        if self.__supersede_stats.replies:
+            logger.debug(
+                f"回复新鲜度：最新消息平均等待 {self.__supersede_stats.freshness():.1f}s 后得到回复，"
+                f"最长 {self.__supersede_stats.max_age:.1f}s"
+            )
+        if deadline.degraded:
+            logger.warning(
+                f"本批次超出回复预算 {deadline.budget:.1f}s(用时 {deadline.elapsed():.1f}s)，"
+                f"降级的阶段：{'，'.join(deadline.degraded)}"
+            )
+
         # 保存会话状态
         self.save_session()
 
@@ -3,6 +3,8 @@ import asyncio
 import httpx
 from nonebot import logger
 
+from .scheduler import scheduler
+
 
 class SiliconFlowEmbeddings:
     """
@@ -35,7 +37,7 @@ class SiliconFlowEmbeddings:
 
         while retries <= self.max_retries:
             try:
-                async with httpx.AsyncClient() as client:
+                async with scheduler.slot("siliconflow"), httpx.AsyncClient() as client:
                     response = await client.post(self.endpoint, json=payload, headers=headers, timeout=self.timeout)
                     response.raise_for_status()
                     data = response.json().get("data", [])
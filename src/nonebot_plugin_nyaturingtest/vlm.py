@@ -1,5 +1,7 @@
 from openai import AsyncOpenAI
 
+from .scheduler import scheduler
+
 
 class SiliconFlowVLM:
     """
@@ -49,20 +51,21 @@ class SiliconFlowVLM:
         """
         让vlm根据图片和文本提示词生成描述
         """
-        responese = await self.client.chat.completions.create(
-            model=self.model,
-            messages=[
-                {
-                    "role": "user",
-                    "content": [
-                        {
-                            "type": "image_url",
-                            "image_url": {"url": f"data:image/{image_format};base64,{image_base64}"},
-                        },
-                        {"type": "text", "text": f"{prompt}"},
-                    ],
-                }
-            ],
-        )
+        async with scheduler.slot("siliconflow"):
+            responese = await self.client.chat.completions.create(
+                model=self.model,
+                messages=[
+                    {
+                        "role": "user",
+                        "content": [
+                            {
+                                "type": "image_url",
+                                "image_url": {"url": f"data:image/{image_format};base64,{image_base64}"},
+                            },
+                            {"type": "text", "text": f"{prompt}"},
+                        ],
+                    }
+                ],
+            )
 
         return responese.choices[0].message.content
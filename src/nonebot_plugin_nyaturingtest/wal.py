@@ -0,0 +1,202 @@
+import asyncio
+import json
+import os
+
+from nonebot import logger
+
+
+class IngestLog:
+    """
+    长期记忆待索引文本的预写日志(JSON Lines，只追加)
+
+    每条文本写入 {"seq": 序号, "text": 文本}，索引完成后写入 {"ack": 序号}，表示该序号及之前的文本都已经索引。
+    写入先进入文件缓冲区，一段时间内的写入合并为一次 fsync (group commit)；
+    所有文本都已索引且日志过大时在线程中压缩日志，不阻塞事件循环
+    """
+
+    def __init__(self, path: str, commit_interval: float = 1.0, compact_bytes: int = 1 << 20):
+        """
+        Args:
+            path: 日志文件路径
+            commit_interval: 合并写入的时间窗口(秒)，小于等于0时每次写入都立即 fsync
+            compact_bytes: 所有文本都已索引且日志超过这个大小时清空日志
+        """
+        self._path = path
+        self._commit_interval = commit_interval
+        self._compact_bytes = compact_bytes
+        self._seq = 0
+        self._acked = 0
+        self._commit_task: asyncio.Task[None] | None = None
+        # 上次提交之后有新的写入
+        self._dirty = False
+        self._compact_task: asyncio.Task[None] | None = None
+        # 压缩期间写入的记录，压缩完成后补写到新文件
+        self._tail: list[str] | None = None
+        self.commits = 0
+        self.writes = 0
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._file = open(path, "a", encoding="utf-8")
+
+    def replay(self) -> list[tuple[int, str]]:
+        """
+        读取还没有被索引的文本，并把日志压缩为只包含这些文本
+
+        Returns:
+            (序号, 文本) 列表
+        """
+        entries: dict[int, str] = {}
+        acked = 0
+        with open(self._path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # 崩溃时写了一半的记录
+                    logger.warning(f"忽略预写日志 {self._path} 中损坏的记录")
+                    continue
+                if "ack" in record:
+                    acked = max(acked, record["ack"])
+                else:
+                    entries[record["seq"]] = record["text"]
+        pending = sorted((seq, text) for seq, text in entries.items() if seq > acked)
+        self._seq = max([acked, *entries])
+        self._acked = acked
+        self._rewrite(pending)
+        if pending:
+            logger.info(f"从预写日志恢复了 {len(pending)} 条未索引的文本")
+        return pending
+
+    def append(self, texts: list[str]) -> int:
+        """
+        追加文本
+
+        Returns:
+            最后一条文本的序号
+        """
+        for text in texts:
+            self._seq += 1
+            self._write(json.dumps({"seq": self._seq, "text": text}, ensure_ascii=False) + "\n")
+        self.writes += len(texts)
+        self._schedule_commit()
+        return self._seq
+
+    def ack(self, seq: int):
+        """
+        确认序号及之前的文本都已经索引
+        """
+        if seq <= self._acked:
+            return
+        self._acked = seq
+        if seq == self._seq and self._file.tell() > self._compact_bytes and self._compact_task is None:
+            try:
+                asyncio.get_running_loop()
+            except RuntimeError:
+                self._rewrite([])
+                return
+            self._tail = []
+            self._compact_task = asyncio.create_task(self._compact())
+        self._write(json.dumps({"ack": seq}) + "\n")
+        self._schedule_commit()
+
+    def reset(self):
+        """
+        清空日志
+        """
+        self._acked = self._seq
+        self._rewrite([])
+
+    def _write(self, line: str):
+        self._file.write(line)
+        self._dirty = True
+        if self._tail is not None:
+            self._tail.append(line)
+
+    def _rewrite(self, entries: list[tuple[int, str]]):
+        # 重写后的文件已经落盘，不再需要等待中的提交和压缩
+        if self._commit_task is not None and not self._commit_task.done():
+            self._commit_task.cancel()
+        if self._compact_task is not None:
+            self._compact_task.cancel()
+            self._compact_task = None
+            self._tail = None
+        tmp = f"{self._path}.tmp"
+        _write_log(tmp, self._acked, entries)
+        self._replace(tmp)
+        self._dirty = False
+
+    def _replace(self, tmp: str):
+        """
+        用写好的文件替换日志
+        """
+        self._file.close()
+        os.replace(tmp, self._path)
+        self._file = open(self._path, "a", encoding="utf-8")
+
+    async def _compact(self):
+        """
+        所有文本都已索引时在线程中写出只包含确认记录的新日志，期间写入的记录在替换后补写到新文件
+        """
+        tmp = f"{self._path}.compact"
+        try:
+            await asyncio.to_thread(_write_log, tmp, self._acked, [])
+            # 以下没有 await，不会与写入交错
+            tail = self._tail or []
+            self._replace(tmp)
+            self._file.writelines(tail)
+            self._dirty = bool(tail)
+            if tail:
+                self._schedule_commit()
+        except OSError as e:
+            logger.warning(f"压缩预写日志失败: {e}")
+        finally:
+            self._tail = None
+            if self._compact_task is asyncio.current_task():
+                self._compact_task = None
+
+    def _schedule_commit(self):
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            # 启动加载等没有事件循环的场景直接提交
+            self._commit()
+            return
+        if self._commit_interval <= 0:
+            self._commit()
+        elif self._commit_task is None or self._commit_task.done():
+            self._commit_task = asyncio.create_task(self._delayed_commit())
+
+    async def _delayed_commit(self):
+        # fsync 期间的写入不会再创建提交任务，由这里继续提交，直到没有新的写入
+        while True:
+            await asyncio.sleep(self._commit_interval)
+            self._dirty = False
+            self._file.flush()
+            fd = self._file.fileno()
+            self.commits += 1
+            try:
+                await asyncio.to_thread(os.fsync, fd)
+            except OSError as e:
+                # fsync 期间日志被压缩，旧文件已经关闭，写入新文件的记录由下一轮提交
+                logger.debug(f"预写日志提交失败: {e}")
+            if not self._dirty:
+                return
+
+    def _commit(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self.commits += 1
+        self._dirty = False
+
+
+def _write_log(path: str, acked: int, entries: list[tuple[int, str]]):
+    """
+    写出日志文件并落盘
+    """
+    with open(path, "w", encoding="utf-8") as f:
+        if acked:
+            # 保留确认记录，压缩后序号仍然连续
+            f.write(json.dumps({"ack": acked}) + "\n")
+        for seq, text in entries:
+            f.write(json.dumps({"seq": seq, "text": text}, ensure_ascii=False) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
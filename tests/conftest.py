@@ -6,6 +6,7 @@ import pytest
 from pytest_asyncio import is_async_test
 
 os.environ["ENVIRONMENT"] = "test"
+os.environ.setdefault("TOKENIZERS_PARALLELISM", "false")
 
 
 def pytest_collection_modifyitems(items: list[pytest.Item]):
@@ -23,3 +24,64 @@ async def after_nonebot_init(after_nonebot_init: None):
 
     # 加载插件
     nonebot.load_from_toml("pyproject.toml")
+
+
+@pytest.fixture(scope="session")
+def tokenizer():
+    """
+    在本地训练的小分词器，测试不需要下载 BAAI/bge-m3
+    """
+    from tokenizers import Tokenizer, decoders, models, normalizers, pre_tokenizers, trainers
+    from transformers import PreTrainedTokenizerFast
+
+    corpus = [
+        "12:34 小明: 今天吃什么 哈哈 笑死 这个游戏好玩",
+        "12:35 阿狸: 在吗 为什么 不知道 真的假的 晚上一起打游戏",
+        "12:36 Tom: hello world ok lol 明天上班 好累 摸鱼",
+    ] * 20
+    model = Tokenizer(models.Unigram())
+    model.normalizer = normalizers.NFKC()
+    model.pre_tokenizer = pre_tokenizers.Metaspace()
+    model.decoder = decoders.Metaspace()
+    model.train_from_iterator(
+        corpus, trainers.UnigramTrainer(vocab_size=200, special_tokens=["<unk>"], unk_token="<unk>")
+    )
+    return PreTrainedTokenizerFast(tokenizer_object=model, unk_token="<unk>", model_max_length=8192)
+
+
+@pytest.fixture
+def plugin_env(monkeypatch: pytest.MonkeyPatch, tmp_path, tokenizer):
+    """
+    插件数据保存到临时目录，分词器使用本地训练的分词器
+    """
+    nonebot.require("nonebot_plugin_nyaturingtest")
+    import nonebot_plugin_localstore as store
+
+    from nonebot_plugin_nyaturingtest import context, hippo_mem
+    from nonebot_plugin_nyaturingtest.config import plugin_config
+
+    monkeypatch.setattr(store, "get_plugin_data_dir", lambda: tmp_path)
+    # 预写日志立即写盘，不在测试之间留下延迟提交的任务
+    monkeypatch.setattr(plugin_config, "nyaturingtest_ingest_commit_interval", 0)
+    monkeypatch.setattr(context, "get_tokenizer", lambda: tokenizer)
+    monkeypatch.setattr(hippo_mem, "get_tokenizer", lambda: tokenizer)
+    return tmp_path
+
+
+@pytest.fixture
+def make_session(plugin_env):
+    """
+    创建会话，长期记忆检索需要请求嵌入接口，测试中总是返回空结果
+    """
+    from nonebot_plugin_nyaturingtest.session import Session
+
+    def make(id: str = "test"):
+        session = Session(siliconflow_api_key="sk-test", id=id)
+
+        async def retrieve(queries: list[str], k: int = 5, reuse_previous: bool = False) -> list[str]:
+            return []
+
+        session.long_term_memory.retrieve = retrieve
+        return session
+
+    return make
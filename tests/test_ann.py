@@ -0,0 +1,40 @@
+import numpy as np
+
+
+def _data(n: int, seed: int = 0) -> tuple[list[str], np.ndarray]:
+    rng = np.random.default_rng(seed)
+    return [str(i) for i in range(n)], rng.normal(size=(n, 16)).astype(np.float32)
+
+
+def test_add_matches_full_build(plugin_env):
+    from nonebot_plugin_nyaturingtest.ann import VectorIndex
+
+    texts, vectors = _data(300)
+    queries = vectors[:20] + 0.01
+    full = VectorIndex(texts, vectors)
+    index = VectorIndex(texts[:100], vectors[:100])
+    index.add(texts[100:250], vectors[100:250])
+    index.add(texts[250:], vectors[250:])
+
+    assert len(index) == 300
+    assert index.texts == texts
+    assert [[i for i, _ in hits] for hits in index.search(queries, 3)] == [
+        [i for i, _ in hits] for hits in full.search(queries, 3)
+    ]
+
+
+def test_add_assigns_new_vectors_to_clusters(plugin_env):
+    from nonebot_plugin_nyaturingtest.ann import VectorIndex
+
+    texts, vectors = _data(400)
+    index = VectorIndex(texts[:200], vectors[:200], ivf_threshold=100, nprobe=100)
+    assert index.is_approximate()
+    index.add(texts[200:300], vectors[200:300])
+    # 没有翻倍，沿用原来的聚类
+    assert index._trained_size == 200
+    assert sorted(np.concatenate(index._lists).tolist()) == list(range(300))
+    # 探测所有簇时与精确搜索一致
+    assert [hits[0][0] for hits in index.search(vectors[250:260], 1)] == list(range(250, 260))
+
+    index.add(texts[300:], vectors[300:])
+    assert index._trained_size == 400
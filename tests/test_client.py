@@ -0,0 +1,142 @@
+import asyncio
+import json
+import re
+import time
+from typing_extensions import Self
+
+import pytest
+
+
+class StubServer:
+    """
+    只实现 /chat/completions 的 openai 规范接口
+    """
+
+    def __init__(self, reply: str, delay: float = 0.0, status: int = 200):
+        self.reply = reply
+        self.delay = delay
+        self.status = status
+        self.requests = 0
+        self._server: asyncio.Server | None = None
+
+    async def __aenter__(self) -> Self:
+        self._server = await asyncio.start_server(self._handle, "127.0.0.1", 0)
+        return self
+
+    async def __aexit__(self, *_):
+        assert self._server is not None
+        self._server.close()
+
+    @property
+    def base_url(self) -> str:
+        assert self._server is not None
+        return f"http://127.0.0.1:{self._server.sockets[0].getsockname()[1]}/v1"
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            head = await reader.readuntil(b"\r\n\r\n")
+            length = re.search(rb"content-length:\s*(\d+)", head, re.IGNORECASE)
+            await reader.readexactly(int(length.group(1)) if length else 0)
+            self.requests += 1
+            await asyncio.sleep(self.delay)
+            if self.status == 200:
+                body = {
+                    "id": "stub",
+                    "object": "chat.completion",
+                    "created": 0,
+                    "model": "stub",
+                    "choices": [
+                        {
+                            "index": 0,
+                            "message": {"role": "assistant", "content": self.reply},
+                            "finish_reason": "stop",
+                        }
+                    ],
+                }
+            else:
+                body = {"error": {"message": "stub error", "type": "server_error"}}
+            data = json.dumps(body).encode()
+            writer.write(
+                f"HTTP/1.1 {self.status} Stub\r\nContent-Type: application/json\r\n"
+                f"Content-Length: {len(data)}\r\nConnection: close\r\n\r\n".encode()
+                + data
+            )
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+
+def _client(*servers: StubServer, **kwargs):
+    from openai import AsyncOpenAI
+
+    from nonebot_plugin_nyaturingtest.client import LLMClient
+
+    return LLMClient(
+        client=[AsyncOpenAI(api_key="sk-test", base_url=server.base_url, max_retries=0) for server in servers],
+        timeout=5,
+        **kwargs,
+    )
+
+
+async def test_failover_to_next_endpoint(plugin_env):
+    async with StubServer("主接口", status=500) as primary, StubServer("备用接口") as fallback:
+        client = _client(primary, fallback)
+
+        assert await client.generate_response("你好", model="stub") == "备用接口"
+        assert primary.requests == 1
+        assert fallback.requests == 1
+
+
+async def test_hedged_request_uses_faster_endpoint(plugin_env):
+    async with StubServer("慢", delay=2.0) as slow, StubServer("快") as fast:
+        client = _client(slow, fast, hedge_delay=0.1)
+
+        start = time.monotonic()
+        assert await client.generate_response("你好", model="stub") == "快"
+        assert time.monotonic() - start < 1.0
+        assert slow.requests == 1
+        assert fast.requests == 1
+
+
+async def test_breaker_recovers_after_cooldown(plugin_env):
+    async with StubServer("恢复了", status=500) as server:
+        client = _client(server, failure_threshold=2, cooldown=0.2)
+        endpoint = client.endpoints[0]
+        for _ in range(2):
+            with pytest.raises(Exception, match="stub error"):
+                await client.generate_response("你好", model="stub")
+        assert not endpoint.available()
+
+        await asyncio.sleep(0.25)
+        assert endpoint.available()
+        server.status = 200
+        assert await client.generate_response("你好", model="stub") == "恢复了"
+        assert endpoint.available()
+        assert server.requests == 3
+
+
+async def test_half_open_allows_one_probe(plugin_env):
+    from openai import AsyncOpenAI
+
+    from nonebot_plugin_nyaturingtest.client import Endpoint
+
+    endpoint = Endpoint(AsyncOpenAI(api_key="sk-test"), failure_threshold=1, cooldown=0.1)
+    endpoint.record_failure()
+    assert not endpoint.available()
+
+    await asyncio.sleep(0.15)
+    assert endpoint.acquire()
+    # 探测请求进行中，其它请求不能再发往这个接口
+    assert not endpoint.available()
+    assert not endpoint.acquire()
+
+    # 探测失败立即重新打开，不需要再连续失败 failure_threshold 次
+    endpoint.record_failure()
+    assert not endpoint.available()
+    await asyncio.sleep(0.15)
+    assert endpoint.acquire()
+    endpoint.record_success(0.1)
+    assert endpoint.acquire()
+    assert endpoint.acquire()
@@ -0,0 +1,49 @@
+async def test_new_messages_are_truncated_not_dropped(plugin_env):
+    from nonebot_plugin_nyaturingtest.context import ContextBuilder, ContextSection, count_tokens
+
+    long = "12:34 小明: " + "今天吃什么 哈哈 笑死 " * 200
+    builder = ContextBuilder(budget=120)
+    builder.add(ContextSection(name="new_messages", items=[long, "12:35 阿狸: 在吗"], priority=5, droppable=False))
+    section = builder.sections["new_messages"]
+    context = builder.build()
+
+    # 超长消息被截断，每条新消息都保留
+    assert len(section.items) == 2
+    assert section.items[1] == "12:35 阿狸: 在吗"
+    assert section.items[0].startswith("12:34 小明:")
+    assert section.truncated == {0}
+    assert count_tokens(context["new_messages"]) <= 130
+
+
+async def test_dropped_items_are_summarized(plugin_env):
+    from nonebot_plugin_nyaturingtest.context import ContextBuilder, ContextSection, summarize_omitted
+
+    names = ["小明", "阿狸", "Tom"] * 10
+    lines = [f"12:{i:02d} {name}: 今天吃什么 哈哈 笑死 这个游戏好玩" for i, name in enumerate(names)]
+    builder = ContextBuilder(budget=200)
+    builder.add(
+        ContextSection(
+            name="new_messages",
+            items=["12:59 猫猫: 在吗"],
+            priority=5,
+            reserve=1.0,
+            droppable=False,
+        )
+    ).add(
+        ContextSection(
+            name="recent_messages",
+            items=list(lines),
+            priority=3,
+            trim_from="head",
+            summarize=summarize_omitted("更早的消息", lambda line: line.split(" ", 1)[1].split(":", 1)[0]),
+        )
+    )
+    context = builder.build()
+    section = builder.sections["recent_messages"]
+
+    assert builder.total_tokens() <= 200
+    assert section.trimmed > 0
+    # 最早的消息被替换为摘要，放在段落开头
+    assert section.items == lines[section.trimmed :]
+    assert context["recent_messages"].startswith(f"(省略了 {section.trimmed} 条更早的消息，涉及: 小明、阿狸、Tom)")
+    assert context["new_messages"] == "12:59 猫猫: 在吗"
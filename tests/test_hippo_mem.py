@@ -0,0 +1,245 @@
+import asyncio
+
+import numpy as np
+import pytest
+
+
+def _hippo(make_session, docs: list[str]):
+    hippo = make_session().long_term_memory
+    # make_session 替换了检索，这里测试真正的检索，只替换向量和 HippoRAG 检索
+    del hippo.retrieve
+    hippo._embed = _embed
+    hippo._retrieve = _fake_retrieve(hippo, docs)
+    return hippo
+
+
+def _fake_retrieve(hippo, docs: list[str]):
+    async def retrieve(queries: list[str], k: int, query_vectors: np.ndarray) -> list[str]:
+        centroid = query_vectors.mean(axis=0)
+        hippo._set_docs(docs, centroid if docs else None, centroid)
+        return hippo._docs
+
+    return retrieve
+
+
+async def _embed(texts: list[str]) -> np.ndarray:
+    return np.ones((len(texts), 4))
+
+
+async def test_empty_prefetch_is_not_counted(make_session):
+    hippo = _hippo(make_session, [])
+
+    await hippo.prefetch([])
+    await hippo.prefetch(["没有相关的记忆"])
+    await hippo.retrieve(["没有相关的记忆"])
+    assert hippo.prefetch_hits == 0
+    assert hippo.prefetch_misses == 0
+
+
+async def test_prefetched_result_is_reused(make_session):
+    hippo = _hippo(make_session, ["小明喜欢吃火锅"])
+
+    await hippo.prefetch(["晚饭吃什么"])
+    # 查询没有变化，不会再次预取
+    await hippo.prefetch(["晚饭吃什么"])
+    assert await hippo.retrieve(["晚饭吃什么"]) == ["小明喜欢吃火锅"]
+    assert hippo.prefetch_hits == 1
+    await hippo.retrieve(["晚饭吃什么"])
+    assert hippo.prefetch_hits == 1
+
+
+class FakeStore:
+    def __init__(self):
+        self.rows: dict[str, tuple[str, np.ndarray]] = {}
+        self.fetched = 0
+
+    def add(self, text: str):
+        rng = np.random.default_rng(len(self.rows))
+        self.rows[f"chunk-{len(self.rows)}"] = (text, rng.normal(size=4))
+
+    def get_all_ids(self) -> list[str]:
+        return list(self.rows)
+
+    def get_row(self, hash_id: str) -> dict:
+        self.fetched += 1
+        return {"content": self.rows[hash_id][0]}
+
+    def get_embeddings(self, ids: list[str]) -> list[np.ndarray]:
+        return [self.rows[hash_id][1] for hash_id in ids]
+
+
+async def test_local_index_appends_new_passages(make_session):
+    hippo = make_session().long_term_memory
+    store = FakeStore()
+    hippo.hippo.chunk_embedding_store = store
+    for i in range(10):
+        store.add(f"段落{i}")
+
+    index = hippo._local_index()
+    assert index is not None
+    assert len(index) == 10
+    store.add("段落10")
+    hippo._index_version += 1
+    assert hippo._local_index() is index
+    assert len(index) == 11
+    # 只读取了新段落
+    assert store.fetched == 11
+
+    del store.rows["chunk-0"]
+    hippo._index_version += 1
+    rebuilt = hippo._local_index()
+    assert rebuilt is not index
+    assert rebuilt is not None
+    assert len(rebuilt) == 10
+
+
+async def test_local_retrieve_without_hits(make_session):
+    hippo = make_session().long_term_memory
+    store = FakeStore()
+    hippo.hippo.chunk_embedding_store = store
+    store.add("段落")
+
+    assert hippo._local_retrieve(np.empty((0, 4)), k=3) is None
+
+
+class FakeOpenIE:
+    def __init__(self, fail: str = ""):
+        self.fail = fail
+
+    def ner(self, chunk_key: str, passage: str):
+        from hipporag.utils.misc_utils import NerRawOutput
+
+        if passage == self.fail:
+            raise RuntimeError("ner failed")
+        return NerRawOutput(chunk_id=chunk_key, response=None, metadata={}, unique_entities=[passage[:2]])
+
+    def triple_extraction(self, chunk_key: str, passage: str, named_entities: list[str]):
+        from hipporag.utils.misc_utils import TripleRawOutput
+
+        return TripleRawOutput(
+            chunk_id=chunk_key, response=None, metadata={}, triples=[[named_entities[0], "说", passage]]
+        )
+
+
+async def test_extract_saves_once_and_keeps_partial_results(make_session):
+    hippo = make_session().long_term_memory
+    hippo.hippo.openie = FakeOpenIE(fail="段落坏")
+    saves: list[int] = []
+    save = hippo.hippo.save_openie_results
+
+    def counted_save(all_openie_info: list[dict]):
+        saves.append(len(all_openie_info))
+        save(all_openie_info)
+
+    hippo.hippo.save_openie_results = counted_save
+
+    with pytest.raises(RuntimeError, match="ner failed"):
+        await hippo._extract(["段落一", "段落二", "段落坏"])
+    assert saves == [2]
+
+    # 已经抽取过的段落不会再次抽取
+    hippo.hippo.openie = FakeOpenIE()
+    await hippo._extract(["段落一", "段落二", "段落坏"])
+    assert saves == [2, 3]
+
+
+async def test_index_reuses_prepared_tokens(make_session):
+    hippo = make_session().long_term_memory
+    chunker = hippo._passage_chunker
+    hippo.add_texts([f"12:{i:02d} 小明: 今天吃什么{i}" for i in range(50)])
+    hippo.add_texts([f"13:{i:02d} 阿狸: 吃火锅{i}" for i in range(50)])
+
+    indexed: list[list[str]] = []
+
+    async def index_texts(texts: list[str], passages: list[str], seq: int):
+        indexed.append(passages)
+
+    tokenized: list[str] = []
+    offsets = chunker._offsets
+
+    def counted_offsets(texts: list[str]):
+        tokenized.extend(texts)
+        return offsets(texts)
+
+    hippo._index_texts = index_texts
+    chunker._offsets = counted_offsets
+    # 索引任务开始之前新增的文本不影响预先分词的结果
+    asyncio.get_running_loop().call_soon(hippo.add_texts, ["14:00 猫猫: 新消息"])
+    await hippo._index()
+
+    assert len(indexed) == 1
+    assert indexed[0][0].startswith("12:00 小明")
+    assert tokenized == ["14:00 猫猫: 新消息\n"]
+
+
+async def test_add_texts_chunking_work_is_linear(make_session, monkeypatch: pytest.MonkeyPatch):
+    from nonebot_plugin_nyaturingtest import hippo_mem
+    from nonebot_plugin_nyaturingtest.chunker import TextChunker
+
+    join_texts = hippo_mem._join_texts
+
+    def work(count: int) -> int:
+        """
+        添加 count 条文本期间拼接和分词的字符数
+        """
+        hippo = make_session(f"linear{count}").long_term_memory
+        chunker = hippo._passage_chunker
+        chars = [0]
+        offsets = chunker._offsets
+
+        def counted_join(texts: list[str]) -> str:
+            text = join_texts(texts)
+            chars[0] += len(text)
+            return text
+
+        def counted_offsets(texts: list[str]):
+            chars[0] += sum(len(text) for text in texts)
+            return offsets(texts)
+
+        monkeypatch.setattr(hippo_mem, "_join_texts", counted_join)
+        chunker._offsets = counted_offsets
+        texts = [f"12:{i % 60:02d} 小明: 今天吃什么 哈哈 笑死{i}" for i in range(count)]
+        for text in texts:
+            hippo.add_texts([text])
+        monkeypatch.setattr(hippo_mem, "_join_texts", join_texts)
+        # 逐条追加后切分的结果与一次性切分一致
+        fresh = TextChunker(hippo._tokenizer, max_tokens=512, overlap=100, cache_size=0)
+        assert chunker.take() == fresh.split(join_texts(texts))
+        return chars[0]
+
+    # 每条文本的工作量与已经缓存的文本数量无关
+    assert work(400) < 2.5 * work(200)
+
+
+async def test_cached_retrieval_skips_indexing(make_session):
+    from types import SimpleNamespace
+
+    hippo = make_session().long_term_memory
+    hippo._embed = _embed
+    calls: list[list[str]] = []
+    indexed: list[list[str]] = []
+
+    def retrieve(queries: list[str], num_to_retrieve: int):
+        calls.append(queries)
+        return [SimpleNamespace(docs=["小明喜欢吃火锅"])]
+
+    async def index_texts(texts: list[str], passages: list[str], seq: int):
+        indexed.append(texts)
+        hippo._index_version += 1
+
+    hippo.hippo.retrieve = retrieve
+    hippo._index_texts = index_texts
+    vectors = await _embed(["晚饭吃什么"])
+
+    assert await hippo._retrieve(["晚饭吃什么"], 5, vectors) == ["小明喜欢吃火锅"]
+    # 聊天新增的文本还没有索引，重复的查询直接使用缓存，不请求 HippoRAG
+    hippo.add_texts(["12:00 小明: 晚饭吃火锅"])
+    assert await hippo._retrieve([" 晚饭吃什么 "], 5, vectors) == ["小明喜欢吃火锅"]
+    assert len(calls) == 1
+    assert indexed == []
+    assert hippo._retrieval_cache.exact_hits == 1
+
+    # 未命中时先索引缓存的文本
+    await hippo._retrieve(["火锅好吃吗"], 5, np.full((1, 4), -1.0))
+    assert indexed == [["12:00 小明: 晚饭吃火锅"]]
+    assert len(calls) == 2
@@ -0,0 +1,40 @@
+import base64
+
+import pytest
+
+
+@pytest.fixture
+def manager(plugin_env, monkeypatch: pytest.MonkeyPatch):
+    from nonebot_plugin_nyaturingtest.image_manager import ImageManager, LazyImageStats
+
+    manager = ImageManager()
+    monkeypatch.setattr(manager, "_vlm", object())
+    monkeypatch.setattr(manager, "_deferred", type(manager._deferred)())
+    monkeypatch.setattr(manager, "stats", LazyImageStats())
+    return manager
+
+
+async def test_failed_image_keeps_placeholder(manager, monkeypatch: pytest.MonkeyPatch):
+    from nonebot_plugin_nyaturingtest.image_manager import ImageWithDescription
+
+    ok = manager.defer(base64.b64encode(b"ok").decode(), is_sticker=False)
+    bad = manager.defer(base64.b64encode(b"bad").decode(), is_sticker=True)
+    failing = [True]
+
+    async def describe(image_base64: str, is_sticker: bool) -> ImageWithDescription:
+        if base64.b64decode(image_base64) == b"bad" and failing[0]:
+            raise RuntimeError("VLM请求失败")
+        return ImageWithDescription(description="猫", emotion="开心", is_sticker=is_sticker)
+
+    monkeypatch.setattr(manager, "get_image_description", describe)
+
+    # 一张图片失败不影响其它图片，失败的图片不返回映射，保留记录
+    resolved = await manager.resolve_deferred([f"{ok} {bad}"])
+    assert list(resolved) == [ok]
+    assert manager.stats.failed == 1
+
+    failing[0] = False
+    resolved = await manager.resolve_deferred([bad])
+    assert "[表情包]" in resolved[bad]
+    assert manager.stats.resolved == 2
+    assert manager.stats.avoided() == 0
@@ -0,0 +1,37 @@
+from datetime import datetime
+
+
+def _message(user_name: str, content: str):
+    from nonebot_plugin_nyaturingtest.mem import Message
+
+    return Message(time=datetime.now(), user_name=user_name, content=content)
+
+
+def test_collapse_flood_from_many_senders(plugin_env):
+    from nonebot_plugin_nyaturingtest.ingest import collapse_into
+    from nonebot_plugin_nyaturingtest.mem import Message, render_message
+
+    messages = [_message("小明", "哈哈哈哈哈")]
+    for name in ["阿狸", "小明", "Tom", "阿狸"]:
+        assert collapse_into(messages, _message(name, "哈哈 哈哈哈"), similarity=0.9)
+    assert not collapse_into(messages, _message("Tom", "晚上吃什么"), similarity=0.9)
+
+    assert messages[0].repeat == 5
+    assert messages[0].others == ("阿狸", "Tom")
+    assert render_message(messages[0]).endswith("哈哈哈哈哈 (x5，阿狸、Tom也发了)")
+    assert Message.from_json(messages[0].to_json()) == messages[0]
+
+
+def test_superseding_respects_max_batch_size(plugin_env, monkeypatch):
+    from nonebot_plugin_nyaturingtest import GroupState, take_superseding
+    from nonebot_plugin_nyaturingtest.config import plugin_config
+    from nonebot_plugin_nyaturingtest.session import Session
+
+    monkeypatch.setattr(plugin_config, "nyaturingtest_max_batch_size", 5)
+    monkeypatch.setattr(plugin_config, "nyaturingtest_supersede_threshold", 1)
+    state = GroupState(session=Session.__new__(Session))
+    state.messages_chunk = [_message("小明", f"消息{i}") for i in range(10)]
+
+    assert len(take_superseding(state, 3)) == 2
+    assert take_superseding(state, 5) == []
+    assert len(state.messages_chunk) == 8
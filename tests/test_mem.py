@@ -0,0 +1,17 @@
+from datetime import datetime
+
+
+async def test_rewrite_keeps_old_snapshots(plugin_env):
+    from nonebot_plugin_nyaturingtest.mem import Memory, Message, render_message
+
+    memory = Memory(llm_client=None, messages=[Message(time=datetime.now(), user_name="小明", content="看[图片]")])  # type: ignore[arg-type]
+    before = memory.access()
+    assert "看[图片]" in before.transcript
+
+    memory.rewrite(lambda text: text.replace("[图片]", "[图片] 一只猫"))
+    after = memory.access()
+    assert after is not before
+    assert "一只猫" in after.transcript
+    # 旧快照的消息和缓存的渲染结果保持一致
+    assert before.messages[0].content == "看[图片]"
+    assert before.lines == tuple(render_message(message) for message in before.messages)
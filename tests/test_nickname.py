@@ -0,0 +1,51 @@
+import pytest
+
+
+class FakeBot:
+    def __init__(self, members: list[dict]):
+        self.members = members
+        self.calls = 0
+
+    async def get_group_member_list(self, group_id: int) -> list[dict]:
+        self.calls += 1
+        return self.members
+
+
+@pytest.fixture
+def clock(monkeypatch: pytest.MonkeyPatch):
+    from nonebot_plugin_nyaturingtest import nickname
+
+    now = [1000.0]
+    monkeypatch.setattr(nickname.time, "monotonic", lambda: now[0])
+    return now
+
+
+async def test_expired_names_are_evicted(plugin_env, clock):
+    from nonebot_plugin_nyaturingtest.nickname import NicknameCache
+
+    cache = NicknameCache(ttl=60)
+    cache.update(1, 10, "小明")
+    cache.update(2, 20, "阿狸")
+    assert len(cache) == 2
+
+    clock[0] += 61
+    cache.update(1, 11, "猫猫")
+    # 过期的昵称和没有成员的群都被清理
+    assert len(cache) == 1
+    assert cache._names == {1: {11: ("猫猫", clock[0] + 60)}}
+
+
+async def test_warm_again_after_ttl(plugin_env, clock):
+    from nonebot_plugin_nyaturingtest.nickname import NicknameCache
+
+    cache = NicknameCache(ttl=60)
+    bot = FakeBot([{"user_id": 10, "card": "", "nickname": "小明"}])
+    assert cache.is_cold(1)
+    await cache.warm(bot, 1)  # type: ignore
+    assert not cache.is_cold(1)
+    assert await cache.get(bot, 1, 10) == "小明"  # type: ignore
+
+    clock[0] += 61
+    assert cache.is_cold(1)
+    await cache.warm(bot, 1)  # type: ignore
+    assert bot.calls == 2
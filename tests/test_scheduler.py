@@ -0,0 +1,39 @@
+import asyncio
+
+
+async def test_background_leaves_a_slot_for_chat(plugin_env):
+    from nonebot_plugin_nyaturingtest.scheduler import Priority, Scheduler
+
+    scheduler = Scheduler()
+    scheduler.configure("chat", rate=0, concurrency=2)
+    release = asyncio.Event()
+    started: list[Priority] = []
+
+    async def request(priority: Priority):
+        async with scheduler.slot("chat", priority=priority):
+            started.append(priority)
+            await release.wait()
+
+    tasks = [asyncio.create_task(request(Priority.INDEXING)) for _ in range(3)]
+    await asyncio.sleep(0.01)
+    # 后台请求只能占用一个名额
+    assert started == [Priority.INDEXING]
+
+    tasks.append(asyncio.create_task(request(Priority.MENTION)))
+    await asyncio.sleep(0.01)
+    assert started == [Priority.INDEXING, Priority.MENTION]
+
+    release.set()
+    await asyncio.gather(*tasks)
+    assert started.count(Priority.INDEXING) == 3
+    assert scheduler.metrics()["chat"]["in_flight"] == 0
+
+
+async def test_single_slot_is_shared(plugin_env):
+    from nonebot_plugin_nyaturingtest.scheduler import Priority, Scheduler
+
+    scheduler = Scheduler()
+    scheduler.configure("chat", rate=0, concurrency=1)
+    async with scheduler.slot("chat", priority=Priority.INDEXING):
+        pass
+    assert scheduler.metrics()["chat"]["in_flight"] == 0
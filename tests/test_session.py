@@ -0,0 +1,56 @@
+from collections.abc import AsyncIterator
+import json
+
+FEEDBACK_ACTIVE = {
+    "new_emotion": {"valence": 0.5, "arousal": 0.5, "dominance": 0.0},
+    "emotion_tends": [{"valence": 0.5, "arousal": 0.5, "dominance": 0.0}],
+    "summary": "在聊晚饭",
+    "analyze_result": [],
+    "willing": {"0": 0.0, "1": 0.0, "2": 1.0},
+}
+
+
+def _batch(content: str = "今天吃什么"):
+    from datetime import datetime
+
+    from nonebot_plugin_nyaturingtest.mem import Message
+
+    return [Message(time=datetime.now(), user_name="小明", content=content)]
+
+
+async def test_malformed_stream_still_records_sent_replies(make_session):
+    session = make_session()
+    sent: list[str] = []
+
+    async def llm(prompt: str) -> str:
+        return json.dumps(FEEDBACK_ACTIVE, ensure_ascii=False)
+
+    async def llm_stream(prompt: str) -> AsyncIterator[str]:
+        # 第一条回复完整发出后返回内容损坏
+        yield '{"reply": ["吃火锅", '
+        yield "broken"
+
+    async def on_reply(reply: str):
+        sent.append(reply)
+
+    batch = _batch()
+    replies = await session.update(batch, llm=llm, llm_stream=llm_stream, on_reply=on_reply, urgent=True)
+
+    assert sent == ["吃火锅"]
+    assert replies == ["吃火锅"]
+    contents = [msg.content for msg in session.global_memory.access().messages]
+    assert contents == ["今天吃什么", "吃火锅"]
+
+
+async def test_unresolved_deferred_images_are_not_ingested(make_session):
+    session = make_session()
+    ingested: list[str] = []
+    session.long_term_memory.add_texts = lambda texts: ingested.extend(texts)
+
+    batch = _batch(f"看这个[表情包(未查看):{'0' * 32}]")
+    await session.record(batch)
+
+    assert len(ingested) == 1
+    assert ingested[0].endswith("看这个[表情包]")
+    # 短期记忆保留占位文本，进入冒泡/对话状态后还能解析
+    assert session.global_memory.access().messages[-1].content == batch[0].content
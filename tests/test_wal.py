@@ -0,0 +1,57 @@
+import asyncio
+import os
+from pathlib import Path
+import time
+
+import pytest
+
+
+@pytest.fixture
+def slow_fsync(monkeypatch: pytest.MonkeyPatch):
+    """
+    fsync 变慢，并记录每次 fsync 时文件的大小
+    """
+    from nonebot_plugin_nyaturingtest import wal
+
+    synced: list[int] = []
+    fsync = os.fsync
+
+    def slow(fd: int):
+        time.sleep(0.1)
+        synced.append(os.fstat(fd).st_size)
+        fsync(fd)
+
+    monkeypatch.setattr(wal.os, "fsync", slow)
+    return synced
+
+
+async def test_append_during_commit_reaches_disk(plugin_env, tmp_path: Path, slow_fsync: list[int]):
+    from nonebot_plugin_nyaturingtest.wal import IngestLog
+
+    path = tmp_path / "ingest.jsonl"
+    log = IngestLog(str(path), commit_interval=0.01)
+    log.append(["第一条"])
+    await asyncio.sleep(0.05)
+    # 第一次提交正在 fsync
+    assert not slow_fsync
+    log.append(["第二条"])
+    await asyncio.sleep(0.3)
+
+    assert "第二条" in path.read_text(encoding="utf-8")
+    assert slow_fsync[-1] == path.stat().st_size
+    assert log.commits == 2
+
+
+async def test_compaction_keeps_records_written_meanwhile(plugin_env, tmp_path: Path, slow_fsync: list[int]):
+    from nonebot_plugin_nyaturingtest.wal import IngestLog
+
+    path = tmp_path / "ingest.jsonl"
+    log = IngestLog(str(path), commit_interval=0.01, compact_bytes=0)
+    seq = log.append(["已索引"])
+    log.ack(seq)
+    # 压缩在线程中进行，期间追加的文本不能丢失
+    log.append(["压缩期间追加"])
+    await asyncio.sleep(0.5)
+
+    assert "已索引" not in path.read_text(encoding="utf-8")
+    assert IngestLog(str(path)).replay() == [(2, "压缩期间追加")]